@@ -31,11 +31,22 @@
 
 
 
-import subprocess, re, logging, logging.handlers, sys, os, time, platform, socket, glob, time, operator
+import subprocess, re, logging, logging.handlers, sys, os, time, platform, socket, glob, time, operator, mmap, struct, select
 from ConfigParser import ConfigParser
 from threading import Timer, Thread
 from xml.etree import ElementTree
 
+# Layout of the fleet indexes written by ontapmon.py with FLEET_INDEX = yes:
+# a header (magic, version, header size, generation, time written, number
+# of filers) followed by one entry per filer (name offset and length, XML
+# document offset and length, time written, generation).
+FLEET_HEADER = struct.Struct('<4sHHQdI')
+FLEET_ENTRY = struct.Struct('<QIQIdQ')
+
+# Seconds to wait after ontapmon.py announced new data before checking,
+# so that the updates of several filers are read together.
+NOTIFY_SETTLE_TIME = 0.2
+
 # Initialize the logger for this script. Outputs to the /var/log directory.
 logger = logging.getLogger('netapp_lsf_hot_job_detector')
 handler = logging.handlers.TimedRotatingFileHandler('/var/log/netapp_lsf_hot_job_detector.log', when='midnight', interval=1, backupCount=7)
@@ -302,6 +313,15 @@ class HotJobDetector(object):
 		# of an unchanged performance data file.
 		self.filesLastModified = {}
 		
+		# The same for fleet indexes: (inode, number of filers) of each
+		# index file, and the generation of each filer last read.
+		self.fleetIndexesLastRead = {}
+		self.fleetGenerationsLastRead = {}
+		
+		# Connections to the notification sockets of ontapmon.py, by
+		# socket path, when ontap_notify_socket is set.
+		self.notifySockets = {}
+		
 		# Stores all of the performance errors and LSF jobs contributing
 		# to the performance errors. Provides an interface for processing
 		# them on a per-filer/volume/aggregate level.
@@ -356,38 +376,48 @@ class HotJobDetector(object):
 		sleepTime = int(sleepTime)
 			
 		while True:
-			# Get the list of files in the XML Data directory.
-			files = os.listdir(xmlDataDirectory)
+			# When ontapmon.py keeps fleet indexes (FLEET_INDEX = yes),
+			# a stat of each index tells whether any filer changed, and
+			# only the filers that changed are read out of it.
+			fleetIndexResult = self.readFleetIndexes(xmlDataDirectory)
+			if fleetIndexResult is not None:
+				filesToCheck, filesUpToDateCount = fleetIndexResult
+				
+				# Clear out the performance manager object.
+				self.performanceErrorDocumentManager = PerformanceErrorDocumentManager()
+			else:
+				# Get the list of files in the XML Data directory.
+				files = os.listdir(xmlDataDirectory)
 			
-			filesToCheck = []
-			filesUpToDateCount = 0
+				filesToCheck = []
+				filesUpToDateCount = 0
 			
-			# Clear out the performance manager object.
-			self.performanceErrorDocumentManager = PerformanceErrorDocumentManager()
+				# Clear out the performance manager object.
+				self.performanceErrorDocumentManager = PerformanceErrorDocumentManager()
 			
-			for filename in files:
-				if filename.endswith('.xml'):
-					# Check to see if this file has been modified (updated)
-					# since the last time this script read it.
-					filepath = xmlDataDirectory + filename
-					lastModifiedTime = os.path.getmtime(filepath)
+				for filename in files:
+					if filename.endswith('.xml'):
+						# Check to see if this file has been modified (updated)
+						# since the last time this script read it.
+						filepath = xmlDataDirectory + filename
+						lastModifiedTime = os.path.getmtime(filepath)
 					
-					if filename in self.filesLastModified:
-						modifiedTimeWhenLastRead = self.filesLastModified[filename]
+						if filename in self.filesLastModified:
+							modifiedTimeWhenLastRead = self.filesLastModified[filename]
 						
-						if lastModifiedTime != modifiedTimeWhenLastRead:
-							# This file has been modified since the last
-							# time it was read. Add it to the list of
-							# files that need to be read.
+							if lastModifiedTime != modifiedTimeWhenLastRead:
+								# This file has been modified since the last
+								# time it was read. Add it to the list of
+								# files that need to be read.
+								filesToCheck.append(filepath)
+								self.filesLastModified[filename] = lastModifiedTime
+							else:
+								logger.debug('File %s has not been updated since last run. Skipping file.' % (filename))
+								filesUpToDateCount += 1
+						else:
+							# This is the first time we're reading this XML file.
 							filesToCheck.append(filepath)
 							self.filesLastModified[filename] = lastModifiedTime
-						else:
-							logger.debug('File %s has not been updated since last run. Skipping file.' % (filename))
-							filesUpToDateCount += 1
-					else:
-						# This is the first time we're reading this XML file.
-						filesToCheck.append(filepath)
-						self.filesLastModified[filename] = lastModifiedTime
 			
 			# Make sure we found at least one XML file.
 			if (len(filesToCheck) + filesUpToDateCount) < 1:
@@ -417,10 +447,115 @@ class HotJobDetector(object):
 			
 			logger.info('Done processing files. Sleeping for %d seconds.' % (sleepTime))
 			
-			time.sleep(sleepTime)
+			self.waitForUpdates(sleepTime)
 			
 	
 	
+	# Sleeps for up to timeout seconds between checks. If
+	# ontap_notify_socket is set, this returns as soon as ontapmon.py
+	# announces new data on one of the listed sockets (its NOTIFY_SOCKET,
+	# see ontapnotify.py next to ontapmon.py), after a short delay so that
+	# the updates of several filers are handled together. Sockets that
+	# cannot be connected to are tried again on the next call.
+	def waitForUpdates(self, timeout):
+		socketPaths = [path.strip() for path in self.properties['ontap_notify_socket'].split(',') if path.strip() != '']
+		for socketPath in socketPaths:
+			if socketPath not in self.notifySockets:
+				notifySocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+				try:
+					notifySocket.connect(socketPath)
+					self.notifySockets[socketPath] = notifySocket
+					logger.info('Connected to ontapmon notification socket %s.' % (socketPath))
+				except socket.error:
+					logger.debug('Unable to connect to ontapmon notification socket %s.' % (socketPath))
+					notifySocket.close()
+		
+		if len(self.notifySockets) < 1:
+			time.sleep(timeout)
+			return
+		
+		readable = select.select(self.notifySockets.values(), [], [], timeout)[0]
+		if len(readable) > 0:
+			time.sleep(NOTIFY_SETTLE_TIME)
+		
+		# Read whatever came in. The events themselves are not needed,
+		# the next check finds the changed files.
+		for socketPath, notifySocket in self.notifySockets.items():
+			while len(select.select([notifySocket], [], [], 0)[0]) > 0:
+				try:
+					data = notifySocket.recv(65536)
+				except socket.error:
+					data = ''
+				if len(data) < 1:
+					logger.info('Lost connection to ontapmon notification socket %s.' % (socketPath))
+					notifySocket.close()
+					del self.notifySockets[socketPath]
+					break
+	
+	
+	# Reads the fleet index files (fleet*.idx) written by ontapmon.py in
+	# the XML data directory, see ontapfleet.py next to ontapmon.py for
+	# their layout. Returns None if there are none. Otherwise, returns
+	# the list of (label, XML text) of the filers that changed since
+	# they were last read, and the number of filers that did not.
+	def readFleetIndexes(self, xmlDataDirectory):
+		indexPaths = sorted(glob.glob(xmlDataDirectory + 'fleet*.idx'))
+		if len(indexPaths) < 1:
+			return None
+		
+		filesToCheck = []
+		filesUpToDateCount = 0
+		for indexPath in indexPaths:
+			try:
+				indexFile = open(indexPath, 'rb')
+			except IOError:
+				continue
+			try:
+				# The index is replaced by renaming a new file over it,
+				# so the same inode means nothing changed.
+				stat = os.fstat(indexFile.fileno())
+				if indexPath in self.fleetIndexesLastRead:
+					inode, filerCount = self.fleetIndexesLastRead[indexPath]
+					if inode == stat.st_ino:
+						logger.debug('Fleet index %s has not been updated since last run. Skipping file.' % (indexPath))
+						filesUpToDateCount += filerCount
+						continue
+				
+				if stat.st_size < FLEET_HEADER.size:
+					logger.warning('Fleet index %s is truncated.' % (indexPath))
+					continue
+				
+				data = mmap.mmap(indexFile.fileno(), stat.st_size, access=mmap.ACCESS_READ)
+			finally:
+				indexFile.close()
+			
+			try:
+				magic, version, headerSize, generation, updated, filerCount = FLEET_HEADER.unpack_from(data, 0)
+				if magic != 'ONTF' or version != 1:
+					logger.warning('File %s is not a fleet index this script can read.' % (indexPath))
+					continue
+				
+				logger.debug('Reading fleet index %s, generation %d.' % (indexPath, generation))
+				for i in range(filerCount):
+					nameOffset, nameLength, documentOffset, documentLength, updated, filerGeneration = \
+						FLEET_ENTRY.unpack_from(data, headerSize + i * FLEET_ENTRY.size)
+					filerName = data[nameOffset:nameOffset + nameLength]
+					if self.fleetGenerationsLastRead.get(filerName) == filerGeneration:
+						filesUpToDateCount += 1
+						continue
+					
+					filesToCheck.append(('%s:%s' % (indexPath, filerName), data[documentOffset:documentOffset + documentLength]))
+					self.fleetGenerationsLastRead[filerName] = filerGeneration
+				
+				self.fleetIndexesLastRead[indexPath] = (stat.st_ino, filerCount)
+			except struct.error:
+				logger.warning('Fleet index %s is truncated.' % (indexPath))
+			finally:
+				data.close()
+		
+		return filesToCheck, filesUpToDateCount
+		
+	
 	# Prints the text report to a file and then calls a script, passing
 	# the path to the report file as an argument. If the property is set,
 	# this script will wait for the called script to complete and then
@@ -950,11 +1085,20 @@ class HotJobDetector(object):
 		# Check the performance data in the passed-in files against
 		# the thresholds.
 		for filepath in filesToCheck:
+			# Filers read from a fleet index come as a (label, XML text)
+			# tuple.
+			xmlText = None
+			if isinstance(filepath, tuple):
+				filepath, xmlText = filepath
+			
 			logger.debug('Checking XML file %s.' % (filepath))
 			
 			# Read and parse the XML file.
-			tree = ElementTree.parse(filepath)
-			root = tree.getroot()
+			if xmlText is not None:
+				root = ElementTree.fromstring(xmlText)
+			else:
+				tree = ElementTree.parse(filepath)
+				root = tree.getroot()
 			
 			if root.find('filer') is None:
 				logger.warning('XML file %s is of an invalid format and does not appear to contain performance data.' % (filepath))
@@ -1101,6 +1245,7 @@ class HotJobDetector(object):
 		self.properties['command_to_run'] = 'python send_email_alert.py'
 		self.properties['num_top_jobs_to_report'] = '3'
 		self.properties['delete_report_after_command'] = 'false'
+		self.properties['ontap_notify_socket'] = ''
 		
 		# Set some default values for the global thresholds. These should
 		# be overwritten when reading the config file.
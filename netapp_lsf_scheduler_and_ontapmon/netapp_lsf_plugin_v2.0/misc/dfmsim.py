@@ -0,0 +1,369 @@
+#===============================================================#
+#                                                               #
+# $ID$                                                          #
+#                                                               #
+# dfmsim.py - Simulated OnCommand (DFM) ZAPI server for testing #
+#               and load testing ontapmon.py without a DFM      #
+#               server or filers. Serves the APIs ontapmon.py   #
+#               calls over HTTP on the ZAPI URL:                #
+#                       - host-list-info-iter-*                 #
+#                       - netif-ip-interface-list-info          #
+#                       - aggregate-list-info-iter-*            #
+#                       - perf-get-counter-data                 #
+#                       - api-proxy of volume-list-info-iter-*  #
+#                                                               #
+#               The fleet is made up: filers are named          #
+#               <prefix>00000, <prefix>00001, ..., each with    #
+#               the same number of aggregates and volumes, and  #
+#               counter values are random. Delays, failed       #
+#               replies, dropped connections, filers that are   #
+#               down and filers that are slow can be injected.  #
+#                                                               #
+#               Usage: dfmsim.py [options], see dfmsim.py -h    #
+#                                                               #
+#               Point PORT in config.ini at the simulator, with #
+#               HOST = 127.0.0.1 and any USER and PASSWD. The   #
+#               number of calls per API is written to stderr    #
+#               when the simulator is stopped.                  #
+#                                                               #
+# Copyright (c) 2012 NetApp, Inc. All rights reserved.          #
+# Specifications subject to change without notice.              #
+#                                                               #
+#===============================================================#
+
+import sys
+import time
+import random
+import signal
+import socket
+import threading
+import zlib
+import BaseHTTPServer
+import SocketServer
+from optparse import OptionParser
+from xml.etree import ElementTree
+
+PROCESSORS = 2
+DISKS_PER_AGGR = 4
+
+#
+# The simulated fleet and the state of the open iterators
+#
+class Fleet(object):
+    def __init__(self, options):
+        self.options = options
+        self.filers = ["%s%05d" %(options.prefix, i) for i in range(options.filers)]
+        self.index = dict([(f, i) for (i, f) in enumerate(self.filers)])
+        # The first filers are down, the next ones are slow
+        self.down = set(self.filers[:options.down])
+        self.slow = set(self.filers[options.down:options.down + options.slow])
+        self.tags = {}
+        self.nextTag = 0
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def aggrs(self, f):
+        return [f + ":aggr%d" %(i) for i in range(self.options.aggrs)]
+
+    # @return list of (volume, aggregate) of a filer
+    def volumes(self, f):
+        vols = []
+        for a in range(self.options.aggrs) :
+            for v in range(self.options.vols) :
+                vols.append(("vol%d_%d" %(a, v), "aggr%d" %(a)))
+        return vols
+
+    #
+    # Opens an iterator over items.
+    # @return tag of the iterator
+    #
+    def open_iter(self, items):
+        self.lock.acquire()
+        try :
+            self.nextTag = self.nextTag + 1
+            tag = "tag%d" %(self.nextTag)
+            self.tags[tag] = list(items)
+        finally :
+            self.lock.release()
+        return tag
+
+    # @return the next maximum items of an iterator
+    def next_iter(self, tag, maximum):
+        self.lock.acquire()
+        try :
+            items = self.tags.get(tag, [])
+            self.tags[tag] = items[maximum:]
+        finally :
+            self.lock.release()
+        return items[:maximum]
+
+    def close_iter(self, tag):
+        self.lock.acquire()
+        try :
+            self.tags.pop(tag, None)
+        finally :
+            self.lock.release()
+
+    def count(self, api):
+        self.lock.acquire()
+        try :
+            self.calls[api] = self.calls.get(api, 0) + 1
+        finally :
+            self.lock.release()
+
+def object_id(name):
+    return 1000 + (zlib.crc32(name) & 0x7fffffff) % 1000000
+
+def xml_escape(s):
+    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+#
+# @return the XML of an element with text content or child elements
+#
+def elem(name, content=None, children=()):
+    s = "<" + name + ">"
+    if (content != None) :
+        s = s + xml_escape(str(content))
+    return s + "".join(children) + "</" + name + ">"
+
+def counter(name, value, label=None):
+    children = [elem("counter-name", name), elem("counter-data", "%d:%0.3f" %(int(time.time()), value))]
+    if (label != None) :
+        children.append(elem("label-names", label))
+    return elem("perf-counter-data", None, children)
+
+def instance(name, oid, counters):
+    return elem("instance-data", None, [elem("instance-name", name), elem("object-id", oid),
+                                        elem("counters", None, counters)])
+
+#
+# Handlers of the APIs. Each gets the fleet and the request element and
+# returns the list of child elements of a passed reply.
+#
+def host_iter_start(fleet, req):
+    return [elem("records", len(fleet.filers)), elem("tag", fleet.open_iter(fleet.filers))]
+
+def host_iter_next(fleet, req):
+    hosts = fleet.next_iter(req.findtext("tag"), int(req.findtext("maximum")))
+    return [elem("records", len(hosts)),
+            elem("hosts", None, [elem("host-info", None, [elem("host-name", f)]) for f in hosts])]
+
+def iter_end(fleet, req):
+    fleet.close_iter(req.findtext("tag"))
+    return []
+
+def netif_list(fleet, req):
+    i = fleet.index[req.findtext("hostname")]
+    ips = [elem("ip-address", "10.%d.%d.%d" %(i / 256 % 256, i % 256, k)) for k in (1, 2)]
+    return [elem("interfaces", None, [elem("interface-info", None, [elem("ip-addresses", None, ips)])])]
+
+def aggr_iter_start(fleet, req):
+    aggrs = fleet.aggrs(req.findtext("object-name-or-id"))
+    return [elem("records", len(aggrs)), elem("tag", fleet.open_iter(aggrs))]
+
+def aggr_iter_next(fleet, req):
+    aggrs = fleet.next_iter(req.findtext("tag"), int(req.findtext("maximum")))
+    infos = [elem("aggregate-info", None, [elem("aggregate-name", a), elem("aggregate-id", object_id(a))])
+             for a in aggrs]
+    return [elem("records", len(aggrs)), elem("aggregates", None, infos)]
+
+#
+# Volume and disk counters are asked for per aggregate (<filer>:<aggr>),
+# domain busy per filer. Disk instances carry the id of their aggregate,
+# as ontapmon.py uses it to tell the aggregates of a batch apart.
+#
+def perf_data(fleet, req):
+    insts = []
+    for ici in req.findall("instance-counter-info") :
+        obj = ici.findtext("object-name-or-id")
+        labels = []
+        for poc in ici.findall("counter-info/perf-object-counter") :
+            otype = poc.findtext("object-type")
+            cname = poc.findtext("counter-name")
+            if (otype == "volume") :
+                (f, a) = obj.split(":")
+                for (v, va) in fleet.volumes(f) :
+                    if (va == a) :
+                        insts.append(instance(v, object_id(f + ":" + v),
+                                              [counter(cname, random.uniform(100, 20000))]))
+            elif (otype == "disk") :
+                for d in range(DISKS_PER_AGGR) :
+                    insts.append(instance("%s.d%d" %(obj, d), object_id(obj),
+                                          [counter(cname, random.uniform(0, 100))]))
+            elif (otype == "processor") :
+                labels.append(poc.findtext("label-names"))
+        if (len(labels) != 0) :
+            for p in range(PROCESSORS) :
+                insts.append(instance("processor%d" %(p), object_id(obj + ":processor%d" %(p)),
+                                      [counter("domain_busy", random.uniform(0, 90), l) for l in labels]))
+    return [elem("perf-instances", None, insts)]
+
+def vol_iter_start(fleet, target, args):
+    vols = fleet.volumes(target)
+    return [elem("records", len(vols)), elem("tag", fleet.open_iter(vols))]
+
+def vol_iter_next(fleet, target, args):
+    vols = fleet.next_iter(args.findtext("tag"), int(args.findtext("maximum")))
+    infos = []
+    for (v, a) in vols :
+        infos.append(elem("volume-info", None, [
+            elem("name", v), elem("state", "online"), elem("type", "flex"),
+            elem("size-available", random.randint(1 << 30, 1 << 40)),
+            elem("files-used", random.randint(100, 100000)), elem("files-total", 1000000),
+            elem("containing-aggregate", a)]))
+    return [elem("records", len(vols)), elem("volumes", None, infos)]
+
+def vol_iter_end(fleet, target, args):
+    fleet.close_iter(args.findtext("tag"))
+    return []
+
+PROXIED = {
+    "volume-list-info-iter-start": vol_iter_start,
+    "volume-list-info-iter-next": vol_iter_next,
+    "volume-list-info-iter-end": vol_iter_end,
+}
+
+def api_proxy(fleet, req):
+    target = req.findtext("target")
+    request = req.find("request")
+    handler = PROXIED.get(request.findtext("name"))
+    if (handler == None) :
+        results = failed_results("Unable to find API: " + request.findtext("name"), 13005)
+    else :
+        args = request.find("args")
+        if (args == None) :
+            args = ElementTree.Element("args")
+        results = "<results status=\"passed\">" + "".join(handler(fleet, target, args)) + "</results>"
+    return [elem("response", None, [elem("status", "passed"), results])]
+
+APIS = {
+    "host-list-info-iter-start": host_iter_start,
+    "host-list-info-iter-next": host_iter_next,
+    "host-list-info-iter-end": iter_end,
+    "netif-ip-interface-list-info": netif_list,
+    "aggregate-list-info-iter-start": aggr_iter_start,
+    "aggregate-list-info-iter-next": aggr_iter_next,
+    "aggregate-list-info-iter-end": iter_end,
+    "perf-get-counter-data": perf_data,
+    "api-proxy": api_proxy,
+}
+
+def failed_results(reason, errno):
+    return "<results status=\"failed\" reason=\"" + xml_escape(reason) + "\" errno=\"%d\"></results>" %(errno)
+
+#
+# @return the filer a request is about, or None for fleet wide calls
+#
+def target_filer(fleet, req):
+    for tag in ("hostname", "target", "object-name-or-id", "instance-counter-info/object-name-or-id") :
+        name = req.findtext(tag)
+        if (name != None) :
+            return name.split(":")[0]
+    return None
+
+class ZapiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        fleet = self.server.fleet
+        options = fleet.options
+        body = self.rfile.read(int(self.headers.getheader("content-length", 0)))
+        root = ElementTree.fromstring(body)
+        for e in root.getiterator() :
+            e.tag = e.tag.split("}")[-1]
+        req = list(root)[0]
+        api = req.tag
+        fleet.count(api)
+        filer = target_filer(fleet, req)
+        if (options.log) :
+            sys.stderr.write("%.3f %s %s\n" %(time.time(), api, filer))
+
+        delay = options.latency + random.uniform(-options.jitter, options.jitter)
+        if (filer in fleet.slow) :
+            delay = delay + options.slow_latency
+        if (delay > 0) :
+            time.sleep(delay / 1000.0)
+
+        if (random.random() < options.drop_rate) :
+            self.close_connection = 1
+            return
+
+        handler = APIS.get(api)
+        if (handler == None) :
+            results = failed_results("Unable to find API: " + api, 13005)
+        elif (filer in fleet.down) :
+            results = failed_results("Timed out while waiting for a response from " + filer, 13001)
+        elif (random.random() < options.error_rate) :
+            results = failed_results("Simulated failure of " + api, 13001)
+        else :
+            results = "<results status=\"passed\">" + "".join(handler(fleet, req)) + "</results>"
+
+        data = ("<?xml version='1.0' encoding='UTF-8' ?>\n"
+                "<netapp version='1.0' xmlns='http://www.netapp.com/filer/admin'>" + results + "</netapp>")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class ZapiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    # Clients closing their connections is normal, not worth a traceback
+    def handle_error(self, request, client_address):
+        if (not isinstance(sys.exc_info()[1], socket.error)) :
+            SocketServer.ThreadingMixIn.handle_error(self, request, client_address)
+
+def print_calls(fleet):
+    apis = fleet.calls.keys()
+    apis.sort()
+    for api in apis :
+        sys.stderr.write("%-34s %10d\n" %(api, fleet.calls[api]))
+
+def signal_handler_term(signal, frame) :
+    sys.exit(0)
+
+def option_parser():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-p", "--port", type="int", default=8088, help="port to listen on (default 8088)")
+    parser.add_option("-f", "--filers", type="int", default=10, help="number of filers (default 10)")
+    parser.add_option("-a", "--aggrs", type="int", default=3, help="aggregates per filer (default 3)")
+    parser.add_option("-v", "--vols", type="int", default=5, help="volumes per aggregate (default 5)")
+    parser.add_option("--prefix", default="filer", help="prefix of the filer names (default filer)")
+    parser.add_option("-l", "--latency", type="float", default=0.0, help="milliseconds added to every call")
+    parser.add_option("-j", "--jitter", type="float", default=0.0,
+                      help="random milliseconds added to or taken off the latency")
+    parser.add_option("-e", "--error-rate", type="float", default=0.0,
+                      help="fraction of calls that return a failed status")
+    parser.add_option("-d", "--drop-rate", type="float", default=0.0,
+                      help="fraction of calls whose connection is closed without a reply")
+    parser.add_option("--down", type="int", default=0, help="number of filers whose calls always fail")
+    parser.add_option("--slow", type="int", default=0, help="number of filers whose calls are slow")
+    parser.add_option("--slow-latency", type="float", default=1000.0,
+                      help="milliseconds added to the calls of slow filers (default 1000)")
+    parser.add_option("--log", action="store_true", default=False, help="log every call to stderr")
+    return parser
+
+#
+# MAIN
+#
+if __name__ == '__main__':
+    (options, args) = option_parser().parse_args()
+
+    fleet = Fleet(options)
+    server = ZapiServer(("127.0.0.1", options.port), ZapiHandler)
+    server.fleet = fleet
+
+    signal.signal(signal.SIGTERM, signal_handler_term)
+    try :
+        try :
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    finally :
+        print_calls(fleet)
@@ -0,0 +1,172 @@
+#===============================================================#
+#                                                               #
+# $ID$                                                          #
+#                                                               #
+# ontapcapture.py - Capture of the raw ZAPI requests and        #
+#               responses of ontapmon.py (CAPTURE_FILE), which  #
+#               ontapmon.py --replay feeds back through the     #
+#               collection code to reproduce and profile it     #
+#               offline.                                        #
+#                                                               #
+#               The file is gzip compressed and only appended   #
+#               to. Each run adds a gzip member starting with   #
+#               an OPEN record, followed by a CALL record per   #
+#               ZAPI call and a COLLECTION record at the end of #
+#               each collection of a filer. A record is RECORD  #
+#               (little endian) followed by the filer name, API #
+#               name, request and response it gives the length  #
+#               of. The calls of a collection are the CALL      #
+#               records of its filer since the previous         #
+#               COLLECTION record of that filer.                #
+#                                                               #
+# Copyright (c) 2012 NetApp, Inc. All rights reserved.          #
+# Specifications subject to change without notice.              #
+#                                                               #
+#===============================================================#
+
+import gzip
+import time
+import zlib
+import struct
+import threading
+
+MAGIC = "ONTC"
+VERSION = 1
+
+# Record kinds
+OPEN = 1
+CALL = 2
+COLLECTION = 3
+
+# kind, time started, seconds taken, status (VERSION of an OPEN record,
+# result of a COLLECTION), lengths of filer, API, request and response
+RECORD = struct.Struct("<BddiIIII")
+# Response length of a call that got no response
+NO_RESPONSE = 0xffffffff
+
+class CaptureError(Exception):
+    pass
+
+def encode(text):
+    if (isinstance(text, unicode)) :
+        return text.encode("utf-8")
+    return text
+
+#
+# Appends records to the capture file at path. Can be used from several
+# threads at once.
+#
+class CaptureWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fp = gzip.open(path, "ab")
+        self.write(OPEN, time.time(), 0.0, VERSION, "", MAGIC, "", "")
+
+    def write(self, kind, started, seconds, status, filer, api, request, response):
+        (filer, api, request) = (encode(filer or ""), encode(api), encode(request))
+        if (response == None) :
+            (response, rlen) = ("", NO_RESPONSE)
+        else :
+            response = encode(response)
+            rlen = len(response)
+        record = RECORD.pack(kind, started, seconds, status, len(filer), len(api), len(request), rlen)
+        self.lock.acquire()
+        try :
+            if (self.fp != None) :
+                self.fp.write(record + filer + api + request + response)
+        finally :
+            self.lock.release()
+
+    # Records a ZAPI call made for filer (None for other calls). response
+    # is the raw response, None if there was none.
+    def call(self, filer, api, request, started, seconds, response):
+        self.write(CALL, started, seconds, 0, filer, api, request, response)
+
+    def collection(self, filer, started, seconds, result):
+        self.write(COLLECTION, started, seconds, result, filer, "", "", "")
+
+    # Makes what was written so far readable, should the process die
+    def flush(self):
+        self.lock.acquire()
+        try :
+            if (self.fp != None) :
+                self.fp.flush()
+        finally :
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try :
+            if (self.fp != None) :
+                self.fp.close()
+                self.fp = None
+        finally :
+            self.lock.release()
+
+#
+# Reads the records of the capture file at path. A capture cut short by
+# the end of its writer ends at its last complete record.
+# @return generator of (kind, started, seconds, status, filer, api,
+# request, response), with response None for a call without one
+#
+def read_records(path):
+    fp = gzip.open(path, "rb")
+    try :
+        first = True
+        while True :
+            try :
+                head = fp.read(RECORD.size)
+                if (len(head) < RECORD.size) :
+                    return
+                (kind, started, seconds, status, flen, alen, qlen, rlen) = RECORD.unpack(head)
+                size = flen + alen + qlen
+                if (rlen != NO_RESPONSE) :
+                    size = size + rlen
+                data = fp.read(size)
+            except (IOError, EOFError, zlib.error):
+                if (first) :
+                    raise CaptureError("not a capture file: " + path)
+                return
+            if (len(data) < size) :
+                return
+            api = data[flen:flen + alen]
+            if (first) and ((kind != OPEN) or (api != MAGIC)) :
+                raise CaptureError("not a capture file: " + path)
+            if (kind == OPEN) and (status != VERSION) :
+                raise CaptureError("unsupported capture version %d in %s" %(status, path))
+            first = False
+
+            response = None
+            if (rlen != NO_RESPONSE) :
+                response = data[flen + alen + qlen:]
+            yield (kind, started, seconds, status, data[:flen], api, data[flen + alen:flen + alen + qlen], response)
+    finally :
+        fp.close()
+
+#
+# Groups the calls of the capture file at path by collection. Calls that
+# were not made for a filer (the filer list) and those of collections
+# that did not finish before their run ended are left out.
+# @return generator of (filer, started, seconds, result, calls, run,
+# refreshes) in the order the collections finished, calls being a list of
+# (api, request, started, seconds, response), run the number of the run
+# of ontapmon.py in the file and refreshes the number of filer lists it
+# had fetched
+#
+def read_collections(path):
+    pending = {}
+    run = 0
+    refreshes = 0
+    for (kind, started, seconds, status, filer, api, request, response) in read_records(path) :
+        if (kind == OPEN) :
+            pending = {}
+            run = run + 1
+            refreshes = 0
+        elif (kind == CALL) and (filer == "") :
+            if (api == "host-list-info-iter-start") :
+                refreshes = refreshes + 1
+        elif (kind == CALL) :
+            pending.setdefault(filer, []).append((api, request, started, seconds, response))
+        elif (kind == COLLECTION) :
+            yield (filer, started, seconds, status, pending.pop(filer, []), run, refreshes)
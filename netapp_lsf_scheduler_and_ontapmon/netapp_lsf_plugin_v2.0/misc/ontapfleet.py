@@ -0,0 +1,217 @@
+#===============================================================#
+#                                                               #
+# $ID$                                                          #
+#                                                               #
+# ontapfleet.py - Writer and reader of the fleet index that     #
+#               ontapmon.py keeps in DIRLOC (fleet.idx, or      #
+#               fleet.shard<n>.idx per shard) when FLEET_INDEX  #
+#               = yes. The index holds the XML documents of all #
+#               filers in one file, which is replaced once per  #
+#               INTERVAL when a filer changed. Consumers stat   #
+#               the index alone to find out whether anything    #
+#               changed, and then read only the filers they     #
+#               need, or those whose generation moved.          #
+#                                                               #
+#               Layout (little endian, offsets from the start)  #
+#                                                               #
+#               header  HEADER (magic, version, generation)     #
+#               table   nfilers x ENTRY, sorted by filer name   #
+#               data    filer names and XML documents           #
+#                                                               #
+#               The generation of the index goes up with every  #
+#               index written. The generation of an entry is    #
+#               the one of the index its document changed in.   #
+#                                                               #
+# Copyright (c) 2012 NetApp, Inc. All rights reserved.          #
+# Specifications subject to change without notice.              #
+#                                                               #
+#===============================================================#
+
+import os
+import time
+import glob
+import mmap
+import struct
+import bisect
+import threading
+
+MAGIC = "ONTF"
+VERSION = 1
+
+# magic, version, header size, generation, time written, nfilers
+HEADER = struct.Struct("<4sHHQdI")
+# name offset, name length, document offset, document length, time the
+# document was written, generation
+ENTRY = struct.Struct("<QIQIdQ")
+
+class FleetIndexError(Exception):
+    pass
+
+#
+# Read only view of a fleet index held in a string, buffer or mmap.
+#
+class FleetIndex(object):
+    def __init__(self, data):
+        if (len(data) < HEADER.size) :
+            raise FleetIndexError("fleet index too short")
+        (magic, version, hsize, self.generation, self.updated, self.nfilers) = HEADER.unpack_from(data, 0)
+        if (magic != MAGIC) :
+            raise FleetIndexError("not a fleet index")
+        if (version != VERSION) :
+            raise FleetIndexError("unsupported fleet index version %d" %(version))
+
+        self.data = data
+        self.tableOffset = hsize
+        if (len(data) < self.tableOffset + self.nfilers * ENTRY.size) :
+            raise FleetIndexError("fleet index truncated")
+        self.names = [self.name(i) for i in range(self.nfilers)]
+
+    def name(self, i):
+        (noff, nlen) = ENTRY.unpack_from(self.data, self.tableOffset + i * ENTRY.size)[:2]
+        return self.data[noff:noff + nlen]
+
+    #
+    # @return (name, updated, generation) of entry i
+    #
+    def entry(self, i):
+        (noff, nlen, doff, dlen, updated, generation) = \
+            ENTRY.unpack_from(self.data, self.tableOffset + i * ENTRY.size)
+        return (self.names[i], updated, generation)
+
+    def entries(self):
+        return [self.entry(i) for i in range(self.nfilers)]
+
+    # @return index of the entry of filer, or -1
+    def find(self, filer):
+        i = bisect.bisect_left(self.names, filer)
+        if (i < self.nfilers) and (self.names[i] == filer) :
+            return i
+        return -1
+
+    # @return the XML document of entry i
+    def document(self, i):
+        (doff, dlen) = ENTRY.unpack_from(self.data, self.tableOffset + i * ENTRY.size)[2:4]
+        return self.data[doff:doff + dlen]
+
+    def close(self):
+        if (isinstance(self.data, mmap.mmap)) :
+            self.data.close()
+
+#
+# Maps the fleet index at path. The file is replaced, never rewritten in
+# place, so the mapping stays valid after a new index is renamed over it.
+# @return FleetIndex
+#
+def open_index(path):
+    fp = open(path, "rb")
+    try :
+        size = os.fstat(fp.fileno()).st_size
+        if (size == 0) :
+            raise FleetIndexError("empty fleet index " + path)
+        data = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+    finally :
+        fp.close()
+    return FleetIndex(data)
+
+#
+# @return the paths of the fleet indexes in dirloc, one per shard
+#
+def index_paths(dirloc):
+    return sorted(glob.glob(os.path.join(dirloc, "fleet*.idx")))
+
+#
+# Keeps the fleet index at path. Collections mark() the filers whose XML
+# file they rewrote, and update() writes a new index with their documents
+# and the unchanged ones copied from the previous index.
+#
+class FleetIndexWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.changed = set()
+        self.index = None
+        self.generation = 0
+        # Go on from the index of an earlier run, so that generations
+        # keep going up for the readers
+        if (os.path.exists(path)) :
+            try :
+                self.index = open_index(path)
+                self.generation = self.index.generation
+            except (IOError, OSError, FleetIndexError):
+                self.index = None
+
+    # Notes that the XML file of filer was rewritten
+    def mark(self, filer):
+        self.lock.acquire()
+        try :
+            self.changed.add(filer)
+        finally :
+            self.lock.release()
+
+    #
+    # Writes a new index of filers, reading the documents of the changed
+    # ones from xml_path(filer). Filers that have no document yet (never
+    # collected, failing or backed off) are left out. Nothing is written
+    # when no filer changed, came or went.
+    # @return generation of the current index
+    #
+    def update(self, filers, xml_path):
+        self.lock.acquire()
+        try :
+            (changed, self.changed) = (self.changed, set())
+        finally :
+            self.lock.release()
+
+        old = {}
+        if (self.index != None) :
+            for (i, name) in enumerate(self.index.names) :
+                old[name] = i
+        filers = sorted([f for f in filers if (f in changed) or (f in old)])
+        if (len(changed.intersection(filers)) == 0) and (sorted(old.keys()) == filers) :
+            return self.generation
+
+        generation = self.generation + 1
+        records = []
+        # Whether a document was read for a changed filer
+        fresh = False
+        for f in filers :
+            if (isinstance(f, unicode)) :
+                f = f.encode("utf-8")
+            if (f in changed) :
+                try :
+                    fp = open(xml_path(f), "rb")
+                    try :
+                        updated = os.fstat(fp.fileno()).st_mtime
+                        records.append((f, fp.read(), updated, generation))
+                        fresh = True
+                    finally :
+                        fp.close()
+                    continue
+                except (IOError, OSError):
+                    pass
+            if (f in old) :
+                (name, updated, gen) = self.index.entry(old[f])
+                records.append((f, self.index.document(old[f]), updated, gen))
+        if (not fresh) and ([r[0] for r in records] == sorted(old.keys())) :
+            return self.generation
+
+        tmpname = self.path + ".tmp"
+        fp = open(tmpname, "wb")
+        try :
+            fp.write(HEADER.pack(MAGIC, VERSION, HEADER.size, generation, time.time(), len(records)))
+            pos = HEADER.size + len(records) * ENTRY.size
+            for (name, document, updated, gen) in records :
+                fp.write(ENTRY.pack(pos, len(name), pos + len(name), len(document), updated, gen))
+                pos = pos + len(name) + len(document)
+            for (name, document, updated, gen) in records :
+                fp.write(name)
+                fp.write(document)
+        finally :
+            fp.close()
+        os.rename(tmpname, self.path)
+
+        if (self.index != None) :
+            self.index.close()
+        self.index = open_index(self.path)
+        self.generation = generation
+        return generation
@@ -0,0 +1,193 @@
+#===============================================================#
+#                                                               #
+# $ID$                                                          #
+#                                                               #
+# ontaphttp.py - HTTP server answering queries on the data of   #
+#               ontapmon.py in JSON, started when HTTP_PORT is  #
+#               set in config.ini.                              #
+#                                                               #
+#               The server only reads the published dictionary  #
+#               of the filers, which ontapmon.py fills with a   #
+#               new tuple for a filer after each collection and #
+#               never changes afterwards. Queries take no lock  #
+#               and never hold up a collection.                 #
+#                                                               #
+#               GET /filers                                     #
+#                       filer names, update times, generations  #
+#               GET /filers/<filer>[?aggr=<a>&volume=<v>]       #
+#                       data of a filer, optionally only some   #
+#                       of its aggregates or volumes            #
+#               GET /aggregates[?filer=&aggr=]                  #
+#               GET /volumes[?filer=&aggr=&volume=]             #
+#                       matching rows across the fleet          #
+#               GET /top/aggregates[?n=10&filer=]               #
+#                       aggregates with the highest maxdiskb    #
+#               GET /top/volumes[?n=10&filer=&aggr=]            #
+#                       volumes with the highest avglatency     #
+#                                                               #
+#               Filters take comma separated names and may be   #
+#               given more than once.                           #
+#                                                               #
+# Copyright (c) 2012 NetApp, Inc. All rights reserved.          #
+# Specifications subject to change without notice.              #
+#                                                               #
+#===============================================================#
+
+import cgi
+import heapq
+import json
+import logging
+import urllib
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+logger = logging.getLogger('ontap_monitoring_agent')
+
+TOP_DEFAULT = 10
+TOP_MAX = 10000
+
+#
+# Published data of a filer: (updated, generation, ipaddrs, aggrs,
+# domains), where aggrs is a list of (name, maxdiskb, volumes), volumes
+# a list of (name, avglatency, availsize, availinodes) and domains a
+# list of (name, value), as ontapmon.snapshot_records() returns them.
+#
+
+class QueryError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+#
+# @return the set of names given for a filter, None if not filtered
+#
+def names_param(params, key):
+    if (key not in params) :
+        return None
+    names = set()
+    for value in params[key] :
+        names.update([name for name in value.split(",") if name != ""])
+    return names
+
+def int_param(params, key, default, maximum):
+    try :
+        value = int(params.get(key, [default])[-1])
+    except ValueError:
+        raise QueryError(400, "invalid " + key)
+    if (value < 0) :
+        raise QueryError(400, "invalid " + key)
+    return min(value, maximum)
+
+def volume_json(vol):
+    (name, avglatency, availsize, availinodes) = vol
+    return {"name": name, "avglatency": avglatency, "availsize": availsize, "availinodes": availinodes}
+
+def filer_json(filer, data, aggrs=None, volumes=None):
+    (updated, generation, ipaddrs, aggrlist, domains) = data
+    out = {"filer": filer, "updated": updated, "generation": generation,
+           "ipaddresses": list(ipaddrs), "aggregates": [],
+           "domains": [{"name": d, "value": value} for (d, value) in domains]}
+    for (a, maxdiskb, vols) in aggrlist :
+        if (aggrs != None) and (a not in aggrs) :
+            continue
+        vlist = [volume_json(vol) for vol in vols if (volumes == None) or (vol[0] in volumes)]
+        if (volumes != None) and (len(vlist) == 0) :
+            continue
+        out["aggregates"].append({"name": a, "maxdiskb": maxdiskb, "volumes": vlist})
+    return out
+
+#
+# Rows of the aggregates (filer, aggr, maxdiskb, volumes) that pass the
+# filters, read off the published filers as they are at the time
+#
+def aggregate_rows(published, filers, aggrs):
+    for (f, data) in published.items() :
+        if (filers != None) and (f not in filers) :
+            continue
+        for (a, maxdiskb, vols) in data[3] :
+            if (aggrs == None) or (a in aggrs) :
+                yield (f, a, maxdiskb, vols)
+
+def volume_rows(published, filers, aggrs, volumes):
+    for (f, a, maxdiskb, vols) in aggregate_rows(published, filers, aggrs) :
+        for vol in vols :
+            if (volumes == None) or (vol[0] in volumes) :
+                yield (f, a, vol)
+
+def aggregate_json(row):
+    (f, a, maxdiskb, vols) = row
+    return {"filer": f, "name": a, "maxdiskb": maxdiskb}
+
+def volume_row_json(row):
+    (f, a, vol) = row
+    out = volume_json(vol)
+    out["filer"] = f
+    out["aggregate"] = a
+    return out
+
+#
+# Answers a query.
+# @return the object to send as JSON
+#
+def query(published, path, params):
+    parts = [urllib.unquote(part) for part in path.split("/") if part != ""]
+    filers = names_param(params, "filer")
+    aggrs = names_param(params, "aggr")
+    volumes = names_param(params, "volume")
+
+    if (parts == ["filers"]) :
+        items = published.items()
+        items.sort()
+        return [{"filer": f, "updated": data[0], "generation": data[1]} for (f, data) in items]
+    if (len(parts) == 2) and (parts[0] == "filers") :
+        data = published.get(parts[1])
+        if (data == None) :
+            raise QueryError(404, "unknown filer " + parts[1])
+        return filer_json(parts[1], data, aggrs, volumes)
+    if (parts == ["aggregates"]) :
+        return [aggregate_json(row) for row in aggregate_rows(published, filers, aggrs)]
+    if (parts == ["volumes"]) :
+        return [volume_row_json(row) for row in volume_rows(published, filers, aggrs, volumes)]
+    if (parts == ["top", "aggregates"]) :
+        n = int_param(params, "n", TOP_DEFAULT, TOP_MAX)
+        rows = heapq.nlargest(n, aggregate_rows(published, filers, aggrs), key=lambda row: row[2])
+        return [aggregate_json(row) for row in rows]
+    if (parts == ["top", "volumes"]) :
+        n = int_param(params, "n", TOP_DEFAULT, TOP_MAX)
+        rows = heapq.nlargest(n, volume_rows(published, filers, aggrs, volumes), key=lambda row: row[2][1])
+        return [volume_row_json(row) for row in rows]
+    raise QueryError(404, "unknown query " + path)
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        try :
+            body = json.dumps(query(self.server.published, url.path, cgi.parse_qs(url.query)))
+            code = 200
+        except QueryError, e:
+            body = json.dumps({"error": str(e)})
+            code = e.code
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("QueryHandler: " + self.address_string() + " " + (format %args))
+
+class QueryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, port, published):
+        BaseHTTPServer.HTTPServer.__init__(self, (address, port), QueryHandler)
+        self.published = published
+
+    # Serves in a thread of its own
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
@@ -0,0 +1,170 @@
+#===============================================================#
+#                                                               #
+# $ID$                                                          #
+#                                                               #
+# ontapmetrics.py - Counters, gauges and histograms used by     #
+#               ontapmon.py to measure itself, written out in   #
+#               the Prometheus text exposition format so that   #
+#               the file can be read by node_exporter's         #
+#               textfile collector or simply looked at.         #
+#                                                               #
+#               Every metric has at most one label. Updating a  #
+#               metric takes a lock and a few list operations,  #
+#               so its cost does not depend on how much has     #
+#               been recorded.                                  #
+#                                                               #
+# Copyright (c) 2012 NetApp, Inc. All rights reserved.          #
+# Specifications subject to change without notice.              #
+#                                                               #
+#===============================================================#
+
+import os
+import bisect
+import threading
+
+# Upper bounds in seconds of the histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_value(value):
+    if (value == float("inf")) :
+        return "+Inf"
+    if (isinstance(value, (int, long))) :
+        return str(value)
+    return repr(float(value))
+
+#
+# Base class of the metrics. series maps a label value (or None for a
+# metric without label) to the state of that series.
+#
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def labels(self, value, extra=""):
+        if (self.label == None) :
+            if (extra == "") :
+                return ""
+            return "{" + extra + "}"
+        if (extra != "") :
+            extra = "," + extra
+        return "{" + self.label + "=\"" + escape_label(value) + "\"" + extra + "}"
+
+    # Drops the series of a label value, e.g. of a removed filer
+    def remove(self, value):
+        self.lock.acquire()
+        try :
+            self.series.pop(value, None)
+        finally :
+            self.lock.release()
+
+    def snapshot(self):
+        self.lock.acquire()
+        try :
+            return [(k, self.copy(v)) for (k, v) in self.series.items()]
+        finally :
+            self.lock.release()
+
+    def copy(self, state):
+        return state
+
+    def expose(self):
+        lines = ["# HELP " + self.name + " " + self.help, "# TYPE " + self.name + " " + self.kind]
+        items = self.snapshot()
+        items.sort()
+        for (value, state) in items :
+            self.expose_series(lines, value, state)
+        return lines
+
+    def expose_series(self, lines, value, state):
+        lines.append(self.name + self.labels(value) + " " + format_value(state))
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, value=None, amount=1):
+        self.lock.acquire()
+        try :
+            self.series[value] = self.series.get(value, 0) + amount
+        finally :
+            self.lock.release()
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, amount, value=None):
+        self.lock.acquire()
+        try :
+            self.series[value] = amount
+        finally :
+            self.lock.release()
+
+#
+# Histogram with fixed buckets. The state of a series is a list of the
+# count per bucket (the last one for values above all bounds) followed
+# by the sum of the values.
+#
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, label)
+        self.buckets = tuple(buckets)
+
+    def observe(self, amount, value=None):
+        i = bisect.bisect_left(self.buckets, amount)
+        self.lock.acquire()
+        try :
+            state = self.series.get(value)
+            if (state == None) :
+                state = [0] * (len(self.buckets) + 1) + [0.0]
+                self.series[value] = state
+            state[i] = state[i] + 1
+            state[-1] = state[-1] + amount
+        finally :
+            self.lock.release()
+
+    def copy(self, state):
+        return list(state)
+
+    def expose_series(self, lines, value, state):
+        total = 0
+        for (i, bound) in enumerate(self.buckets + (float("inf"),)) :
+            total = total + state[i]
+            lines.append(self.name + "_bucket" + self.labels(value, "le=\"" + format_value(bound) + "\"") +
+                         " " + str(total))
+        lines.append(self.name + "_sum" + self.labels(value) + " " + format_value(state[-1]))
+        lines.append(self.name + "_count" + self.labels(value) + " " + str(total))
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def text(self):
+        lines = []
+        for metric in self.metrics :
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+    # Writes all metrics to path through a temporary file, so readers
+    # never see a partly written file
+    def write(self, path):
+        tmpname = path + ".tmp"
+        fp = open(tmpname, "w")
+        try :
+            fp.write(self.text())
+        finally :
+            fp.close()
+        os.rename(tmpname, path)
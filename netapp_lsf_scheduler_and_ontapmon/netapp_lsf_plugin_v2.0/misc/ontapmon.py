@@ -27,6 +27,13 @@
 #               HOST = dfm host                                 #
 #               USER = dfm admin or root                        #
 #               PASSWD = dfm password                           #
+#               PORT = dfm ZAPI port (default 8088)             #
+#               KEEPALIVE = yes to reuse DFM connections across #
+#                       calls, filers and cycles (default yes)  #
+#               MAX_IDLE = seconds a pooled DFM connection may  #
+#                       sit unused before it is closed          #
+#               CLIENT = nmsdk (NaElement from NMDKDIR) or      #
+#                       builtin (ontapzapi.py, no NMSDK needed) #
 #               [mon_param]                                     #
 #               INTERVAL = interval of samples                  #
 #               DIRLOC = dir location of where to place xml     #
@@ -35,6 +42,78 @@
 #                        performance monitoring.                #
 #               REFRESH = number of times to run with current   #
 #                       filer list before refreshing list       #
+#               AGGR_BATCH = max aggregates per counter request #
+#                       (1 = one request per aggregate)         #
+#               VOL_PAGE = max volumes per proxied volume list  #
+#                       call (default 1000)                     #
+#               VOL_PAGE_LATENCY = seconds a volume page may    #
+#                       take before the page size is halved     #
+#               TOPOLOGY_REFRESH = seconds between refreshes of #
+#                       the cached aggregate list and IP addrs  #
+#               EVICT_AFTER = passes an aggr, volume or domain  #
+#                       (or refreshes a filer) may be missing   #
+#                       before it is removed                    #
+#               BREAKER_THRESHOLD = failures in a row before a  #
+#                       filer is backed off (default 3)         #
+#               BACKOFF_MAX = max seconds between retries of a  #
+#                       failing filer (default 900)             #
+#               METRICS_FILE = file to write collection metrics #
+#                       to every INTERVAL (Prometheus text)     #
+#               ENGINE = threads (NTHREADS blocking workers) or #
+#                       async (one thread, non-blocking calls)  #
+#               ASYNC_CONNECTIONS = DFM connections used by the #
+#                       async engine (default NTHREADS)         #
+#               ASYNC_CONCURRENCY = max filers collected at the #
+#                       same time by the async engine           #
+#               SNAPSHOT = yes to also write a binary snapshot  #
+#                       <filer>.snap per filer (ontapsnap.py)   #
+#               HISTORY = number of samples of each filer kept  #
+#                       in DIRLOC/history (ontapring.py), 0=off #
+#               SHARDS = number of collector processes the      #
+#                       filers are split across (default 1)     #
+#               INTERVAL_MIN, INTERVAL_MAX = bounds of adaptive #
+#                       per filer intervals (default INTERVAL)  #
+#               DISKBUSY_WATERMARK, LATENCY_WATERMARK = disk    #
+#                       busy (%) and volume latency (ms) at     #
+#                       which a filer is sampled more often     #
+#               CHANGE_WATERMARK = change between samples, as a #
+#                       fraction of the watermark, that counts  #
+#                       as busy too (default 0.25)              #
+#               REQUEST_BUDGET = max ZAPI calls per second for  #
+#                       adaptive intervals, 0 = no limit        #
+#               WRITE_HEARTBEAT = seconds after which output    #
+#                       files are rewritten even if unchanged,  #
+#                       0 = rewrite them every sample (default) #
+#               WRITE_EPSILON = list of metric:epsilon, the     #
+#                       change (absolute, or % of the value last#
+#                       written) that makes output be rewritten #
+#                       (metrics: diskbusy, latency, domain,    #
+#                       availsize, availinodes)                 #
+#               FLEET_INDEX = yes to also keep DIRLOC/fleet.idx #
+#                       with the XML of all filers, for readers #
+#                       that only stat one file (ontapfleet.py) #
+#               NOTIFY_SOCKET = Unix socket on which each filer #
+#                       written is announced (ontapnotify.py),  #
+#                       empty = off                             #
+#               HTTP_PORT = port of the JSON query server on the#
+#                       data last collected (ontaphttp.py),     #
+#                       0 = off                                 #
+#               HTTP_ADDRESS = address it listens on (default   #
+#                       127.0.0.1)                              #
+#               DOMAIN_COUNTERS = domain_busy labels collected  #
+#                       (default kahuna, storage, raid, target, #
+#                       cifs, nwk_legacy), the LSF plugin checks#
+#                       the first 6                             #
+#               CALL_DEADLINE = seconds a ZAPI call may take,   #
+#                       and api:seconds for single APIs, 0 = no #
+#                       limit (default 300)                     #
+#               COLLECTION_DEADLINE = seconds the collection of #
+#                       a filer may take, 0 = no limit (default)#
+#               CAPTURE_FILE = gzip file the raw ZAPI calls are #
+#                       appended to (ontapcapture.py), empty =  #
+#                       off. Replayed with ontapmon.py          #
+#                       <config_file> --replay <capture_file>   #
+#                       [--paced]                               #
 #                                                               #
 # Copyright (c) 2012 NetApp, Inc. All rights reserved.          #
 # Specifications subject to change without notice.              #
@@ -43,13 +122,39 @@
 
 import time
 import signal
+import asyncore
+import collections
 import sys
+import base64
+import httplib
+import select
+import socket
 import xml.dom.minidom
 from xml.dom.minidom import Document
 from ConfigParser import SafeConfigParser
 import os
+import re
 import threading, Queue
+import heapq
+import math
+import array
+import hashlib
+import random
+import shutil
+import tempfile
+import types
 import logging, logging.handlers
+import ontapsnap
+import ontapring
+import ontapmetrics
+import ontapzapi
+import ontapfleet
+import ontapnotify
+import ontaphttp
+import ontapcapture
+
+# Handlers are set up from DIRLOC in main
+logger = logging.getLogger('ontap_monitoring_agent')
 
 #
 # Usage Error Message
@@ -57,12 +162,36 @@ import logging, logging.handlers
 def usage():
     print ("Usage:\n")
     print ("ontapmon.py <config_file>\n")
+    print ("ontapmon.py <config_file> --replay <capture_file> [--paced]\n")
     sys.exit (1)
+
+#
+# Sends the log to logname, replacing the log file used so far
+#
+def set_log_file(logname):
+    for handler in logger.handlers[:] :
+        logger.removeHandler(handler)
+        handler.close()
+    handler = logging.handlers.TimedRotatingFileHandler(logname, when='midnight', interval=1, backupCount=7)
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+
+#
+# Returns an optional parameter from config.ini, or default if it is not
+# set so that existing config files keep working. raw values are taken
+# as they are, without % interpolation.
+#
+def config_get(section, option, default, raw=False):
+    if (parser.has_option(section, option)) :
+        return parser.get(section, option, raw)
+    return default
 #
 # Gets the list of filers being managed by DFM
 # @returns array of hostnames
 #
-def flist_get(server):
+def flist_get():
     # creating a input element
     input_element = NaElement("host-list-info-iter-start")
     xi = NaElement("host-types")
@@ -71,46 +200,46 @@ def flist_get(server):
 
     # invoking the api and capturing the ouput
     try :
-        output = server.invoke_elem(input_element)
-    except:
+        output = yield ZapiCall(input_element)
+    except Exception:
         logger.error("flist_get():Exception getting filer list.", exc_info=1)
-        return -1
+        yield -1
     else:
         if (output.results_status() == "failed") :
             logger.error("flist_get(): Failed " + output.results_reason() )
-            return -1
+            yield -1
 
         # Extracting the record and tag values and printing them
         records = output.child_get_string("records")
         if(int(records) == 0):
             logger.error("flist_get():No datasets to display for host-types" )
-            return -1
+            yield -1
 
         tag = output.child_get_string("tag")
 
         # Iterating through each record
         # Extracting records one at a time
         try:
-            record = server.invoke( "host-list-info-iter-next", "maximum", records, "tag", tag )
-        except:
+            record = yield ZapiCall(zapi_elem("host-list-info-iter-next", "maximum", records, "tag", tag))
+        except Exception:
             logger.error("flist_get():Exception getting filer list.", exc_info=1)
-            return -1
+            yield -1
         else:
             if (record.results_status() == "failed") :
                 logger.error("flist_get(): Failed " + record.results_reason())
-                return -1
+                yield -1
     
             # Navigating to the datasets child element
             if(not record):
                 logger.error ("flist_get(): no records for datasets")
-                return -1
+                yield -1
             else:
                 stat = record.child_get("hosts")
     
             # Navigating to the dataset-info child element
             if(not stat):
                 logger.error("flist_get(): no stat for hosts")
-                return -1
+                yield -1
 
             else:
                 info = stat.children_get()
@@ -127,114 +256,114 @@ def flist_get(server):
 
             # invoking the iter-end zapi
             try :
-                end = server.invoke( "host-list-info-iter-end", "tag", tag )
-            except:
+                end = yield ZapiCall(zapi_elem("host-list-info-iter-end", "tag", tag))
+            except Exception:
                 logger.error("flist_get():Exception getting filer list.", exc_info=1)
-                return -1
+                yield -1
             else:
 
                 if (end.results_status() == "failed") :
                     logger.error("flist_get(): Failed " + end.results_reason())
-                    return -1
-                return(flist)
+                    yield -1
+                yield flist
 #
 # Gets the ip addresses of each filers being managed by DFM
 # @returns array of IP addresses of filers
 #
-def ipaddr_get(server, filer):
+def ipaddr_get(filer):
     # creating a input element
     input_element = NaElement("netif-ip-interface-list-info")
     input_element.child_add_string("hostname", filer)
 
     # invoking the api and capturing the ouput
     try :
-        output = server.invoke_elem(input_element)
-    except:
+        output = yield ZapiCall(input_element)
+    except Exception:
         logger.error("ipaddr_get():Exception getting filer list.", exc_info=1)
-        return -1
+        yield -1
     else:
         if (output.results_status() == "failed") :
             logger.error("ipaddr_get(): Failed " + filer + ":" + output.results_reason())
-            return -1
+            yield -1
 
         interfaces = output.child_get("interfaces")
         if (interfaces == None) :
             logger.error("ipaddr_get():No interfaces found for object:  " + filer +"" )
-            return -1
+            yield -1
 
         netif = interfaces.children_get()
     
         if(netif == None) or (len(netif) == 0):
             logger.error("ipaddr_get():No instances found for object:  " + filer +"" )
-            return -1
+            yield -1
 
         # if there are items in ip addr list, delete it.
-        if (len(filerDataDict[filer].ipAddr) != 0) :
-            del filerDataDict[filer].ipAddr[:]
+        if (len(topology.get(filer).ipAddr) != 0) :
+            del topology.get(filer).ipAddr[:]
 
         for rec in netif :
             iplist = rec.child_get("ip-addresses")
 
             if (iplist == None) :
-                return -1
+                yield -1
             ipaddrs = iplist.children_get()
 
             # There is no provisions to get content of self in NaElement
             # Using the element array of NaElement to get info.
             for rec1 in ipaddrs :
-                filerDataDict[filer].ipAddr.append(rec1.element["content"])
+                topology.get(filer).ipAddr.append(rec1.element["content"])
 
 #
 # Gets the list of aggregates within a filer
 # @return list of aggregates
 #
 
-def aggrlist_get(filer, server) :
+def aggrlist_get(filer) :
     # creating a input element
     input_element = NaElement("aggregate-list-info-iter-start")
     input_element.child_add_string("object-name-or-id", filer)
 
     # invoking the api and capturing the ouput
     try :
-        output = server.invoke_elem(input_element)
-    except:
+        output = yield ZapiCall(input_element)
+    except Exception:
         # Add trace to logger
         logger.error("aggrlist_get():Exception getting aggr list for " + filer, exc_info=1)
-        return -1
+        yield -1
     else:
         if (output.results_status() == "failed") :
             logger.error("aggrlist_get(): Failed " + filer + ":" +  output.results_reason())
-            return -1
+            yield -1
 
         # Extracting the record and tag values and printing them
         records = output.child_get_string("records")
 
         if(int(records) == 0) or (records == None):
             logger.error("aggrlist_get(): No datasets to display for " + filer)
-            return -1
+            yield -1
 
         tag = output.child_get_string("tag")
         
         if (tag == None) :
             logger.error("aggrlist_get():No tag for filer " + filer)
-            return -1
+            yield -1
 
         # Iterating through each record
         # Extracting records one at a time
         try: 
-            record = server.invoke( "aggregate-list-info-iter-next", "maximum", records, "tag", tag )
-        except:
+            record = yield ZapiCall(zapi_elem("aggregate-list-info-iter-next", "maximum", records, "tag", tag))
+        except Exception:
             logger.error("aggrlist_get():Exception getting aggr list for " + filer, exc_info=1)
-            return -1
+            yield -1
         else:
             if (record.results_status() == "failed") :
                 logger.error("aggrlist_get(): Failed " + filer + ":" + record.results_reason())
-                return -1
+                yield -1
     
             # Navigating to the datasets child element
             if (record == None) or (not record):
                 logger.error("aggrlist_get():No records for " + filer)
-                return -1
+                yield -1
 
             else:
                 stat = record.child_get("aggregates")
@@ -242,14 +371,14 @@ def aggrlist_get(filer, server) :
             # Navigating to the dataset-info child element
             if (stat == None) or (not stat):
                 logger.error("aggrlist_get():No stat for " + filer)
-                return -1
+                yield -1
 
             else:
                 info = stat.children_get()
         
             if (info == None) :
                 logger.error("aggrlist_get():No aggregates for " + filer)
-                return -1
+                yield -1
 
             slist = []
             # Iterating through each record
@@ -259,295 +388,306 @@ def aggrlist_get(filer, server) :
                     continue
                 slist.append(aname)
 
+                # Remember the DFM object id of the aggregate so that
+                # batched counter responses can be matched back to it.
+                aid = info.child_get_string("aggregate-id")
+                if (aid != None) :
+                    topology.get(filer).aggrIdDict[aid] = aname.split(':')[-1]
+
             # invoking the iter-end zapi
             try :
-                end = server.invoke( "aggregate-list-info-iter-end", "tag", tag )
-            except:
+                end = yield ZapiCall(zapi_elem("aggregate-list-info-iter-end", "tag", tag))
+            except Exception:
                 logger.error("aggrlist_get():Exception getting aggr list for " + filer, exc_info=1)
-                return -1
+                yield -1
             else :
                 if (end.results_status() == "failed") :
                     logger.error("aggrlist_get(): Failed " + filer + ":" + end.results_reason())
-                    return -1
-                return(slist)
+                    yield -1
+                yield slist
 #
-# Gets the volume specific information directly from filer via api-proxy
+# Records the capacity of a volume already known from its counters.
+# Raises KeyError for a volume that is not.
 #
-def vollist_get(server, filer) :
+def store_vol_capacity(fdata, aggrName, inst_name, asize, ainodes):
+    vol = fdata.aggrDataDict[aggrName].volumeDataDict[inst_name]
+    vol.availSize = asize
+    vol.availInodes = ainodes
 
+# Smallest page size of the volume list, the size it used to be fetched in
+VOL_PAGE_MIN = 10
+
+#
+# Builds an api-proxy request that runs api on filer with the given
+# name/value arguments.
+#
+def proxy_elem(filer, api, *args):
     proxyElem = NaElement("api-proxy")
     proxyElem.child_add_string("target", filer)
     apiRequest = NaElement("request")
-    apiRequest.child_add_string("name", "volume-list-info-iter-start")
-
+    apiRequest.child_add_string("name", api)
+    if (len(args) > 0) :
+        apiargs = NaElement("args")
+        for i in range(0, len(args) - 1, 2) :
+            apiargs.child_add_string(args[i], args[i + 1])
+        apiRequest.child_add(apiargs)
     proxyElem.child_add(apiRequest)
+    return proxyElem
+
+#
+# Gets the volume specific information directly from filer via api-proxy
+#
+# Volumes are fetched in pages of up to the records count returned by
+# iter-start, so a filer normally takes three proxied calls (start, one
+# next, end). The page size of each filer is capped by VOL_PAGE and
+# halved when a page takes longer than VOL_PAGE_LATENCY seconds, then
+# doubled again while pages come back quickly. The counters of the volumes
+# in pending, which aggrperf_collect() could not place, are stored with
+# the aggregate their volume info names.
+#
+def vollist_get(filer, pending) :
+
     try :
-        out = server.invoke_elem(proxyElem)
-    except:
+        out = yield ZapiCall(volstart_request.fill(target=filer))
+    except Exception:
         # Add trace to logger
         logger.error("vollist_get(1): Exception getting vollist info for " + filer, exc_info=1)
-        return -1
+        yield -1
     else:
         if(out.results_status() == 'failed') :
             logger.error("vollist_get(2): " + filer + ":" + out.results_reason() + "\n")
-            return -1
+            yield -1
 
         dfmResponse = out.child_get('response')
 
         if (dfmResponse.child_get_string('status') == 'failed') :
             logger.error("vollist_get(3): " + filer + ":" + dfmResponse.child_get_string("reason") + "\n")
-            return -1
+            yield -1
 
         ontapiResponse = dfmResponse.child_get('results')
 
         if (ontapiResponse.results_status() == 'failed'):
             logger.error("vollist_get(4): " + filer + ":" + ontapiResponse.results_reason() + "\n")
-            return -1
+            yield -1
 
         iter_tag = ontapiResponse.child_get_string('tag')
-        records = ontapiResponse.child_get_string('records')
-
-
-        num_records = 1
-        max_records = 10
-
-        while(int(num_records) != 0):
-            proxyElem = NaElement("api-proxy")
-            proxyElem.child_add_string("target", filer)
-            apiRequest = NaElement("request")
-            apiRequest.child_add_string("name", "volume-list-info-iter-next")
-            apiargs = NaElement("args")
-            apiargs.child_add_string("tag", iter_tag)
-            apiargs.child_add_string("maximum", max_records)
-            apiRequest.child_add(apiargs)
-            proxyElem.child_add(apiRequest)
+        try :
+            remaining = int(ontapiResponse.child_get_string('records'))
+        except (TypeError, ValueError):
+            # Unknown count, page until a page comes back empty
+            remaining = None
+
+        fdata = filerDataDict[filer]
+        if (fdata.volPage == None) :
+            fdata.volPage = vol_page
+        aggrDataDict = fdata.aggrDataDict
+        volAggrDict = topology.get(filer).volAggrDict
+
+        while (remaining == None) or (remaining > 0) :
+            max_records = fdata.volPage
+            if (remaining != None) :
+                max_records = min(remaining, max_records)
+            start = time.time()
             try :
-                out = server.invoke_elem(proxyElem)
-            except:
+                out = yield ZapiCall(volnext_request.fill(target=filer, tag=iter_tag,
+                                                           maximum=str(max_records)))
+            except Exception:
                 logger.error("vollist_get(5):Exception from " + filer, exc_info=1)
-                return -1
+                yield -1
             else: 
                 if(out.results_status() == 'failed') :
                     logger.error("vollist_get(6): " +filer + ":" + out.results_reason() + "\n")
-                    return -1
+                    yield -1
+
+                # Adapt the page size of the filer to the latency of
+                # this page
+                elapsed = time.time() - start
+                if (elapsed > vol_page_latency) :
+                    fdata.volPage = max(max_records / 2, VOL_PAGE_MIN)
+                elif (elapsed < vol_page_latency / 4) and (max_records == fdata.volPage) :
+                    fdata.volPage = min(fdata.volPage * 2, vol_page)
 
                 dfmResponse = out.child_get('response')
 
                 if (dfmResponse.child_get_string('status') == 'failed') :
                     logger.error("vollist_get(7):  " + filer + ":"  + dfmResponse.child_get_string("reason") + "\n")
-                    return -1
+                    yield -1
 
                 ontapiResponse = dfmResponse.child_get('results')
 
                 if (ontapiResponse.results_status() == 'failed'):
                     logger.error("vollist_get(8) " + filer + ":" + ontapiResponse.results_reason() + "\n")
-                    return -1
+                    yield -1
 
                 num_records = ontapiResponse.child_get_int("records")
 
                 if (num_records == None) :
-                    return -1;
-                if(num_records > 0) :
-                    instances_list = ontapiResponse.child_get("volumes")   
-                    instances = instances_list.children_get()
-
-                    for inst in instances:
-                        inst_name = inst.child_get_string("name")
-                        if (inst_name == None) :
-                            logger.error("vollist_get(9): Got NoneType for inst_name for filer " + filer + "\n")
-                            return -1
-                        state = inst.child_get_string("state")
-                        # Only record volumes that are online
-                        if (state != "online") :
-                            continue
-
-                        vtype = inst.child_get_string("type")
-                        ssize = inst.child_get_string("size-available")
-                        fu = inst.child_get_string("files-used")
-                        fT = inst.child_get_string("files-total")
-                        # Sometimes the XML is corrupt so need to check for None
-                        if ( (ssize == None) or (fu == None) or (fT == None) or (vtype == None) ) :
-                            logger.error("vollist_get(10): Got None Type for values for " + inst_name)
-                            return -1
+                    yield -1
+                if (num_records == 0) :
+                    break
+                if (remaining != None) :
+                    remaining = remaining - num_records
+
+                instances = ontapiResponse.child_get("volumes").children_get()
+
+                for inst in instances:
+                    # Pick up the fields of the volume in one pass over
+                    # its children
+                    fields = {}
+                    for field in inst.children_get() :
+                        fields[field.element["name"]] = field.element["content"]
+
+                    inst_name = fields.get("name")
+                    if (inst_name == None) :
+                        logger.error("vollist_get(9): Got NoneType for inst_name for filer " + filer + "\n")
+                        yield -1
+                    # Only record volumes that are online
+                    if (fields.get("state") != "online") :
+                        continue
+
+                    vtype = fields.get("type")
+                    ssize = fields.get("size-available")
+                    fu = fields.get("files-used")
+                    fT = fields.get("files-total")
+                    # Sometimes the XML is corrupt so need to check for None
+                    if ( (ssize == None) or (fu == None) or (fT == None) or (vtype == None) ) :
+                        logger.error("vollist_get(10): Got None Type for values for " + inst_name)
+                        yield -1
+                    if (vtype == "flex") :
+                        aggrName = fields.get("containing-aggregate")
+                        if (aggrName == None) :
+                            yield -1
+                    # For traditional volumes, aggr name is vol name
+                    else :
+                        aggrName = inst_name
+
+                    volAggrDict[inst_name] = aggrName
+                        
+                    try: 
+                        if (inst_name in pending) :
+                            with_filer_lock(filer, place_pending_vol, filer, aggrName, inst_name, pending)
                         # Convert values to int
-                        asize = int(ssize)
-                        filesUsed = int(fu)
-                        filesTotal = int(fT)
-                        if (vtype == "flex") :
-                            aggrName = inst.child_get_string("containing-aggregate")
-                            if (aggrName == None) :
-                                return -1
-                        # For traditional volumes, aggr name is vol name
-                        else :
-                            aggrName = inst_name
-                            
-                        try: 
-                            filerDataDict[filer].aggrDataDict[aggrName].volumeDataDict[inst_name].availSize = asize
-                            filerDataDict[filer].aggrDataDict[aggrName].volumeDataDict[inst_name].availInodes = filesTotal - filesUsed
-                        except:
-                            logger.error("vollist_get(11):Exception in vollist_get: filerDataDict setting of asize and availInodes")
-                            logger.error("looking up: Filer = %s, Aggr = %s, Volume = %s" %(filer, aggrName, inst_name))
-                            logger.error("Filer Keys %s" %(filerDataDict.keys()))
-                            # Check for existence of aggrName and inst_name
-                            # before printing it out.
-                            if (aggrName in filerDataDict[filer].aggrDataDict) :
-                                logger.error("Aggr Keys %s" %(filerDataDict[filer].aggrDataDict.keys()))
-                            if (inst_name in filerDataDict[filer].aggrDataDict[aggrName].volumeDataDict) :
-                                logger.error("Volume Keys %s" %(filerDataDict[filer].aggrDataDict[aggrName].volumeDataDict.keys()))
-                            return -1
-
-        apiRequest.child_add_string("name", "volume-list-info-iter-end")
-        apiargs = NaElement("args")
-        apiargs.child_add_string("tag", iter_tag)
-        apiRequest.child_add(apiargs)
-        proxyElem.child_add(apiRequest)
+                        with_filer_lock(filer, store_vol_capacity, fdata, aggrName, inst_name,
+                                        int(ssize), int(fT) - int(fu))
+                    except Exception:
+                        logger.error("vollist_get(11):Exception in vollist_get: filerDataDict setting of asize and availInodes")
+                        logger.error("looking up: Filer = %s, Aggr = %s, Volume = %s" %(filer, aggrName, inst_name))
+                        logger.error("Filer Keys %s" %(filerDataDict.keys()))
+                        # The cached aggregate list no longer matches
+                        # the filer, so fetch it again next time.
+                        topology.invalidate(filer)
+                        # Check for existence of aggrName and inst_name
+                        # before printing it out.
+                        if (aggrName in aggrDataDict) :
+                            logger.error("Aggr Keys %s" %(aggrDataDict.keys()))
+                            if (inst_name in aggrDataDict[aggrName].volumeDataDict) :
+                                logger.error("Volume Keys %s" %(aggrDataDict[aggrName].volumeDataDict.keys()))
+                        yield -1
+
         try:
-            out = server.invoke_elem(proxyElem)
-        except:
+            out = yield ZapiCall(volend_request.fill(target=filer, tag=iter_tag))
+        except Exception:
             logger.error("vollist_get(12):Exception vollist_get() from " + filer, exc_info=1)
-            return -1
+            yield -1
         else:
             if(out.results_status() == 'failed') :
                 logger.error("vollist_get(13):Exception getting vollist_get():" + filer + ":" + out.results_reason() + "\n")
-                return -1
+                yield -1
             dfmResponse = out.child_get('response')
 
             if (dfmResponse.child_get_string('status') == 'failed') :
                 logger.error("vollist_get(14): " + filer + ":" + dfmResponse.child_get_string("reason") + "\n")
-                return -1
+                yield -1
 
             ontapiResponse = dfmResponse.child_get('results')
             if (ontapiResponse.results_status() == 'failed'):
                 logger.error("vollist_get(15) " + filer + ":" + ontapiResponse.results_reason() + "\n")
-                return -1
-        return 0
+                yield -1
+        yield 0
 
 #
-# Gets the performance counters, domain_busy, for non-exempt domains
-# directly from DFM.
+# Gets the performance counters, domain_busy, for the non-exempt domains
+# of DOMAIN_COUNTERS directly from DFM.
 # @returns array of performance data for domain
 
-def domainperf_get(obj_name, server) :
-    # Create API request
-    perf_in = NaElement("perf-get-counter-data")
-
-    perf_in.child_add_string("number-samples", 1)        
-        
-    instance_info = NaElement("instance-counter-info")
-    counter_info = NaElement("counter-info")
-    instance_info.child_add_string("object-name-or-id", obj_name)
-
-    perf_obj_ctr1 = NaElement("perf-object-counter")
-    perf_obj_ctr1.child_add_string("object-type", "processor")
-    perf_obj_ctr1.child_add_string("counter-name", "domain_busy")
-    perf_obj_ctr1.child_add_string("label-names", "kahuna")
-        
-    perf_obj_ctr3 = NaElement("perf-object-counter")
-    perf_obj_ctr3.child_add_string("object-type", "processor")
-    perf_obj_ctr3.child_add_string("counter-name", "domain_busy")
-    perf_obj_ctr3.child_add_string("label-names", "storage")
-    
-    perf_obj_ctr4 = NaElement("perf-object-counter")
-    perf_obj_ctr4.child_add_string("object-type", "processor")
-    perf_obj_ctr4.child_add_string("counter-name", "domain_busy")
-    perf_obj_ctr4.child_add_string("label-names", "raid")
-        
-    perf_obj_ctr5 = NaElement("perf-object-counter")
-    perf_obj_ctr5.child_add_string("object-type", "processor")
-    perf_obj_ctr5.child_add_string("counter-name", "domain_busy")
-    perf_obj_ctr5.child_add_string("label-names", "target")
-    
-    perf_obj_ctr6 = NaElement("perf-object-counter")
-    perf_obj_ctr6.child_add_string("object-type", "processor")
-    perf_obj_ctr6.child_add_string("counter-name", "domain_busy")
-    perf_obj_ctr6.child_add_string("label-names", "cifs")
-        
-    perf_obj_ctr7 = NaElement("perf-object-counter")
-    perf_obj_ctr7.child_add_string("object-type", "processor")
-    perf_obj_ctr7.child_add_string("counter-name", "domain_busy")
-    perf_obj_ctr7.child_add_string("label-names", "nwk_legacy")
-
-    counter_info.child_add(perf_obj_ctr1)            
-    counter_info.child_add(perf_obj_ctr3)
-    counter_info.child_add(perf_obj_ctr4)
-    counter_info.child_add(perf_obj_ctr5)
-    counter_info.child_add(perf_obj_ctr6)
-    counter_info.child_add(perf_obj_ctr7)
-
-    instance_info.child_add(counter_info)
-    perf_in.child_add(instance_info)
+def domainperf_get(obj_name) :
     try:
-        perf_out = server.invoke_elem(perf_in)
-    except:
+        perf_out = yield ZapiCall(domainperf_request.fill(obj=obj_name))
+    except Exception:
         logger.error("domainperf_get():Exception getting domain counters for " + obj_name, exc_info=1)
-        return -1
+        yield -1
     else:
         if(perf_out.results_status() == "failed") :
             logger.error("domainperf_get(): Failed " + obj_name + ":" + perf_out.results_reason())
-            return -1
+            yield -1
 	
-        return perf_out
+        yield perf_out
 
 #
-# Gets the performance counters, avg_latency and disk_busy, for aggregate
-# directly from DFM.
-# @returns array of performance data for aggregate
-def aggrperf_get(obj_name, server) :
-    # Create API request
-    perf_in = NaElement("perf-get-counter-data")
-    
-    perf_in.child_add_string("number-samples", 1)        
-
-    instance_info = NaElement("instance-counter-info")
-    counter_info = NaElement("counter-info")
-    instance_info.child_add_string("object-name-or-id", obj_name)
-        
-    perf_obj_ctr1 = NaElement("perf-object-counter")
-    perf_obj_ctr1.child_add_string("object-type", "volume")
-    perf_obj_ctr1.child_add_string("counter-name", "avg_latency")
-        
-    perf_obj_ctr2 = NaElement("perf-object-counter")
-    perf_obj_ctr2.child_add_string("object-type", "disk")
-    perf_obj_ctr2.child_add_string("counter-name", "disk_busy")
-
-    counter_info.child_add(perf_obj_ctr1)
-    counter_info.child_add(perf_obj_ctr2)
-    instance_info.child_add(counter_info)
-
-    perf_in.child_add(instance_info)
+# Gets the performance counters, avg_latency and disk_busy, for one or
+# more aggregates directly from DFM. Each aggregate gets its own
+# instance-counter-info entry in a single perf-get-counter-data request.
+# @returns array of performance data for the aggregates
+def aggrperf_get(obj_names) :
+    instances = [aggrperf_instance.text({"obj": obj_name}) for obj_name in obj_names]
     try: 
-        perf_out = server.invoke_elem(perf_in)
-    except:
-        logger.error("aggrperf_get():Exception getting aggregate counters for " + obj_name, exc_info=1)
-        return -1
+        perf_out = yield ZapiCall(aggrperf_request.fill(instances=instances))
+    except Exception:
+        logger.error("aggrperf_get():Exception getting aggregate counters for " + ",".join(obj_names), exc_info=1)
+        yield -1
     else :
         if(perf_out.results_status() == "failed") :
-            logger.error("aggrperf_get(): Failed " + obj_name + ":" + perf_out.results_reason())
-            return -1
+            logger.error("aggrperf_get(): Failed " + ",".join(obj_names) + ":" + perf_out.results_reason())
+            yield -1
+
+        yield perf_out
 
-        return perf_out
+#
+# Works out which aggregate of a batched aggrperf_get() request an
+# instance belongs to. Disk instances carry the DFM object id of the
+# aggregate that was asked for, volume instances are looked up in the
+# volume to aggregate mapping of the topology cache.
+# @return aggregate name, or None if the instance cannot be placed
+#
+def aggr_of_instance(fname, anames, inst_name, obj_id) :
+    topo = topology.get(fname)
+    aname = topo.aggrIdDict.get(obj_id)
+    if (aname in anames) :
+        return aname
+
+    aname = topo.volAggrDict.get(inst_name)
+    if (aname in anames) :
+        return aname
+    return None
 
 
 #
-# Extracts the performance counter data from the instances
-# @return 0 for success, -1 for error
+# Extracts the performance counter data from the instances returned by
+# aggrperf_get() for the aggregates in objnames. When several aggregates
+# were asked for in one request, each instance is demultiplexed back to
+# its aggregate. Volumes that cannot be placed yet are added to pending,
+# by name, as (aggregate names, counters) for vollist_get() to place.
+# @return 0 for success, -1 for error, -2 if the batched response could
+#         not be split by aggregate
 #
-def extract_aggr_counter_data(perf_out, objname) :
+def extract_aggr_counter_data(perf_out, objnames, pending) :
 
 
-    # Get filer name and aggregate name
-    str_arr = objname.split(':')
-    fname = str_arr[0]
-    aname = str_arr[1]
+    # Get filer name and aggregate names
+    fname = objnames[0].split(':')[0]
+    anames = [o.split(':')[1] for o in objnames]
+    objname = ",".join(objnames)
 
     instance = perf_out.child_get("perf-instances")
 
-    # Allocate space for aggregate in dictionary
-    if (aname not in filerDataDict[fname].aggrDataDict) :
-        filerDataDict[fname].aggrDataDict[aname] = AggrData()
+    for aname in anames :
+        # Allocate space for aggregate in dictionary
+        if (aname not in filerDataDict[fname].aggrDataDict) :
+            filerDataDict[fname].aggrDataDict[name_key(aname)] = AggrData()
 
-    # Initialize maxdisk busy value
-    filerDataDict[fname].aggrDataDict[aname].maxdiskb = 0.0
+        # Initialize maxdisk busy value
+        filerDataDict[fname].aggrDataDict[aname].maxdiskb = 0.0
+        filerDataDict[fname].aggrDataDict[aname].seen = filerDataDict[fname].generation
 
     if (instance == None) :
             logger.error(":No instance found for object:  " + objname +"" )
@@ -575,32 +715,66 @@ def extract_aggr_counter_data(perf_out, objname) :
             logger.error("extract_aggr_counter_data():No counter data found for object:  " + objname +"" )
             return -1
 
-        for rec1 in perf_cnt_data :
-            counter_name = rec1.child_get_string("counter-name")
-            counter_str = rec1.child_get_string("counter-data")
-            if (counter_str == None) or (len(counter_str) == 0) :
-                logger.error("extract_aggr_counter_data():No records found for counter-name :  " + objname +"" )
-                
+        if (len(anames) == 1) :
+            aname = anames[0]
+        else :
+            aname = aggr_of_instance(fname, anames, inst_name, obj_id)
+            if (aname == None) :
+                # A disk that cannot be placed means DFM does not tag disk
+                # instances with the aggregate, so stop batching this filer.
+                for rec1 in perf_cnt_data :
+                    if (rec1.child_get_string("counter-name") == "disk_busy") :
+                        logger.info("extract_aggr_counter_data(): unable to place disk " + str(inst_name) + ", not batching " + fname)
+                        filerDataDict[fname].aggrBatchOk = False
+                        return -2
+                # A volume not seen before, as on the first collection or
+                # after volumes are created, is placed once vollist_get()
+                # has learnt its aggregate
+                pending[inst_name] = (anames, perf_cnt_data)
                 continue
-                        
-            counter_arr = counter_str.split (',')
 
-            if(counter_name == "avg_latency") :
-                for time_val in counter_arr :
-                    time_val_arr = [float(s) for s in time_val.split(':')]
-                    if (inst_name not in filerDataDict[fname].aggrDataDict[aname].volumeDataDict) :
-                        filerDataDict[fname].aggrDataDict[aname].volumeDataDict[inst_name] = VolumeData()
+        store_aggr_counters(fname, aname, inst_name, perf_cnt_data, objname)
+    return 0
+
+#
+# Stores the counters of an instance of aggregate aname
+#
+def store_aggr_counters(fname, aname, inst_name, perf_cnt_data, objname) :
+    for rec1 in perf_cnt_data :
+        counter_name = rec1.child_get_string("counter-name")
+        counter_str = rec1.child_get_string("counter-data")
+        if (counter_str == None) or (len(counter_str) == 0) :
+            logger.error("extract_aggr_counter_data():No records found for counter-name :  " + objname +"" )
+            
+            continue
+                    
+        counter_arr = counter_str.split (',')
+
+        if(counter_name == "avg_latency") :
+            for time_val in counter_arr :
+                time_val_arr = [float(s) for s in time_val.split(':')]
+                if (inst_name not in filerDataDict[fname].aggrDataDict[aname].volumeDataDict) :
+                    filerDataDict[fname].aggrDataDict[aname].volumeDataDict[name_key(inst_name)] = VolumeData()
 		     # Avglatency is returned in microseconds from DFM.  
 		     # Want values to be in milliseconds
-                    filerDataDict[fname].aggrDataDict[aname].volumeDataDict[inst_name].avglatency = time_val_arr[1]/1000.0
-            elif(counter_name == "disk_busy") :
-                for time_val in counter_arr :
-                    time_val_arr = [float(s) for s in time_val.split(':')]
-                    
-                    if (time_val_arr[1] > filerDataDict[fname].aggrDataDict[aname].maxdiskb):
-                        filerDataDict[fname].aggrDataDict[aname].maxdiskb = time_val_arr[1]
-	
-    return 0
+                filerDataDict[fname].aggrDataDict[aname].volumeDataDict[inst_name].avglatency = time_val_arr[1]/1000.0
+                filerDataDict[fname].aggrDataDict[aname].volumeDataDict[inst_name].seen = filerDataDict[fname].generation
+        elif(counter_name == "disk_busy") :
+            for time_val in counter_arr :
+                time_val_arr = [float(s) for s in time_val.split(':')]
+                
+                if (time_val_arr[1] > filerDataDict[fname].aggrDataDict[aname].maxdiskb):
+                    filerDataDict[fname].aggrDataDict[aname].maxdiskb = time_val_arr[1]
+
+#
+# Stores the counters of a volume that extract_aggr_counter_data() put in
+# pending, now that vollist_get() has found its aggregate aname
+#
+def place_pending_vol(fname, aname, inst_name, pending) :
+    (anames, perf_cnt_data) = pending.pop(inst_name)
+    if (aname in anames) :
+        store_aggr_counters(fname, aname, inst_name, perf_cnt_data, fname + ":" + aname)
+
 #
 # Extracts the domain performance counter data from the instances
 # @returns 0 for sucess, -1 for error
@@ -642,7 +816,8 @@ def extract_domain_counter_data(perf_out, objname) :
             if (lname == None) :
                 return -1
             if (lname not in filerDataDict[objname].domainDataDict) :
-                filerDataDict[objname].domainDataDict[lname] = DomainData()
+                filerDataDict[objname].domainDataDict[name_key(lname)] = DomainData()
+            filerDataDict[objname].domainDataDict[lname].seen = filerDataDict[objname].generation
 
             if (counter_str == None) or (len(counter_str) == 0) :
                 logger.error("extract_domain_counter_data():No records found for counter-name :  " + objname +"" )
@@ -657,43 +832,198 @@ def extract_domain_counter_data(perf_out, objname) :
 
     return 0
 #
-# Collects aggregate and domain counters and outputs to XML document
+# Fetches the aggregate list and IP addresses of a filer into the
+# topology cache. Called from the worker threads when the cached entry
+# is missing, older than TOPOLOGY_REFRESH or has been invalidated.
+# @return 0 for success, -1 for error
 #
-def perf_mon (filer, server) :
-    
-    # Get list of aggregates for specific filer
-    alist = aggrlist_get(filer, server)
+def topology_refresh(filer) :
+    topo = topology.get(filer)
+    topo.aggrIdDict.clear()
+
+    alist = yield aggrlist_get(filer)
     if (alist == -1) :
-        return -1
+        yield -1
 
-    # Traverse thru list of aggregates to get aggr counter information
-    # if error return -1
-    for a in alist :
+    res = yield ipaddr_get(filer)
+    if (res == -1) :
+        logger.error("topology_refresh(): ipaddr_get() unable to get ip for filer " + filer)
+
+    topo.aggrList = alist
+    topo.refreshed = time.time()
+    yield 0
 
-        perf_out = aggrperf_get(a, server)
+#
+# Collects the counters for the aggregates in alist, putting up to
+# AGGR_BATCH aggregates in each perf-get-counter-data request so the
+# number of requests does not grow with the number of aggregates. A batch
+# whose disks cannot be split by aggregate is asked for again one
+# aggregate at a time. Volumes not mapped yet are added to pending.
+# @return 0 for success, -1 for error
+#
+def aggrperf_collect(filer, alist, pending) :
+    if (filerDataDict[filer].aggrBatchOk) :
+        batch_size = max(aggr_batch, 1)
+    else :
+        batch_size = 1
+
+    for i in range(0, len(alist), batch_size) :
+        batch = alist[i:i + batch_size]
+
+        perf_out = yield aggrperf_get(batch)
         if (perf_out == -1) :
-            return -1
+            yield -1
+
+        held = set(pending)
+        res = with_filer_lock(filer, extract_aggr_counter_data, perf_out, batch, pending)
+        if (res == -2) :
+            # Volumes held back from this batch are fetched again with
+            # their aggregate
+            for v in set(pending) - held :
+                del pending[v]
+            for a in batch :
+                perf_out = yield aggrperf_get([a])
+                if (perf_out == -1) :
+                    yield -1
+
+                res = with_filer_lock(filer, extract_aggr_counter_data, perf_out, [a], pending)
+                if (res == -1) :
+                    yield -1
+        elif (res == -1) :
+            yield -1
+    yield 0
+
+def next_generation(fdata):
+    fdata.generation = fdata.generation + 1
+
+#
+# Drops the aggregates, volumes and domains of a filer that have not been
+# seen by its last EVICT_AFTER collections, so that deleted volumes are
+# no longer written out.
+#
+def evict_stale(f):
+    fdata = filerDataDict[f]
+    oldest = fdata.generation - evict_after
+    volAggrDict = topology.get(f).volAggrDict
+
+    for a in fdata.aggrDataDict.keys() :
+        aggr = fdata.aggrDataDict[a]
+        stale = [v for v in aggr.volumeDataDict if (aggr.volumeDataDict[v].seen <= oldest)]
+        if (aggr.seen <= oldest) :
+            stale = aggr.volumeDataDict.keys()
+            logger.info("evict_stale(): removing aggregate " + a + " of " + f)
+            del fdata.aggrDataDict[a]
+        for v in stale :
+            logger.info("evict_stale(): removing volume " + v + " of " + f)
+            aggr.volumeDataDict.pop(v, None)
+            # Keep the mapping of a volume that moved to another aggregate
+            if (volAggrDict.get(v) == a) :
+                del volAggrDict[v]
+
+    for d in fdata.domainDataDict.keys() :
+        if (fdata.domainDataDict[d].seen <= oldest) :
+            logger.info("evict_stale(): removing domain " + d + " of " + f)
+            del fdata.domainDataDict[d]
+
+#
+# @return (highest disk busy of the aggregates, highest volume latency)
+# of the data of a filer, used to adapt its interval
+#
+def filer_load(fdata):
+    diskb = 0.0
+    latency = 0.0
+    for aggr in fdata.aggrDataDict.itervalues() :
+        diskb = max(diskb, aggr.maxdiskb)
+        for vol in aggr.volumeDataDict.itervalues() :
+            latency = max(latency, vol.avglatency)
+    return (diskb, latency)
+
+#
+# Removes everything kept for a filer that DFM no longer manages: its
+# data, topology and history and its output files.
+#
+def evict_filer(f):
+    logger.info("evict_filer(): " + f + " is no longer managed by DFM, removing its data and files")
+    forget_filer(f)
+    for fname in (dirloc + "/" + f + ".xml", dirloc + "/" + f + ".snap", dirloc + "/history/" + f + ".ring") :
+        try :
+            os.remove(fname)
+        except OSError:
+            pass
+
+#
+# Drops the data kept in memory for a filer, e.g. one that another shard
+# collects now and whose files that shard keeps writing.
+#
+def forget_filer(f):
+    filerDataDict.pop(f, None)
+    topology.remove(f)
+    stats.forget(f)
+    ring = rings.pop(f, None)
+    if (ring != None) :
+        ring.close()
+    if (published != None) :
+        published.pop(f, None)
+
+#
+# Collects aggregate and domain counters and outputs to XML document
+#
+def perf_mon (filer) :
+    
+    # Entries updated by this pass are marked with its generation
+    with_filer_lock(filer, next_generation, filerDataDict[filer])
 
-        res = extract_aggr_counter_data(perf_out,a)
+    # Get list of aggregates for specific filer from the topology cache,
+    # refreshing it first if it is due.
+    if (topology.stale(filer)) :
+        res = yield topology_refresh(filer)
         if (res == -1) :
-            return -1
+            yield -1
+    alist = topology.get(filer).aggrList
+
+    # Traverse thru list of aggregates to get aggr counter information
+    # if error return -1
+    pending = {}
+    res = yield aggrperf_collect(filer, alist, pending)
+    if (res == -1) :
+        yield -1
 
     # Get domain counters separately, would only need it once.
     # If error, return -1
-    perf_out = domainperf_get(filer, server)
+    perf_out = yield domainperf_get(filer)
     if (perf_out == -1) :
-        return -1
+        yield -1
 
-    res = extract_domain_counter_data(perf_out, filer)
+    res = with_filer_lock(filer, extract_domain_counter_data, perf_out, filer)
     if (res == -1) :
-        return -1
+        yield -1
 
-    res = vollist_get(server, filer)
+    res = yield vollist_get(filer, pending)
     if (res == -1) :
-        return -1
+        yield -1
     
-    printToXML(filer)
-    return 0
+    with_filer_lock(filer, evict_stale, filer)
+    if (published != None) :
+        publish_filer(filer)
+    written = output_due(filer)
+    if (written != None) :
+        if (printToXML(filer) != -1) :
+            filerDataDict[filer].written = written
+            if (fleet_writer != None) :
+                fleet_writer.mark(filer)
+            if (notifier != None) :
+                notify(ontapnotify.UPDATE, filer, filerDataDict[filer].generation)
+            # The snapshot never gets ahead of the XML file
+            if (snapshot) :
+                printToSnapshot(filer)
+            stats.outputs.inc("written")
+        else :
+            stats.outputs.inc("failed")
+    else :
+        stats.outputs.inc("suppressed")
+    if (history > 0) :
+        record_history(filer)
+    yield 0
 
 #
 # Used only for debugging purposes
@@ -729,9 +1059,11 @@ def to_pretty_xml(xml_doc):
 
 
 #
-# Creates XML document based on data collected.
+# Builds the minidom document of a filer that printToXML() used to write
+# through to_pretty_xml(). Kept as the reference for the streaming
+# writer (see ontapmon_bench.py).
 #
-def printToXML(f):
+def filer_doc(f):
 
     # Set up xml document
     doc = Document()
@@ -749,7 +1081,7 @@ def printToXML(f):
     # Print accordingly for ipaddresses
     ipstag = doc.createElement("ipaddresses")
             
-    for ip in filerDataDict[f].ipAddr :
+    for ip in topology.get(f).ipAddr :
         intag = doc.createElement("ipaddress")
         intag.appendChild(doc.createTextNode(ip))
         ipstag.appendChild(intag)
@@ -806,193 +1138,2466 @@ def printToXML(f):
                    
     pxml.appendChild(dstag)
 
+    return doc
+
+#
+# Escapes text data the same way minidom does.
+#
+def xml_escape(data):
+    return data.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+#
+# Writes the XML of a filer straight from filerDataDict to fp. The output
+# is byte for byte what to_pretty_xml(filer_doc(f)) gives, without
+# building the document in memory first.
+#
+def write_filer_xml(fp, f):
+    fdata = filerDataDict[f]
+    w = fp.write
+
+    w('<?xml version="1.0" ?>\n<performance>\n')
+    w("  <filer>" + xml_escape(f) + "</filer>\n")
+    w("  <lastUpdated>" + xml_escape(time.asctime()) + "</lastUpdated>\n")
+
+    ipaddrs = topology.get(f).ipAddr
+    if (len(ipaddrs) == 0) :
+        w("  <ipaddresses/>\n")
+    else :
+        w("  <ipaddresses>\n")
+        for ip in ipaddrs :
+            w("    <ipaddress>" + xml_escape(ip) + "</ipaddress>\n")
+        w("  </ipaddresses>\n")
+
+    if (len(fdata.aggrDataDict) == 0) :
+        w("  <aggregates/>\n")
+    else :
+        w("  <aggregates>\n")
+        for a in fdata.aggrDataDict :
+            aggr = fdata.aggrDataDict[a]
+            w("    <aggr>\n      <name>" + xml_escape(a) + "</name>\n")
+            w("      <maxdiskb>%0.5f</maxdiskb>\n" %(aggr.maxdiskb))
+            if (len(aggr.volumeDataDict) == 0) :
+                w("      <volumes/>\n")
+            else :
+                w("      <volumes>\n")
+                for v in aggr.volumeDataDict :
+                    vol = aggr.volumeDataDict[v]
+                    w("        <volume>\n          <name>" + xml_escape(v) + "</name>\n" +
+                      "          <avglatency>%0.5f</avglatency>\n" %(vol.avglatency) +
+                      "          <availsize>%d</availsize>\n" %(vol.availSize) +
+                      "          <availinodes>%d</availinodes>\n" %(vol.availInodes) +
+                      "        </volume>\n")
+                w("      </volumes>\n")
+            w("    </aggr>\n")
+        w("  </aggregates>\n")
+
+    if (len(fdata.domainDataDict) == 0) :
+        w("  <domains/>\n")
+    else :
+        w("  <domains>\n")
+        for d in fdata.domainDataDict :
+            w("    <domain>\n      <name>" + xml_escape(d) + "</name>\n")
+            w("      <value>%0.5f</value>\n    </domain>\n" %(fdata.domainDataDict[d].dvalue))
+        w("  </domains>\n")
 
+    w("</performance>\n")
 
-    # Open file to write xml data to
-    # There should be one file per filer created
+#
+# Creates XML file based on data collected. There is one file per filer,
+# written to a temporary file first and renamed over the old one so that
+# readers never see a partly written file.
+#
+def printToXML(f):
     fname = dirloc + "/" + f + ".xml"
+    tmpname = fname + ".tmp"
     try :
-        fp = open(fname, "w")
-        fp.write(to_pretty_xml(doc))
+        fp = open(tmpname, "w")
+        try :
+            with_filer_lock(f, write_filer_xml, fp, f)
+        finally :
+            fp.close()
+        os.rename(tmpname, fname)
     except:
-        logger.error("Error in opening file " + fname, exc_info=1)
+        logger.error("Error in writing file " + fname, exc_info=1)
+        try :
+            os.remove(tmpname)
+        except OSError:
+            pass
         return -1
-    else:
-        fp.close()
+
+# Metrics of the output files, with the WRITE_EPSILON they get by default
+OUTPUT_EPSILONS = {'diskbusy': (1.0, 0.0), 'latency': (0.5, 0.0), 'domain': (1.0, 0.0),
+                   'availsize': (0.0, 0.01), 'availinodes': (0.0, 0.01)}
+
+#
+# Parses WRITE_EPSILON, a comma separated list of metric:epsilon where
+# the epsilon is absolute, or relative to the value last written if it
+# ends with %. Metrics not in the list keep their default.
+# @return {metric: (absolute, relative)}, or -1 if spec is invalid
+#
+def parse_epsilons(spec):
+    epsilons = dict(OUTPUT_EPSILONS)
+    for item in spec.split(",") :
+        if (item.strip() == "") :
+            continue
+        try :
+            (metric, value) = [part.strip() for part in item.split(":")]
+            if (metric not in OUTPUT_EPSILONS) :
+                raise ValueError("unknown metric " + metric)
+            if (value.endswith("%")) :
+                epsilons[metric] = (0.0, float(value[:-1]) / 100)
+            else :
+                epsilons[metric] = (float(value), 0.0)
+        except ValueError, e:
+            logger.error("parse_epsilons(): invalid WRITE_EPSILON entry " + item + ": " + str(e))
+            return -1
+    return epsilons
+
+#
+# @return (signature, values) of what the output files of a filer hold,
+# where values has an array of each metric in the order they are written
+# and signature is a hash of the aggregate, volume and domain names and
+# IP addresses, so that any of them coming or going changes it
+#
+def output_values(f):
+    fdata = filerDataDict[f]
+    names = list(topology.get(f).ipAddr)
+    values = dict([(metric, array.array('d')) for metric in OUTPUT_EPSILONS])
+    for a in fdata.aggrDataDict :
+        aggr = fdata.aggrDataDict[a]
+        names.append(a)
+        values['diskbusy'].append(aggr.maxdiskb)
+        for v in aggr.volumeDataDict :
+            vol = aggr.volumeDataDict[v]
+            names.append(v)
+            values['latency'].append(vol.avglatency)
+            values['availsize'].append(vol.availSize)
+            values['availinodes'].append(vol.availInodes)
+    for d in fdata.domainDataDict :
+        names.append(d)
+        values['domain'].append(fdata.domainDataDict[d].dvalue)
+    return (hash(tuple(names)), values)
+
+#
+# @return True if a value moved past its WRITE_EPSILON from old to new
+#
+def output_moved(old, new):
+    for metric in new :
+        (absolute, relative) = write_epsilons[metric]
+        for (before, after) in zip(old[metric], new[metric]) :
+            if (abs(after - before) > max(absolute, relative * abs(before))) :
+                return True
+    return False
+
+#
+# Decides whether the output files of a filer are written after a
+# collection. With WRITE_HEARTBEAT > 0 they are only rewritten when a
+# value moved past its epsilon since the last write, names came or went,
+# or the last write is WRITE_HEARTBEAT seconds old, so that readers that
+# look at the modification time (the hot job detector) skip the rest.
+# @return the written state to keep once the files are written, or None
+# to leave them alone
+#
+def output_due(f):
+    now = time.time()
+    if (write_heartbeat <= 0) :
+        return (now, None, None)
+    (signature, values) = with_filer_lock(f, output_values, f)
+    written = filerDataDict[f].written
+    if (written != None) and (now - written[0] < write_heartbeat) and (written[1] == signature) and \
+       (not output_moved(written[2], values)) :
+        return None
+    return (now, signature, values)
+
+#
+# @return (aggrs, domains) of a filer as ontapsnap.write_snapshot() takes
+# them
+#
+def snapshot_records(f):
+    fdata = filerDataDict[f]
+    aggrs = []
+    for a in fdata.aggrDataDict :
+        aggr = fdata.aggrDataDict[a]
+        vols = []
+        for v in aggr.volumeDataDict :
+            vol = aggr.volumeDataDict[v]
+            vols.append((v, vol.avglatency, vol.availSize, vol.availInodes))
+        aggrs.append((a, aggr.maxdiskb, vols))
+    domains = [(d, fdata.domainDataDict[d].dvalue) for d in fdata.domainDataDict]
+    return (aggrs, domains)
+
+#
+# Publishes the data just collected for a filer to the query server (see
+# ontaphttp.py). Each collection publishes a new tuple in place of the
+# last one, so readers use it without taking the filer lock.
+#
+def publish_filer(f):
+    (aggrs, domains) = with_filer_lock(f, snapshot_records, f)
+    published[f] = (time.time(), filerDataDict[f].generation, tuple(topology.get(f).ipAddr), aggrs, domains)
+
+#
+# Writes the binary snapshot of a filer (see ontapsnap.py) next to its
+# XML file, through a temporary file like printToXML().
+#
+def printToSnapshot(f):
+    (aggrs, domains) = with_filer_lock(f, snapshot_records, f)
+
+    fname = dirloc + "/" + f + ".snap"
+    tmpname = fname + ".tmp"
+    try :
+        fp = open(tmpname, "wb")
+        try :
+            ontapsnap.write_snapshot(fp, f, time.time(), topology.get(f).ipAddr, aggrs, domains)
+        finally :
+            fp.close()
+        os.rename(tmpname, fname)
+    except:
+        logger.error("Error in writing file " + fname, exc_info=1)
+        try :
+            os.remove(tmpname)
+        except OSError:
+            pass
+        return -1
+
+#
+# @return the series values of a filer for its ring buffer
+#
+def history_values(f):
+    fdata = filerDataDict[f]
+    values = {}
+    for a in fdata.aggrDataDict :
+        aggr = fdata.aggrDataDict[a]
+        values["aggr:" + a] = aggr.maxdiskb
+        for v in aggr.volumeDataDict :
+            values["vol:" + v] = aggr.volumeDataDict[v].avglatency
+    for d in fdata.domainDataDict :
+        values["domain:" + d] = fdata.domainDataDict[d].dvalue
+    return values
+
+#
+# Appends the counters just collected for a filer to its ring buffer in
+# DIRLOC/history (see ontapring.py), which keeps the last HISTORY samples.
+#
+def record_history(f):
+    values = with_filer_lock(f, history_values, f)
+    try :
+        ring = rings.get(f)
+        if (ring == None) :
+            ring = rings.setdefault(f, ontapring.RingBuffer(dirloc + "/history/" + f + ".ring",
+                                                            history, len(values) * 2))
+        ring.append(time.time(), values)
+    except:
+        logger.error("Error in recording history of " + f, exc_info=1)
+        rings.pop(f, None)
+        return -1
+
+#
+# Writes a new fleet index (see ontapfleet.py) if a filer was rewritten,
+# added or removed since the last one
+#
+def update_fleet_index():
+    generation = fleet_writer.generation
+    try :
+        if (fleet_writer.update(filerDataDict.keys(), lambda f: dirloc + "/" + f + ".xml") == generation) :
+            return 0
+    except:
+        logger.error("Error in writing fleet index " + fleet_writer.path, exc_info=1)
+        return -1
+    if (notifier != None) :
+        notify(ontapnotify.INDEX, fleet_writer.generation)
+
+#
+# Tells the subscribers of NOTIFY_SOCKET about new data (see
+# ontapnotify.py). Subscribers that do not keep up are dropped rather
+# than waited for.
+#
+def notify(kind, *args):
+    dropped = notifier.publish(kind, *args)
+    if (dropped > 0) :
+        logger.warning("notify(): disconnected %d subscriber(s) of %s that fell behind or went away"
+                       %(dropped, notifier.path))
+        stats.notifyDropped.inc(amount=dropped)
 
 #
 # Signal handler for SIGTERM
 #
 def signal_handler_term(signal, frame) :
     print("Caught SIGTERM signal")
+    stop_workers()
+    if (capture != None) :
+        capture.close()
     sys.exit(0)
 
+# Seconds SIGTERM waits for the workers to finish the filers they collect
+STOP_WAIT = 10
+
+#
+# Stops the worker threads, letting them finish the filers they are
+# collecting for up to STOP_WAIT seconds, so that none is still running
+# while the interpreter shuts down
+#
+def stop_workers():
+    for worker in workers :
+        worker.workq.put(None)
+    end = time.time() + STOP_WAIT
+    for worker in workers :
+        worker.join(max(end - time.time(), 0))
+
 #
-# Worker Thread definition. As long as there are items in the queue.
+# Worker Thread definition. Runs for the life of the process, taking
+# (filer, due) items off workq and reporting (err, filer) on resultq,
+# until it takes None off workq.
+# A filer that waited on workq past its next slot is reported as
+# skipped (1) without being collected, so that a backlog does not turn
+# into a burst of stale samples.
 #
 class WorkerThread(threading.Thread):
-    def __init__(self, workq, resultq, dfm_hostname, username, password):
+    def __init__(self, workq, resultq, pool, interval):
         super(WorkerThread, self).__init__()
+        self.daemon = True
         self.workq = workq
         self.resultq = resultq
-        self.dfm_hostname = dfm_hostname
-        self.username = username
-        self.password = password
+        self.pool = pool
+        self.interval = interval
 
     def run(self):
-        # Run this thread as long as the work queue is not empty.  
-        # If empty, break out of thread
         while True :
+            item = self.workq.get()
+            if (item == None) :
+                return
+            (filer, due) = item
+
+            start = time.time()
+            if (start - due > self.interval) :
+                logger.warning("WorkerThread: skipping stale sample of " + filer + ", all workers were busy")
+                stats.collection(filer, None, 1)
+                self.resultq.put((1, filer))
+                continue
+
+            # Borrow a DFM connection from the pool for this filer and
+            # hand it back afterwards so the session stays open for the
+            # next filer or cycle.
+            server = self.pool.get()
             try:
-                filer = self.workq.get(True, 0.05)
-                # Construct a new NaServer object for each call to perf_mon()
-                # to avoid threading issues in NaServer.parse_xml().
-                server = construct_server(self.dfm_hostname, self.username, self.password)
-                err = perf_mon(filer, server)
-                self.resultq.put((err, filer))
-            except Queue.Empty:
-                break;
+                err = zapi_run(perf_mon(filer), server, filer)
+            except:
+                logger.error("WorkerThread: unexpected error collecting " + filer, exc_info=1)
+                err = -1
+            self.pool.put(server)
+            stats.collection(filer, time.time() - start, err)
+            if (capture != None) :
+                capture.collection(filer, start, time.time() - start, err)
+            self.resultq.put((err, filer))
+
+#
+# Fetches the filer list from DFM in the background whenever request()
+# is called, and reports it on resultq as (FLIST_DONE, flist) where
+# flist is -1 if it could not be fetched or is empty.
+#
+FLIST_DONE = "flist"
+
+class RefreshThread(threading.Thread):
+    def __init__(self, server, resultq):
+        super(RefreshThread, self).__init__()
+        self.daemon = True
+        self.server = server
+        self.resultq = resultq
+        self.requests = Queue.Queue()
+
+    def request(self):
+        self.requests.put(None)
+
+    # Filers missing from the list are gone from DFM
+    def in_fleet(self, filer):
+        return False
+
+    def run(self):
+        while True :
+            self.requests.get()
+            try :
+                flist = zapi_run(flist_get(), self.server)
+            except:
+                logger.error("RefreshThread: unexpected error getting filer list", exc_info=1)
+                flist = -1
+            if (flist == None) or (flist == -1) or (len(flist) == 0) :
+                flist = -1
+            self.resultq.put((FLIST_DONE, flist))
+
+#
+# Sharded collection (SHARDS > 1). The main process becomes a coordinator
+# that fetches the filer list and forks SHARDS collector processes, each
+# running the normal collection loop with its own workers, log file and
+# metrics file. On every refresh the coordinator sends the whole list and
+# the shards that are running down a pipe to each shard, and each shard
+# keeps the filers that rendezvous hashing gives it. A filer therefore
+# stays on the same shard across refreshes, only the filers of a shard
+# that stops or comes back move, and they move to the shards that
+# rank them next.
+#
+
+#
+# @return the shard out of shards that collects filer, the one with the
+# highest hash of its number and the filer name
+#
+def shard_of(filer, shards):
+    best = None
+    bestScore = None
+    for i in shards :
+        score = hashlib.md5("%d:%s" %(i, filer)).digest()
+        if (bestScore == None) or (score > bestScore) :
+            best = i
+            bestScore = score
+    return best
+
+#
+# Receives the filer lists sent by the coordinator to a shard and
+# reports the filers of the shard on resultq as (FLIST_DONE, flist),
+# like RefreshThread does for a single process.
+#
+class ShardFeed(threading.Thread):
+    def __init__(self, fd, shard, resultq):
+        super(ShardFeed, self).__init__()
+        self.daemon = True
+        self.fp = os.fdopen(fd)
+        self.shard = shard
+        self.resultq = resultq
+        self.fleet = set()
+
+    # Lists are sent by the coordinator, not asked for
+    def request(self):
+        pass
+
+    def in_fleet(self, filer):
+        return (filer in self.fleet)
+
+    # Each line is the running shards, comma separated, followed by the
+    # filer list, separated by spaces
+    def run(self):
+        while True :
+            line = self.fp.readline()
+            if (line == "") :
+                # The coordinator is gone, stop the shard with it
+                logger.error("ShardFeed: lost the coordinator, exiting")
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+            fields = line.split()
+            shards = [int(i) for i in fields[0].split(",")]
+            fleet = fields[1:]
+            self.fleet = set(fleet)
+            self.resultq.put((FLIST_DONE, [f for f in fleet if shard_of(f, shards) == self.shard]))
+
+class ShardCoordinator(object):
+    def __init__(self, nshards, server, interval, refresh, backoff_max):
+        self.nshards = nshards
+        self.server = server
+        self.interval = interval
+        self.refresh = refresh
+        self.backoff_max = backoff_max
+        self.pid = os.getpid()
+        # pid, pipe and start time of the running shards
+        self.pids = {}
+        self.pipes = {}
+        self.started = {}
+        # Time of the next restart and restart delay of stopped shards
+        self.restarts = {}
+        self.delays = {}
+        self.fleet = None
+
+    #
+    # Forks shard i.
+    # @return the read end of the pipe of the shard in the new shard,
+    # None in the coordinator
+    #
+    def spawn(self, i):
+        (rfd, wfd) = os.pipe()
+        # Do not leave the coordinator's DFM connection to the shard
+        if (isinstance(self.server, DfmConnection)) :
+            self.server.close()
+        pid = os.fork()
+        if (pid == 0) :
+            os.close(wfd)
+            for fd in self.pipes.values() :
+                os.close(fd)
+            return rfd
+        os.close(rfd)
+        self.pids[i] = pid
+        self.pipes[i] = wfd
+        self.started[i] = time.time()
+        self.restarts.pop(i, None)
+        logger.info("ShardCoordinator: started shard %d, pid %d" %(i, pid))
+        return None
+
+    # Sends the filer list and the running shards to every shard
+    def broadcast(self):
+        if (self.fleet == None) or (len(self.pipes) == 0) :
+            return
+        shards = self.pipes.keys()
+        shards.sort()
+        line = ",".join([str(i) for i in shards]) + " " + " ".join(self.fleet) + "\n"
+        for i in shards :
+            try :
+                data = line
+                while (len(data) > 0) :
+                    data = data[os.write(self.pipes[i], data):]
+            except OSError:
+                # The shard stopped, reap() finds out
+                pass
+
+    #
+    # Notes the shards that stopped and when to restart them. A shard
+    # that stops again soon after a restart waits twice as long, up to
+    # BACKOFF_MAX.
+    # @return True if a shard stopped
+    #
+    def reap(self, now):
+        stopped = False
+        while True :
+            try :
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if (pid == 0) :
+                break
+            for i in self.pids.keys() :
+                if (self.pids[i] != pid) :
+                    continue
+                os.close(self.pipes.pop(i))
+                del self.pids[i]
+                if (now - self.started[i] > self.backoff_max) :
+                    self.delays[i] = self.interval
+                else :
+                    self.delays[i] = min(self.delays.get(i, self.interval / 2) * 2, self.backoff_max)
+                self.restarts[i] = now + self.delays[i]
+                logger.error("ShardCoordinator: shard %d (pid %d) stopped with status %d, restarting in %d seconds"
+                             %(i, pid, status, self.delays[i]))
+                stopped = True
+        return stopped
+
+    def stop(self):
+        for pid in self.pids.values() :
+            try :
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.pids.values() :
+            try :
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+    #
+    # Starts the shards and runs the coordinator until it is stopped.
+    # @return (shard number, read end of its pipe) in a shard, which
+    # goes on to collect its filers
+    #
+    def run(self):
+        for i in range(self.nshards) :
+            fd = self.spawn(i)
+            if (fd != None) :
+                return (i, fd)
+        next_refresh = 0.0
+        try :
+            while True :
+                now = time.time()
+                changed = self.reap(now)
+
+                for i in self.restarts.keys() :
+                    if (self.restarts[i] <= now) :
+                        fd = self.spawn(i)
+                        if (fd != None) :
+                            return (i, fd)
+                        changed = True
+
+                if (now >= next_refresh) :
+                    try :
+                        flist = zapi_run(flist_get(), self.server)
+                    except:
+                        logger.error("ShardCoordinator: unexpected error getting filer list", exc_info=1)
+                        flist = -1
+                    if (flist == None) or (flist == -1) or (len(flist) == 0) :
+                        logger.error("No filers to process")
+                        next_refresh = now + self.interval
+                    else :
+                        self.fleet = flist
+                        changed = True
+                        next_refresh = now + self.refresh * self.interval
+
+                # Running shards take over the filers of stopped ones
+                # and give them back once they are restarted
+                if (changed) :
+                    self.broadcast()
+                time.sleep(1.0)
+        finally :
+            if (os.getpid() == self.pid) :
+                self.stop()
+
+#
+# Deadline scheduler for the filers. Every filer is sampled on its own
+# grid of INTERVAL seconds, and the next due time of each filer is kept
+# in a heap so the main loop can hand filers to the workers when they
+# are due instead of waiting for the slowest filer of a round. A filer
+# is never queued twice: if its collection runs past its next slot, the
+# missed slots are skipped rather than run back to back.
+#
+# With INTERVAL_MIN/INTERVAL_MAX set, each filer has its own interval
+# between those bounds instead of INTERVAL: it is halved after a sample
+# where the filer's highest disk busy or volume latency is at or above
+# its watermark, or moved by CHANGE_WATERMARK of the watermark since the
+# previous sample, and grows by a quarter after a quiet sample. When the
+# intervals would take more ZAPI calls per second than REQUEST_BUDGET,
+# all of them are stretched by the same factor, still within the bounds.
+#
+# Each filer also has a circuit breaker. A failed collection is retried
+# at the next slot, until threshold failures in a row open the breaker.
+# An open breaker holds the filer back for an exponential backoff with
+# jitter (INTERVAL doubling up to backoff_max), after which one probe is
+# let through (half-open): success closes the breaker and the filer is
+# back on its grid, failure opens it again for twice as long.
+#
+class FilerScheduler(object):
+    def __init__(self, interval, threshold=3, backoff_max=900.0, interval_min=None, interval_max=None,
+                 watermarks=(None, None), change=0.25, budget=0.0):
+        self.interval = interval
+        self.threshold = threshold
+        self.backoff_max = max(backoff_max, interval)
+        self.interval_min = min(interval_min or interval, interval)
+        self.interval_max = max(interval_max or interval, interval)
+        # (disk busy, volume latency) watermarks, None to ignore one
+        self.watermarks = watermarks
+        self.change = change
+        # ZAPI calls per second, 0 for no limit
+        self.budget = budget
+        self.scale = 1.0
+        # filer -> interval before scaling, for adaptive intervals
+        self.intervals = {}
+        # filer -> (disk busy, volume latency) of the last sample
+        self.loads = {}
+        self.heap = []
+        self.filers = set()
+        # filer -> next due time, for filers waiting in the heap
+        self.due = {}
+        # filer -> due time of the sample being collected
+        self.inflight = {}
+        # filer -> number of failed collections in a row
+        self.failures = {}
+
+    def schedule(self, filer, due):
+        self.due[filer] = due
+        heapq.heappush(self.heap, (due, filer))
+
+    # Makes flist the set of filers to sample. Filers not yet scheduled
+    # get start times staggered over one interval so DFM is not asked
+    # for all of them at once.
+    def set_filers(self, flist, now):
+        self.filers = set(flist)
+        for f in self.due.keys() :
+            if (f not in self.filers) :
+                del self.due[f]
+        for d in (self.failures, self.intervals, self.loads) :
+            for f in d.keys() :
+                if (f not in self.filers) :
+                    del d[f]
+
+        new = [f for f in flist if (f not in self.due) and (f not in self.inflight)]
+        for i in range(len(new)) :
+            self.schedule(new[i], now + self.interval * i / len(new))
+
+    # Drops heap entries of filers that were removed or rescheduled
+    def _prune(self):
+        while (len(self.heap) > 0) and (self.due.get(self.heap[0][1]) != self.heap[0][0]) :
+            heapq.heappop(self.heap)
+
+    def next_due(self):
+        self._prune()
+        if (len(self.heap) == 0) :
+            return None
+        return self.heap[0][0]
+
+    # @return list of (filer, due) that are due at time now
+    def pop_due(self, now):
+        items = []
+        self._prune()
+        while (len(self.heap) > 0) and (self.heap[0][0] <= now) :
+            (due, filer) = heapq.heappop(self.heap)
+            del self.due[filer]
+            self.inflight[filer] = due
+            items.append((filer, due))
+            self._prune()
+        return items
+
+    # Records the end of a collection. On success the filer is due again
+    # at the next slot of its grid after now; on failure it goes through
+    # its circuit breaker, which a collection cut short by a deadline
+    # opens at once.
+    # @return number of samples skipped because of an overrun
+    def done(self, filer, ok, now, deadline=False):
+        due = self.inflight.pop(filer, None)
+        if (due == None) or (filer not in self.filers) :
+            return 0
+
+        if (not ok) :
+            failures = self.failures.get(filer, 0) + 1
+            if (deadline) :
+                failures = max(failures, self.threshold)
+            self.failures[filer] = failures
+            if (failures < self.threshold) :
+                self.schedule(filer, now + self.interval)
+                return 0
+            delay = self.backoff(failures)
+            if (deadline) :
+                logger.warning("FilerScheduler: " + filer + " ran past its deadline, backing off for %d seconds" %(delay))
+            elif (failures == self.threshold) :
+                logger.warning("FilerScheduler: " + filer + " failed %d times in a row, backing off for %d seconds" %(failures, delay))
+            else :
+                logger.info("FilerScheduler: probe of " + filer + " failed, backing off for %d seconds" %(delay))
+            self.schedule(filer, now + delay)
+            return 0
+
+        if (self.failures.pop(filer, 0) >= self.threshold) :
+            logger.warning("FilerScheduler: " + filer + " is back, resuming collection")
+        interval = self.period(filer)
+        slots = int((now - due) / interval) + 1
+        self.schedule(filer, due + slots * interval)
+        return slots - 1
+
+    def adaptive(self):
+        return (self.interval_min < self.interval_max)
+
+    # @return seconds between samples of filer
+    def period(self, filer):
+        if (not self.adaptive()) :
+            return self.interval
+        interval = self.intervals.get(filer, self.interval) * self.scale
+        return min(max(interval, self.interval_min), self.interval_max)
+
+    #
+    # Adapts the interval of filer to load, the (disk busy, volume
+    # latency) of its latest sample. Called before done().
+    #
+    def adapt(self, filer, load):
+        if (not self.adaptive()) or (filer not in self.filers) :
+            return
+        last = self.loads.get(filer)
+        self.loads[filer] = load
+        hot = False
+        for i in range(len(load)) :
+            mark = self.watermarks[i]
+            if (mark == None) :
+                continue
+            if (load[i] >= mark) or ((last != None) and (abs(load[i] - last[i]) >= self.change * mark)) :
+                hot = True
+        interval = self.intervals.get(filer, self.interval)
+        if (hot) :
+            interval = max(interval / 2, self.interval_min)
+        else :
+            interval = min(interval * 1.25, self.interval_max)
+        self.intervals[filer] = interval
+
+    #
+    # Works out the factor the intervals are stretched by to keep within
+    # REQUEST_BUDGET, given the average ZAPI calls of a collection.
+    #
+    def rebudget(self, calls_per_collection):
+        if (not self.adaptive()) or (self.budget <= 0) or (calls_per_collection <= 0) :
+            return
+        rate = 0.0
+        for f in self.filers :
+            rate = rate + 1.0 / self.intervals.get(f, self.interval)
+        self.scale = max(rate * calls_per_collection / self.budget, 1.0)
+
+    # @return seconds an open breaker waits after the given number of
+    # failures in a row: INTERVAL doubled per failure past threshold, up
+    # to backoff_max, of which a random half is taken off so that filers
+    # that failed together do not all probe together
+    def backoff(self, failures):
+        delay = self.interval * (2 ** min(failures - self.threshold + 1, 30))
+        delay = min(delay, self.backoff_max)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+#
+# Metrics of the collection (see ontapmetrics.py). ZAPI call latency is
+# kept per API and per filer, collection time per filer, and the main
+# loop writes them out with the queue and scheduler state to
+# METRICS_FILE every INTERVAL.
+#
+class CollectorMetrics(object):
+    def __init__(self):
+        self.registry = ontapmetrics.Registry()
+        add = self.registry.add
+        self.callSeconds = add(ontapmetrics.Histogram("ontapmon_zapi_call_seconds",
+            "Latency of DFM ZAPI calls by API.", "api"))
+        self.filerCallSeconds = add(ontapmetrics.Histogram("ontapmon_filer_zapi_call_seconds",
+            "Latency of DFM ZAPI calls by filer.", "filer"))
+        self.calls = add(ontapmetrics.Counter("ontapmon_zapi_calls_total",
+            "DFM ZAPI calls by API.", "api"))
+        self.callFailures = add(ontapmetrics.Counter("ontapmon_zapi_call_failures_total",
+            "DFM ZAPI calls that failed or returned a failed status, by API.", "api"))
+        self.collectionSeconds = add(ontapmetrics.Histogram("ontapmon_collection_seconds",
+            "Time taken by the collections of all filers."))
+        self.filerCollectionSeconds = add(ontapmetrics.Gauge("ontapmon_filer_collection_seconds",
+            "Time taken by the last collection of each filer.", "filer"))
+        self.collections = add(ontapmetrics.Counter("ontapmon_collections_total",
+            "Filer collections by result (ok, failed, skipped).", "result"))
+        self.skipped = add(ontapmetrics.Counter("ontapmon_overrun_samples_total",
+            "Samples skipped because a collection overran INTERVAL."))
+        self.queueDepth = add(ontapmetrics.Gauge("ontapmon_queue_depth",
+            "Filers that are due and waiting to be collected."))
+        self.inflight = add(ontapmetrics.Gauge("ontapmon_filers_in_flight",
+            "Filers queued or being collected."))
+        self.filers = add(ontapmetrics.Gauge("ontapmon_filers",
+            "Filers in the current filer list."))
+        self.backedOff = add(ontapmetrics.Gauge("ontapmon_filers_backed_off",
+            "Filers held back by their circuit breaker."))
+        self.filerInterval = add(ontapmetrics.Gauge("ontapmon_filer_interval_seconds",
+            "Current sampling interval of each filer.", "filer"))
+        self.budgetScale = add(ontapmetrics.Gauge("ontapmon_interval_budget_scale",
+            "Factor the filer intervals are stretched by to keep within REQUEST_BUDGET."))
+        self.outputs = add(ontapmetrics.Counter("ontapmon_output_writes_total",
+            "Output file updates by result (written, suppressed, failed).", "result"))
+        self.notifySubscribers = add(ontapmetrics.Gauge("ontapmon_notify_subscribers",
+            "Subscribers connected to NOTIFY_SOCKET."))
+        self.notifyDropped = add(ontapmetrics.Counter("ontapmon_notify_dropped_total",
+            "Subscribers of NOTIFY_SOCKET disconnected because they fell behind or went away."))
+        self.callDeadlines = add(ontapmetrics.Counter("ontapmon_call_deadlines_total",
+            "ZAPI calls abandoned at the CALL_DEADLINE of their API, by API.", "api"))
+        self.collectionDeadlines = add(ontapmetrics.Counter("ontapmon_collection_deadlines_total",
+            "Filer collections cut short by COLLECTION_DEADLINE."))
+        self.lastExport = add(ontapmetrics.Gauge("ontapmon_last_export_time_seconds",
+            "Time the metrics were written."))
+
+    # Records a ZAPI call. output is None if the call raised.
+    def call(self, req, filer, seconds, output):
+        api = req.element["name"]
+        self.callSeconds.observe(seconds, api)
+        self.calls.inc(api)
+        if (output == None) or (output.results_status() == "failed") :
+            self.callFailures.inc(api)
+        if (filer != None) :
+            self.filerCallSeconds.observe(seconds, filer)
+
+    # Records a deadline ("call" or "collection") that cut the call of req
+    # short
+    def deadline(self, limit, req):
+        if (limit == "collection") :
+            self.collectionDeadlines.inc()
+        else :
+            self.callDeadlines.inc(req.element["name"])
+
+    # Records a collection with its result (0, -1, DEADLINE or 1 for
+    # skipped)
+    def collection(self, filer, seconds, err):
+        if (err == 1) :
+            self.collections.inc("skipped")
+            return
+        if (err == -1) or (err == DEADLINE) :
+            self.collections.inc("failed")
+        else :
+            self.collections.inc("ok")
+        self.collectionSeconds.observe(seconds)
+        self.filerCollectionSeconds.set(seconds, filer)
+
+    # @return average number of ZAPI calls of a collection so far
+    def calls_per_collection(self):
+        calls = sum([n for (api, n) in self.calls.snapshot()])
+        collections = sum([n for (result, n) in self.collections.snapshot() if result != "skipped"])
+        if (collections == 0) :
+            return 0.0
+        return float(calls) / collections
+
+    # Drops the series of a removed filer
+    def forget(self, filer):
+        self.filerCallSeconds.remove(filer)
+        self.filerCollectionSeconds.remove(filer)
+        self.filerInterval.remove(filer)
+
+    def export(self, path, workq, scheduler, notifier=None):
+        self.queueDepth.set(workq.qsize())
+        self.inflight.set(len(scheduler.inflight))
+        self.filers.set(len(scheduler.filers))
+        self.backedOff.set(len([f for f in scheduler.failures if scheduler.failures[f] >= scheduler.threshold]))
+        if (scheduler.adaptive()) :
+            for f in scheduler.filers :
+                self.filerInterval.set(scheduler.period(f), f)
+            self.budgetScale.set(scheduler.scale)
+        if (notifier != None) :
+            self.notifySubscribers.set(notifier.count())
+        self.lastExport.set(time.time())
+        try :
+            self.registry.write(path)
+        except (IOError, OSError):
+            logger.error("Error in writing metrics file " + path, exc_info=1)
+
+stats = CollectorMetrics()
 
 #
 # Class definitions Filer Information
 #
+# filerDataDict entries are only added by the main thread. The data of a
+# filer belongs to the worker collecting it, and the scheduler never
+# hands a filer to two workers at once. Every read or update of the data
+# of a filer (the workers' extract and print functions, the main thread
+# resetting aggrBatchOk) is done under its lock with with_filer_lock().
+# The lock is never held across a DFM call.
+#
+# The classes use __slots__, and aggregate, volume and domain names are
+# interned with name_key(), since a fleet has millions of these entries.
+#
 
 class FilerData(object):
+    __slots__ = ('aggrDataDict', 'domainDataDict', 'aggrBatchOk', 'volPage', 'lock', 'generation',
+                 'written')
+
     def __init__(self) :
-        self.ipAddr = []
         self.aggrDataDict = {}
         self.domainDataDict = {}
+        # Whether batched aggregate counter requests can be used
+        self.aggrBatchOk = True
+        # Current volume page size, VOL_PAGE to start with (see
+        # vollist_get())
+        self.volPage = None
+        self.lock = threading.Lock()
+        # Number of the current collection pass, see evict_stale()
+        self.generation = 0
+        # (time, signature, values) of the last output written, see
+        # output_due(). Only used by the worker collecting the filer.
+        self.written = None
 
 class AggrData(object) :
+    __slots__ = ('volumeDataDict', 'maxdiskb', 'seen')
+
     def __init__(self) :
         self.volumeDataDict = {}
         self.maxdiskb = 0.0
+        # Generation of the last pass that saw the aggregate
+        self.seen = 0
 
 class VolumeData(object):
+    __slots__ = ('avglatency', 'availSize', 'availInodes', 'seen')
+
     def __init__(self):
         self.avglatency = 0.0
         self.availSize = 0
         self.availInodes = 0
+        self.seen = 0
 
 class DomainData(object):
+    __slots__ = ('dvalue', 'seen')
+
     def __init__(self):
         self.dvalue = 0
+        self.seen = 0
+
+#
+# Runs func(*args) under the lock of the data of filer
+# @return what func returns
+#
+def with_filer_lock(filer, func, *args):
+    lock = filerDataDict[filer].lock
+    lock.acquire()
+    try :
+        return func(*args)
+    finally :
+        lock.release()
+
+#
+# Returns name interned so that the same aggregate, volume or domain name
+# on many filers is stored once.
+#
+def name_key(name):
+    if (type(name) == str) :
+        return intern(name)
+    return name
+
+#
+# Layout of a filer that rarely changes: its aggregates (with their DFM
+# object ids), which aggregate each volume lives in and its IP addresses.
+#
+class FilerTopology(object):
+    __slots__ = ('aggrList', 'aggrIdDict', 'volAggrDict', 'ipAddr', 'refreshed')
+
+    def __init__(self):
+        self.aggrList = []
+        self.aggrIdDict = {}
+        self.volAggrDict = {}
+        self.ipAddr = []
+        self.refreshed = 0.0
+
+#
+# Topology cache for all filers. An entry is refreshed when it is older
+# than max_age seconds or after invalidate() is called because the
+# collected data did not match it, so regular cycles only have to ask
+# DFM for counters.
+#
+class TopologyCache(object):
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, filer):
+        topo = self.entries.get(filer)
+        if (topo == None) :
+            self.lock.acquire()
+            try :
+                topo = self.entries.setdefault(filer, FilerTopology())
+            finally :
+                self.lock.release()
+        return topo
+
+    def stale(self, filer):
+        return (time.time() - self.get(filer).refreshed) > self.max_age
+
+    def invalidate(self, filer):
+        self.get(filer).refreshed = 0.0
+
+    def remove(self, filer):
+        self.lock.acquire()
+        try :
+            self.entries.pop(filer, None)
+        finally :
+            self.lock.release()
 
 
         
-def construct_server(hostname, username, password):
+#
+# ZAPI port, envelope and URL used by NaServer for a DFM server
+#
+DFM_PORT = 8088
+DFM_URL = "/apis/XMLrequest"
+ZAPI_HEADER = "<?xml version='1.0' encoding='utf-8'?>\n" + \
+              "<!DOCTYPE netapp SYSTEM 'file:/etc/netapp_dfm.dtd'>" + \
+              "<netapp version='1.0' xmlns='http://www.netapp.com/filer/admin'>"
+ZAPI_FOOTER = "</netapp>"
+
+def construct_server(hostname, username, password, port=DFM_PORT):
     server = NaServer(hostname, 1, 0 )
     server.set_style('LOGIN')
     server.set_transport_type('HTTP')
     server.set_server_type('DFM')
-    server.set_port(8088)
+    server.set_port(port)
     server.set_admin_user(username, password)
     return server
 
+#
+# Builds a ZAPI request from name/value pairs the way NaServer.invoke()
+# does.
+#
+def zapi_elem(api, *args):
+    xi = NaElement(api)
+    for i in range(0, len(args) - 1, 2) :
+        xi.child_add_string(args[i], args[i + 1])
+    return xi
+
+#
+# Requests that are sent for every filer in every interval are built and
+# serialized once as templates, with a marker (template_slot()) in place
+# of each value that changes from call to call. fill() then only puts the
+# values in, escaped, and returns a request that the connections send as
+# it is, with either client.
+#
+# Domains whose domain_busy counters are collected by default
+DOMAIN_COUNTERS = "kahuna, storage, raid, target, cifs, nwk_legacy"
+# Domains of a filer that the LSF plugin (sysntap.h) has room for
+DOMAIN_SIZE = 6
+
+TEMPLATE_SLOT_RE = re.compile("\x01(\\w+)\x01")
+
+def template_slot(name):
+    return "\x01" + name + "\x01"
+
+class RequestTemplate(object):
+    def __init__(self, req):
+        self.api = req.element["name"]
+        # Text between the slots at the even positions, slot names at
+        # the odd ones
+        self.parts = TEMPLATE_SLOT_RE.split(req.toEncodedString())
+
+    #
+    # @return the serialized request with the values of the slots. A
+    # list value is taken as request fragments serialized by text() of
+    # another template, and put in unescaped.
+    #
+    def text(self, values):
+        out = self.parts[:]
+        for i in range(1, len(out), 2) :
+            value = values[out[i]]
+            if (isinstance(value, list)) :
+                out[i] = "".join(value)
+            else :
+                out[i] = ontapzapi.escape(value)
+        return "".join(out)
+
+    def fill(self, **values):
+        return TemplateRequest(self.api, self.text(values))
 
 #
-# MAIN 
+# Request made from a template. Has the element dictionary (for the name
+# of the API) and toEncodedString() of NaElement, which is all that
+# NaServer and the DFM connections use.
 #
+class TemplateRequest(object):
+    __slots__ = ('element', 'encoded')
 
+    def __init__(self, api, encoded):
+        self.element = {'name': api}
+        self.encoded = encoded
 
-# get args
-args = len(sys.argv) - 1
-if(args < 1):
-    usage()
+    def toEncodedString(self):
+        return self.encoded
 
-# Read config.ini file
-parser = SafeConfigParser()
-parser.read(sys.argv[1])
-nmdkpath = parser.get('env_params', 'NMDKDIR')
-sys.path.append(nmdkpath + "/lib/python/NetApp")
-from NaServer import *
+#
+# Template of the perf-get-counter-data request for the domain_busy
+# counters of the labels in domains, with the slot obj for the filer.
+#
+def domainperf_template(domains):
+    perf_in = NaElement("perf-get-counter-data")
+    perf_in.child_add_string("number-samples", 1)
 
-# Get the parameters from config.ini
-dfmserver = parser.get('dfm_param', 'HOST')
-dfmuser = parser.get('dfm_param', 'USER')
-dfmpw = parser.get('dfm_param', 'PASSWD')
-interval = float(parser.get('mon_param', 'INTERVAL'))
-dirloc = parser.get('mon_param', 'DIRLOC')
-nthreads = int(parser.get('mon_param', 'NTHREADS'))
-refresh = int(parser.get('mon_param', 'REFRESH'))
+    instance_info = NaElement("instance-counter-info")
+    counter_info = NaElement("counter-info")
+    instance_info.child_add_string("object-name-or-id", template_slot("obj"))
+    for label in domains :
+        perf_obj_ctr = NaElement("perf-object-counter")
+        perf_obj_ctr.child_add_string("object-type", "processor")
+        perf_obj_ctr.child_add_string("counter-name", "domain_busy")
+        perf_obj_ctr.child_add_string("label-names", label)
+        counter_info.child_add(perf_obj_ctr)
 
-# Set up logger file for errors
-logname = dirloc + "/ontapmon_error.log"
-logger = logging.getLogger('ontap_monitoring_agent')
-handler = logging.handlers.TimedRotatingFileHandler(logname, when='midnight', interval=1, backupCount=7)
-formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
+    instance_info.child_add(counter_info)
+    perf_in.child_add(instance_info)
+    return RequestTemplate(perf_in)
 
-# Set up signal handler
-signal.signal(signal.SIGTERM, signal_handler_term)
+#
+# Templates of the perf-get-counter-data request for aggregates, whose
+# slot instances takes the text() of the instance template, with the
+# slot obj, for each aggregate.
+# @return (request template, instance template)
+#
+def aggrperf_templates():
+    perf_in = NaElement("perf-get-counter-data")
+    perf_in.child_add_string("number-samples", 1)
+    # Content comes after the children, where the instances go
+    perf_in.set_content(template_slot("instances"))
 
-# Creating a server object and setting appropriate attributes
-server_ctx = construct_server(dfmserver, dfmuser, dfmpw)
+    instance_info = NaElement("instance-counter-info")
+    counter_info = NaElement("counter-info")
+    instance_info.child_add_string("object-name-or-id", template_slot("obj"))
 
-#Define the Filer Data Dictionary to hold filer/volume data
-filerDataDict = {}
+    perf_obj_ctr1 = NaElement("perf-object-counter")
+    perf_obj_ctr1.child_add_string("object-type", "volume")
+    perf_obj_ctr1.child_add_string("counter-name", "avg_latency")
 
-# Create work threads to get counters for filers
-while True : 
-    
-    # get list of filers
-    flist_arr = flist_get(server_ctx)
-
-    # If unable to get list of filers or there is no filers being
-    # managed by DFM, sleep for specified interval and recheck after
-    if (flist_arr == -1) or (flist_arr == None) :
-        logger.error("No filers to process")
-        time.sleep(interval)
-        continue
-    
-    for f in flist_arr :
-        if (f not in filerDataDict) :
-            filerDataDict[f] = FilerData()
-        res = ipaddr_get(server_ctx, f)
-        if (res == -1) :
-            logger.error("main(): ipaddr_get() unable to get ip for filer " + f)
+    perf_obj_ctr2 = NaElement("perf-object-counter")
+    perf_obj_ctr2.child_add_string("object-type", "disk")
+    perf_obj_ctr2.child_add_string("counter-name", "disk_busy")
 
+    counter_info.child_add(perf_obj_ctr1)
+    counter_info.child_add(perf_obj_ctr2)
+    instance_info.child_add(counter_info)
+    return (RequestTemplate(perf_in), RequestTemplate(instance_info))
+
+#
+# Template of an api-proxy request with the slot target for the filer and
+# a slot for each of the arguments of api, named after it.
+#
+def proxy_template(api, *argnames):
+    args = []
+    for name in argnames :
+        args.extend([name, template_slot(name)])
+    return RequestTemplate(proxy_elem(template_slot("target"), api, *args))
+
+#
+# The ZAPI sequences (flist_get(), perf_mon() and the functions they
+# use) are written as generators so that the same code can be driven by
+# a blocking worker thread or by the asynchronous engine. A sequence
+# yields a ZapiCall to have a request sent and gets the results element
+# back, yields another sequence to run it and get its result, and yields
+# any other value as its own result.
+#
+class ZapiCall(object):
+    def __init__(self, req):
+        self.req = req
+
+#
+# Calls are abandoned once they take longer than the CALL_DEADLINE of
+# their API, and the collection of a filer once it takes longer than
+# COLLECTION_DEADLINE. A collection cut short by either fails with
+# DEADLINE, which puts the filer in backoff at once.
+#
+DEADLINE = -2
+CALL_DEADLINE = "300"
+# Least socket timeout left to a call close to its deadline
+DEADLINE_MIN = 0.01
+
+#
+# Parses CALL_DEADLINE, a comma separated list of seconds for all APIs
+# and api:seconds for single ones, 0 meaning no limit.
+# @return {api: seconds} with the default under None, or -1 if spec is
+# invalid
+#
+def parse_deadlines(spec):
+    deadlines = {None: 0.0}
+    for item in spec.split(",") :
+        if (item.strip() == "") :
+            continue
+        try :
+            parts = [part.strip() for part in item.split(":")]
+            if (len(parts) == 1) :
+                (api, value) = (None, parts[0])
+            elif (len(parts) == 2) :
+                (api, value) = parts
+            else :
+                raise ValueError("expected seconds or api:seconds")
+            deadlines[api] = float(value)
+            if (deadlines[api] < 0) :
+                raise ValueError("negative deadline")
+        except ValueError, e:
+            logger.error("parse_deadlines(): invalid CALL_DEADLINE entry " + item + ": " + str(e))
+            return -1
+    return deadlines
+
+# @return seconds a call of api may take, 0 for no limit
+def call_deadline(api):
+    return call_deadlines.get(api, call_deadlines[None])
+
+class ZapiTask(object):
+    def __init__(self, steps, filer=None):
+        self.stack = [steps]
+        self.result = None
+        self.started = time.time()
+        # Filer collected by the task, None for other sequences. Only
+        # collections have COLLECTION_DEADLINE.
+        self.filer = filer
+        self.deadline = None
+        if (filer != None) and (collection_deadline > 0) :
+            self.deadline = self.started + collection_deadline
+        # Deadline that cut the last call short ("call", "collection")
+        self.limit = None
+        self.expired = False
+
+    #
+    # @return seconds the call of req may take, 0 for no limit, or None
+    # if the task has run out of time
+    #
+    def timeout(self, req):
+        seconds = call_deadline(req.element["name"])
+        self.limit = "call"
+        if (self.deadline == None) :
+            return seconds
+        left = self.deadline - time.time()
+        if (left <= 0) :
+            self.limit = "collection"
+            self.expire(req)
+            return None
+        if (seconds == 0) or (left < seconds) :
+            self.limit = "collection"
+            return left
+        return seconds
+
+    # Records a call that took seconds out of timeout, and got body as
+    # its raw response (for CAPTURE_FILE). A failed call that used up its
+    # time was abandoned on its deadline.
+    def called(self, req, timeout, seconds, output, body=None):
+        stats.call(req, self.filer, seconds, output)
+        if (capture != None) :
+            capture.call(self.filer, req.element["name"], req.toEncodedString(), time.time() - seconds, seconds, body)
+        if (timeout > 0) and (seconds >= timeout) and \
+           ((output == None) or (output.results_status() == "failed")) :
+            self.expire(req)
+
+    def expire(self, req):
+        if (self.limit == "collection") :
+            logger.warning("ZapiTask: collection of " + self.filer + " ran past COLLECTION_DEADLINE at " + req.element["name"])
+        elif (self.filer != None) :
+            logger.warning("ZapiTask: " + req.element["name"] + " call for " + self.filer + " ran past CALL_DEADLINE")
+        else :
+            logger.warning("ZapiTask: " + req.element["name"] + " call ran past CALL_DEADLINE")
+        stats.deadline(self.limit, req)
+        self.expired = True
+
+    # Drops the sequence, which has run out of time
+    def abandon(self):
+        while (len(self.stack) > 0) :
+            self.stack.pop().close()
+        self.result = DEADLINE
+
+    # @return result of the task, with DEADLINE for a collection that
+    # failed because a deadline passed
+    def outcome(self):
+        if (self.filer != None) and (self.expired) and (self.result == -1) :
+            return DEADLINE
+        return self.result
+
+    # Runs the task until it has a request for DFM. value (or exc_info)
+    # is the outcome of the previous request.
+    # @return the next ZapiCall, or None once the task has its result
+    def resume(self, value=None, exc_info=None):
+        while True :
+            steps = self.stack[-1]
+            try :
+                if (exc_info != None) :
+                    out = steps.throw(exc_info[0], exc_info[1], exc_info[2])
+                else :
+                    out = steps.send(value)
+            except StopIteration:
+                out = None
+            except Exception:
+                # Hand the error to the calling sequence, if any
+                self.stack.pop()
+                if (len(self.stack) == 0) :
+                    raise
+                exc_info = sys.exc_info()
+                continue
+            exc_info = None
+
+            if (isinstance(out, ZapiCall)) :
+                return out
+            if (isinstance(out, types.GeneratorType)) :
+                self.stack.append(out)
+                value = None
+                continue
+
+            # out is the result of the sequence on top of the stack
+            self.stack.pop()
+            if (len(self.stack) == 0) :
+                self.result = out
+                return None
+            value = out
+
+#
+# Gives the next blocking call on server the timeout of its deadline.
+# NaServer takes whole seconds and has no way back to no limit, so a call
+# without a deadline keeps the timeout of the one before it on the same
+# NaServer.
+#
+def set_call_timeout(server, seconds):
+    if (isinstance(server, DfmConnection)) or (isinstance(server, AsyncServer)) :
+        server.set_timeout(seconds)
+    elif (seconds > 0) and (hasattr(server, "set_timeout")) :
+        server.set_timeout(max(int(math.ceil(seconds)), 1))
+
+#
+# Runs a ZAPI sequence to completion with blocking calls on server
+# (an NaServer or a DfmConnection). The calls are timed for the metrics,
+# per filer too when filer is given, and limited by their deadlines.
+# @return result of the sequence, DEADLINE for a collection of filer cut
+# short by a deadline
+#
+def zapi_run(steps, server, filer=None):
+    task = ZapiTask(steps, filer)
+    call = task.resume()
+    while (call != None) :
+        timeout = task.timeout(call.req)
+        if (timeout == None) :
+            task.abandon()
+            break
+        set_call_timeout(server, timeout)
+        start = time.time()
+        try :
+            output = server.invoke_elem(call.req)
+        except Exception:
+            exc_info = sys.exc_info()
+            task.called(call.req, timeout, time.time() - start, None)
+            call = task.resume(exc_info=exc_info)
+        else :
+            body = None
+            if (capture != None) :
+                body = server.body
+            task.called(call.req, timeout, time.time() - start, output, body)
+            call = task.resume(output)
+    return task.outcome()
+
+#
+# Returns a failed results element the same way NaServer does, so
+# callers can keep checking results_status()/results_reason().
+#
+def fail_response(errno, reason):
+    return ontapzapi.fail_response(errno, reason, NaElement)
+
+# Failed results of a call abandoned on its deadline
+def expired_response(hostname):
+    return fail_response(13001, "DFM " + hostname + " did not answer before the deadline of the call")
+
+#
+# Elements of the responses that ontapmon reads, by API. With CLIENT =
+# builtin all other elements are dropped while a response is parsed.
+# Responses of the APIs not listed are kept whole.
+#
+RESPONSE_FIELDS = {
+    "host-list-info-iter-next" : frozenset(["records", "hosts", "host-info", "host-name"]),
+    "aggregate-list-info-iter-next" : frozenset(["records", "aggregates", "aggregate-info",
+                                                 "aggregate-name", "aggregate-id"]),
+    "perf-get-counter-data" : frozenset(["perf-instances", "instance-data", "instance-name", "object-id",
+                                         "counters", "perf-counter-data", "counter-name",
+                                         "counter-data", "label-names"]),
+    "api-proxy" : frozenset(["response", "status", "reason", "results", "records", "tag",
+                             "volumes", "volume-info", "name", "state", "type", "size-available",
+                             "files-used", "files-total", "containing-aggregate"]),
+}
+
+def response_fields(req):
+    if (client != 'builtin') :
+        return None
+    return RESPONSE_FIELDS.get(req.element["name"])
+
+#
+# Parses a ZAPI response into NaElement objects (ZapiElement objects
+# with CLIENT = builtin) and returns the results element. Unlike
+# NaServer.parse_xml() the element stack is local to the call, so this
+# is safe to use from several worker threads.
+#
+def parse_zapi_response(xmlresponse, fields=None):
+    return ontapzapi.parse_response(xmlresponse, NaElement, fields)
+
+#
+# Socket of a DfmConnection read by an HTTPResponse, whose every recv()
+# only gets the time left until end. A plain socket timeout bounds each
+# recv(), so a response that trickles in would never run out of time.
+#
+class DeadlineSocket(object):
+    def __init__(self, sock, end):
+        self.sock = sock
+        self.end = end
+
+    def recv(self, size):
+        left = self.end - time.time()
+        if (left <= 0) :
+            raise socket.timeout("timed out")
+        self.sock.settimeout(left)
+        return self.sock.recv(size)
+
+    def makefile(self, mode="r", bufsize=-1):
+        return socket._fileobject(self, mode, bufsize)
+
+    # httplib closes the connection of a response that will close before
+    # it is read. The socket is closed when the response lets go of it.
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+#
+# Persistent HTTP/1.1 session to DFM. Sends the same ZAPI envelope as
+# NaServer.invoke_elem() but keeps the TCP connection open between calls
+# so a worker does not pay for connection setup and login on every ZAPI.
+#
+class DfmConnection(object):
+    def __init__(self, hostname, username, password, port=DFM_PORT):
+        self.hostname = hostname
+        self.port = port
+        self.headers = {
+            "Content-type" : 'text/xml; charset="UTF-8"',
+            "Authorization" : "Basic " + base64.b64encode(username + ":" + password),
+        }
+        self.conn = None
+        self.last_used = time.time()
+        # Seconds DFM may take to answer the next call, None for no limit
+        self.timeout = None
+        # Raw response of the last call, None if it got none
+        self.body = None
+
+    # Like NaServer.set_timeout(), with 0 for no limit
+    def set_timeout(self, seconds):
+        self.timeout = (seconds > 0) and seconds or None
+
+    def connect(self, timeout=None):
+        self.close()
+        self.conn = httplib.HTTPConnection(self.hostname, self.port, timeout=timeout)
+        self.conn.connect()
+
+    def close(self):
+        if (self.conn != None) :
+            self.conn.close()
+            self.conn = None
+
+    def idle_time(self):
+        return time.time() - self.last_used
+
+    # Health check done before reusing a connection. An idle keep-alive
+    # socket that is readable has either been closed by DFM or has stray
+    # data on it, so it cannot carry the next request.
+    def healthy(self):
+        if (self.conn == None) or (self.conn.sock == None) :
+            return False
+        try :
+            readable = select.select([self.conn.sock], [], [], 0)[0]
+        except (select.error, socket.error):
+            return False
+        return (len(readable) == 0)
+
+    def invoke(self, api, *args):
+        return self.invoke_elem(zapi_elem(api, *args))
+
+    # @return seconds left until end for the next socket operation, None
+    # for no limit
+    def left(self, end):
+        if (end == None) :
+            return None
+        return max(end - time.time(), DEADLINE_MIN)
+
+    # Reads the response to the request sent, cut off at end
+    def getresponse(self, end):
+        if (end == None) :
+            return self.conn.getresponse()
+        sock = DeadlineSocket(self.conn.sock, end)
+        self.conn.sock = sock
+        try :
+            return self.conn.getresponse()
+        finally :
+            if (self.conn.sock == sock) :
+                self.conn.sock = sock.sock
+
+    def invoke_elem(self, req):
+        content = ZAPI_HEADER + req.toEncodedString() + ZAPI_FOOTER
+        self.body = None
+
+        # A reused connection can be closed by DFM at any time, so retry
+        # once on a fresh connection before reporting the failure. Each
+        # step only gets the time left of the call, retry included.
+        end = None
+        if (self.timeout != None) :
+            end = time.time() + self.timeout
+        for attempt in (0, 1) :
+            if (attempt > 0) and (end != None) and (time.time() >= end) :
+                return expired_response(self.hostname)
+            reused = self.healthy()
+            try :
+                if (not reused) :
+                    self.connect(self.left(end))
+                self.conn.sock.settimeout(self.left(end))
+                self.conn.request("POST", DFM_URL, content, self.headers)
+                response = self.getresponse(end)
+                xmlresponse = response.read()
+            except socket.timeout:
+                # The call is abandoned, and the connection with it since
+                # DFM may still answer on it
+                self.close()
+                return expired_response(self.hostname)
+            except (httplib.HTTPException, socket.error), e:
+                self.close()
+                if (reused) and (attempt == 0) :
+                    continue
+                return fail_response(13001, "Unable to reach DFM " + self.hostname + ": " + str(e))
+
+            self.last_used = time.time()
+            if (response.will_close) :
+                self.close()
+            self.body = xmlresponse
+            if (response.status != 200) :
+                return fail_response(13001, "HTTP error " + str(response.status) + " " + response.reason)
+            return parse_zapi_response(xmlresponse, response_fields(req))
+
+#
+# Pool of DFM connections shared by the worker threads. The pool holds
+# one connection per worker (NTHREADS) and hands out the most recently
+# used one first, so the connections left idle are the ones that get
+# closed once they exceed MAX_IDLE. With KEEPALIVE off every get()
+# returns a new NaServer, as before.
+#
+class DfmConnectionPool(object):
+    def __init__(self, hostname, username, password, port, size, max_idle, keepalive=True):
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.port = port
+        self.max_idle = max_idle
+        self.keepalive = keepalive
+        self.free = Queue.LifoQueue()
+        if (keepalive) :
+            for i in range(size) :
+                self.free.put(DfmConnection(hostname, username, password, port))
+
+    def get(self):
+        if (not self.keepalive) :
+            return construct_server(self.hostname, self.username, self.password, self.port)
+        conn = self.free.get()
+        if (conn.idle_time() > self.max_idle) :
+            conn.close()
+        return conn
+
+    def put(self, conn):
+        if (self.keepalive) :
+            self.free.put(conn)
+
+    # Close connections that have not been used for MAX_IDLE seconds
+    # so DFM is not holding sessions for workers that have nothing to do.
+    def evict_idle(self):
+        if (not self.keepalive) :
+            return
+        conns = []
+        while True :
+            try :
+                conns.append(self.free.get_nowait())
+            except Queue.Empty:
+                break
+        conns.reverse()
+        for conn in conns :
+            if (conn.idle_time() > self.max_idle) :
+                conn.close()
+            self.free.put(conn)
+
+#
+# One HTTP/1.1 keep-alive connection of the asynchronous engine. It
+# carries one ZAPI request at a time and hands the parsed results
+# element (or a failed one) to the callback given with the request.
+#
+class AsyncDfmChannel(asyncore.dispatcher):
+    def __init__(self, engine):
+        asyncore.dispatcher.__init__(self, map=engine.map)
+        self.engine = engine
+        self.open = False
+        self.callback = None
+        self.deadline = None
+        self.outbuf = ""
+        self.status = None
+        self.headers = {}
+        self.last_used = time.time()
+
+    def busy(self):
+        return (self.callback != None)
+
+    def idle_time(self):
+        return time.time() - self.last_used
+
+    # deadline is the time by which the request has to be done, None for
+    # no limit
+    def request(self, content, fields, callback, deadline):
+        self.content = content
+        self.fields = fields
+        self.callback = callback
+        self.deadline = deadline
+        self.attempt = 0
+        self.send_request()
+
+    def send_request(self):
+        self.outbuf = "POST " + DFM_URL + " HTTP/1.1\r\n" + \
+                      "Host: " + self.engine.hostname + ":" + str(self.engine.port) + "\r\n" + \
+                      "Content-type: text/xml; charset=\"UTF-8\"\r\n" + \
+                      "Authorization: " + self.engine.auth + "\r\n" + \
+                      "Content-Length: " + str(len(self.content)) + "\r\n\r\n" + self.content
+        self.inbuf = ""
+        self.chunks = []
+        self.nbytes = 0
+        self.dechunker = None
+        self.status = None
+        self.headers = {}
+        self.reused = self.open
+        if (not self.open) :
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.open = True
+            try :
+                self.connect((self.engine.hostname, self.engine.port))
+            except socket.error, e:
+                self.fail(str(e))
+
+    def readable(self):
+        return self.open
+
+    def writable(self):
+        return self.open and ((len(self.outbuf) > 0) or (not self.connected))
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.outbuf)
+        self.outbuf = self.outbuf[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if (len(data) == 0) or (not self.busy()) :
+            return
+        if (self.status == None) :
+            self.inbuf = self.inbuf + data
+            end = self.inbuf.find("\r\n\r\n")
+            if (end < 0) :
+                return
+            lines = self.inbuf[:end].split("\r\n")
+            data = self.inbuf[end + 4:]
+            self.inbuf = ""
+            try :
+                (self.version, status) = lines[0].split(None, 2)[:2]
+                self.status = int(status)
+            except ValueError:
+                self.fail("Bad HTTP status line from DFM: " + lines[0])
+                return
+            for line in lines[1:] :
+                (name, sep, value) = line.partition(":")
+                self.headers[name.strip().lower()] = value.strip()
+        self.add_body(data)
+
+    # Adds data to the body and completes the request once the whole body
+    # is in. The body is only joined then, and a chunked one is decoded
+    # as it comes in. A body without a length is delimited by DFM closing
+    # the connection.
+    def add_body(self, data):
+        if ('content-length' not in self.headers) and \
+           (self.headers.get('transfer-encoding', '').lower() == 'chunked') :
+            if (self.dechunker == None) :
+                self.dechunker = Dechunker()
+            if (self.dechunker.feed(data)) :
+                self.complete(self.dechunker.body())
+            return
+
+        self.chunks.append(data)
+        self.nbytes = self.nbytes + len(data)
+        if ('content-length' in self.headers) :
+            length = int(self.headers['content-length'])
+            if (self.nbytes < length) :
+                return
+            self.complete("".join(self.chunks)[:length])
+
+    def complete(self, body):
+        self.last_used = time.time()
+        connection = self.headers.get('connection', '').lower()
+        if (connection == 'close') or ((self.version == 'HTTP/1.0') and (connection != 'keep-alive')) :
+            self.shut()
+        if (self.status != 200) :
+            self.finish(fail_response(13001, "HTTP error " + str(self.status)), body)
+        else :
+            self.finish(parse_zapi_response(body, self.fields), body)
+
+    # A reused connection can be closed by DFM at any time, so retry once
+    # on a fresh connection before reporting the failure.
+    def fail(self, reason):
+        self.shut()
+        if (self.busy()) :
+            if (self.reused) and (self.attempt == 0) and (self.status == None) :
+                self.attempt = 1
+                self.send_request()
+                return
+            self.finish(fail_response(13001, "Unable to reach DFM " + self.engine.hostname + ": " + reason))
+
+    # Abandons the request, which ran past its deadline. DFM may still
+    # answer on the connection, so it is closed.
+    def expire(self):
+        self.shut()
+        self.finish(expired_response(self.engine.hostname))
+
+    # Hands output, and the raw response body if there was one, to the
+    # callback of the request
+    def finish(self, output, body=None):
+        callback = self.callback
+        self.callback = None
+        callback(output, body)
+        self.engine.dispatch()
+
+    def shut(self):
+        if (self.open) :
+            self.close()
+            self.open = False
+
+    def handle_close(self):
+        if (self.busy()) and (self.status != None) and \
+           ('content-length' not in self.headers) and ('transfer-encoding' not in self.headers) :
+            self.shut()
+            self.complete("".join(self.chunks))
+            return
+        self.fail("connection closed")
+
+    def handle_error(self):
+        (t, v, tb) = sys.exc_info()
+        self.fail(str(v))
+
+#
+# Decoder of a chunked HTTP body, fed the data as it is received. Only
+# the new data is parsed each time, so a large body costs no more than
+# one pass over it.
+#
+class Dechunker(object):
+    def __init__(self):
+        self.chunks = []
+        # Data not parsed yet: part of a chunk size line, or the trailers
+        self.pending = ""
+        # Bytes left of the current chunk, and of the CRLF that ends it
+        self.left = 0
+        self.skip = 0
+        # Whether the last (empty) chunk was seen
+        self.last = False
+
+    # @return True once the whole body is in
+    def feed(self, data):
+        if (len(self.pending) > 0) :
+            data = self.pending + data
+            self.pending = ""
+        pos = 0
+        while True :
+            if (self.left > 0) :
+                piece = data[pos:pos + self.left]
+                self.chunks.append(piece)
+                self.left = self.left - len(piece)
+                pos = pos + len(piece)
+                if (self.left > 0) :
+                    return False
+            if (self.skip > 0) :
+                n = min(self.skip, len(data) - pos)
+                self.skip = self.skip - n
+                pos = pos + n
+                if (self.skip > 0) :
+                    return False
+            if (self.last) :
+                # The last chunk is followed by optional trailers and CRLF
+                rest = data[pos:]
+                if (rest.startswith("\r\n")) or (rest.find("\r\n\r\n") >= 0) :
+                    return True
+                self.pending = rest
+                return False
+
+            end = data.find("\r\n", pos)
+            if (end < 0) :
+                self.pending = data[pos:]
+                return False
+            size = int(data[pos:end].split(";")[0], 16)
+            pos = end + 2
+            if (size == 0) :
+                self.last = True
+            else :
+                (self.left, self.skip) = (size, 2)
+
+    def body(self):
+        return "".join(self.chunks)
+
+#
+# Asynchronous collection engine (ENGINE = async). A single thread takes
+# filers off workq like the worker threads do and runs perf_mon() for up
+# to ASYNC_CONCURRENCY filers at a time, with the ZAPI requests of all of
+# them multiplexed over ASYNC_CONNECTIONS keep-alive connections to DFM.
+# Other threads can run blocking calls through it with AsyncServer.
+#
+class AsyncCollector(threading.Thread):
+    def __init__(self, workq, resultq, hostname, username, password, port,
+                 connections, concurrency, interval, max_idle):
+        super(AsyncCollector, self).__init__()
+        self.daemon = True
+        self.workq = workq
+        self.resultq = resultq
+        self.hostname = hostname
+        self.port = port
+        self.auth = "Basic " + base64.b64encode(username + ":" + password)
+        self.interval = interval
+        self.max_idle = max_idle
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.calls = Queue.Queue()
+        self.waiting = collections.deque()
+        self.map = {}
+        self.channels = [AsyncDfmChannel(self) for i in range(connections)]
+
+    def run(self):
+        next_evict = time.time() + self.interval
+        while True :
+            self.start_calls()
+            self.start_filers()
+            try :
+                asyncore.loop(0.05, False, self.map, 1)
+            except Exception:
+                logger.error("AsyncCollector: unexpected error", exc_info=1)
+            self.expire_calls()
+
+            # asyncore.loop() returns at once when no connection is open
+            if (len(self.map) == 0) :
+                time.sleep(0.05)
+
+            # Drop DFM connections that were not needed for a while
+            now = time.time()
+            if (now >= next_evict) :
+                for ch in self.channels :
+                    if (not ch.busy()) and (ch.idle_time() > self.max_idle) :
+                        ch.shut()
+                next_evict = now + self.interval
+
+    # Requests sent by AsyncServer on behalf of other threads
+    def start_calls(self):
+        while True :
+            try :
+                (req, timeout, reply) = self.calls.get_nowait()
+            except Queue.Empty:
+                return
+            self.submit(req, lambda output, body: reply.put((output, body)), timeout)
+
+    # Starts perf_mon() for due filers while there are free slots. A
+    # filer that waited on workq past its next slot is reported as
+    # skipped (1) without being collected.
+    def start_filers(self):
+        while (self.slots.acquire(False)) :
+            try :
+                (filer, due) = self.workq.get_nowait()
+            except Queue.Empty:
+                self.slots.release()
+                return
+
+            if (time.time() - due > self.interval) :
+                logger.warning("AsyncCollector: skipping stale sample of " + filer + ", ASYNC_CONCURRENCY filers were busy")
+                self.slots.release()
+                stats.collection(filer, None, 1)
+                self.resultq.put((1, filer))
+                continue
+
+            self.step(filer, ZapiTask(perf_mon(filer), filer), None)
+
+    # Runs the task of filer up to its next request
+    def step(self, filer, task, output):
+        try :
+            call = task.resume(output)
+        except Exception:
+            logger.error("AsyncCollector: unexpected error collecting " + filer, exc_info=1)
+            call = None
+            task.result = -1
+        timeout = None
+        if (call != None) :
+            timeout = task.timeout(call.req)
+            if (timeout == None) :
+                task.abandon()
+        if (timeout == None) :
+            self.slots.release()
+            err = task.outcome()
+            stats.collection(filer, time.time() - task.started, err)
+            if (capture != None) :
+                capture.collection(filer, task.started, time.time() - task.started, err)
+            self.resultq.put((err, filer))
+            return
+        start = time.time()
+        self.submit(call.req, lambda output, body: self.called(filer, task, call.req, timeout, start, output, body),
+                    timeout)
+
+    def called(self, filer, task, req, timeout, start, output, body):
+        task.called(req, timeout, time.time() - start, output, body)
+        self.step(filer, task, output)
+
+    # Queues req, to be done within timeout seconds (0 for no limit)
+    # from now, whether it has been sent by then or not
+    def submit(self, req, callback, timeout):
+        deadline = None
+        if (timeout > 0) :
+            deadline = time.time() + timeout
+        self.waiting.append((ZAPI_HEADER + req.toEncodedString() + ZAPI_FOOTER, response_fields(req),
+                             callback, deadline))
+        self.dispatch()
+
+    # Sends waiting requests on the free connections
+    def dispatch(self):
+        for ch in self.channels :
+            if (len(self.waiting) == 0) :
+                return
+            if (not ch.busy()) :
+                (content, fields, callback, deadline) = self.waiting.popleft()
+                ch.request(content, fields, callback, deadline)
+
+    # Abandons the requests that ran past their deadline, whether they
+    # were sent or are still waiting for a connection
+    def expire_calls(self):
+        now = time.time()
+        for ch in self.channels :
+            if (ch.busy()) and (ch.deadline != None) and (now >= ch.deadline) :
+                ch.expire()
+        expired = [item for item in self.waiting if (item[3] != None) and (now >= item[3])]
+        for item in expired :
+            self.waiting.remove(item)
+            item[2](expired_response(self.hostname), None)
+
+#
+# Blocking ZAPI calls run through the asynchronous engine, for use as
+# server_ctx by the main thread when ENGINE = async.
+#
+class AsyncServer(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.timeout = 0
+        # Raw response of the last call, None if it got none
+        self.body = None
+
+    # Like NaServer.set_timeout(), with 0 for no limit
+    def set_timeout(self, seconds):
+        self.timeout = seconds
+
+    def invoke(self, api, *args):
+        return self.invoke_elem(zapi_elem(api, *args))
+
+    def invoke_elem(self, req):
+        reply = Queue.Queue()
+        self.engine.calls.put((req, self.timeout, reply))
+        (output, self.body) = reply.get()
+        return output
+
+#
+# Answers the calls of a captured collection (CAPTURE_FILE) with their
+# responses, in the order they were made, for replay(). Responses are
+# parsed as DfmConnection parses them. With paced each call takes as long
+# as it did when it was captured.
+#
+class ReplayServer(object):
+    def __init__(self, calls, paced):
+        self.calls = collections.deque(calls)
+        self.paced = paced
+        # Calls answered, requests that differ from the captured ones,
+        # and seconds spent parsing responses by API
+        self.answered = 0
+        self.diverged = 0
+        self.seconds = {}
+
+    def invoke_elem(self, req):
+        api = req.element["name"]
+        if (len(self.calls) == 0) :
+            return fail_response(13001, "Replay: no " + api + " call left in the capture")
+        (name, request, started, seconds, body) = self.calls.popleft()
+        if (name != api) :
+            return fail_response(13001, "Replay: " + api + " call where the capture has " + name)
+        self.answered = self.answered + 1
+        if (req.toEncodedString() != request) :
+            self.diverged = self.diverged + 1
+
+        start = time.time()
+        if (body == None) :
+            output = fail_response(13001, "Replay: no response was captured")
+        else :
+            output = parse_zapi_response(body, response_fields(req))
+        elapsed = time.time() - start
+        self.seconds[api] = self.seconds.get(api, 0.0) + elapsed
+        if (self.paced) and (seconds > elapsed) :
+            time.sleep(seconds - elapsed)
+        return output
+
+#
+# Replays the collections of the capture file at path through perf_mon(),
+# as fast as possible or, with paced, starting each at the time it had
+# in the capture, and prints how long they took.
+# @return 0, or 1 if the capture could not be read
+#
+def replay(path, paced):
+    # (filer, captured result, replayed result, seconds, server) of each
+    # collection replayed
+    replayed = []
+
+    def collect(filer, result, calls):
+        if (filer not in filerDataDict) :
+            filerDataDict[filer] = FilerData()
+        # Fetch the topology of the filer when the capture did, whatever
+        # its age
+        topo = topology.get(filer)
+        if ("aggregate-list-info-iter-start" in [call[0] for call in calls]) :
+            topology.invalidate(filer)
+        elif (topo.refreshed > 0) :
+            topo.refreshed = time.time()
+        server = ReplayServer(calls, paced)
+        start = time.time()
+        try :
+            err = zapi_run(perf_mon(filer), server, filer)
+        except:
+            logger.error("replay(): unexpected error replaying " + filer, exc_info=1)
+            err = -1
+        replayed.append((filer, result, err, time.time() - start, server))
+
+    threads = []
+    first = None
+    last = (None, None)
+    start = time.time()
+    try :
+        for (filer, started, seconds, result, calls, run, refreshes) in ontapcapture.read_collections(path) :
+            # Start over like ontapmon.py did when it was restarted, and
+            # try batching again after each filer list as it does
+            if (run != last[0]) :
+                for thread in threads :
+                    thread.join()
+                for f in filerDataDict.keys() :
+                    topology.remove(f)
+                    del filerDataDict[f]
+            elif (refreshes != last[1]) :
+                for f in filerDataDict.keys() :
+                    with_filer_lock(f, setattr, filerDataDict[f], "aggrBatchOk", True)
+            last = (run, refreshes)
+
+            if (not paced) :
+                collect(filer, result, calls)
+                continue
+            # Collections of different filers overlapped, so each runs
+            # in a thread of its own
+            if (first == None) :
+                first = started
+            delay = start + (started - first) - time.time()
+            if (delay > 0) :
+                time.sleep(delay)
+            thread = threading.Thread(target=collect, args=(filer, result, calls))
+            thread.start()
+            threads.append(thread)
+    except (IOError, ontapcapture.CaptureError), e:
+        logger.error("replay(): unable to read capture " + path + ": " + str(e))
+        print("Unable to read capture " + path + ": " + str(e))
+        return 1
+    finally :
+        for thread in threads :
+            thread.join()
+    elapsed = time.time() - start
+
+    filers = set([r[0] for r in replayed])
+    calls = sum([r[4].answered for r in replayed])
+    print("replayed %d collections of %d filers (%d calls) in %.3f s" %(len(replayed), len(filers), calls, elapsed))
+    if (len(replayed) == 0) :
+        return 0
+    print("collection time: %.4f s mean, %.4f s max" %(sum([r[3] for r in replayed]) / len(replayed),
+                                                     max([r[3] for r in replayed])))
+    print("results differing from the capture: %d, requests differing: %d" %(
+        len([r for r in replayed if r[1] != r[2]]), sum([r[4].diverged for r in replayed])))
+    totals = {}
+    for r in replayed :
+        for (api, seconds) in r[4].seconds.items() :
+            totals[api] = totals.get(api, 0.0) + seconds
+    for api in sorted(totals.keys()) :
+        print("parse time of %s responses: %.3f s" %(api, totals[api]))
+    return 0
+
+
+#
+# MAIN 
+#
+
+if __name__ == '__main__':
+    # get args
+    args = len(sys.argv) - 1
+    if(args < 1):
+        usage()
+
+    # Replay of a CAPTURE_FILE instead of collection from DFM
+    replay_file = None
+    paced = False
+    if (args > 1) :
+        if (args > 4) or (sys.argv[2] != "--replay") or (args == 2) or ((args == 4) and (sys.argv[4] != "--paced")) :
+            usage()
+        replay_file = sys.argv[3]
+        paced = (args == 4)
+
+    # Read config.ini file
+    parser = SafeConfigParser()
+    parser.read(sys.argv[1])
+    # ZAPI client: the NMSDK from NMDKDIR, or the built-in one which
+    # does not need the NMSDK
+    client = config_get('dfm_param', 'CLIENT', 'nmsdk').lower()
+    if (client == 'builtin') :
+        from ontapzapi import ZapiElement as NaElement
+    else :
+        nmdkpath = parser.get('env_params', 'NMDKDIR')
+        sys.path.append(nmdkpath + "/lib/python/NetApp")
+        from NaServer import *
+
+    # Get the parameters from config.ini
+    dfmserver = parser.get('dfm_param', 'HOST')
+    dfmuser = parser.get('dfm_param', 'USER')
+    dfmpw = parser.get('dfm_param', 'PASSWD')
+    dfmport = int(config_get('dfm_param', 'PORT', DFM_PORT))
+    keepalive = config_get('dfm_param', 'KEEPALIVE', 'yes').lower() in ('yes', 'true', '1')
+    max_idle = float(config_get('dfm_param', 'MAX_IDLE', 120))
+    interval = float(parser.get('mon_param', 'INTERVAL'))
+    dirloc = parser.get('mon_param', 'DIRLOC')
+    nthreads = int(parser.get('mon_param', 'NTHREADS'))
+    refresh = int(parser.get('mon_param', 'REFRESH'))
+    engine = config_get('mon_param', 'ENGINE', 'threads').lower()
+    async_connections = int(config_get('mon_param', 'ASYNC_CONNECTIONS', nthreads))
+    async_concurrency = int(config_get('mon_param', 'ASYNC_CONCURRENCY', 100))
+    aggr_batch = int(config_get('mon_param', 'AGGR_BATCH', 10))
+    vol_page = max(int(config_get('mon_param', 'VOL_PAGE', 1000)), VOL_PAGE_MIN)
+    vol_page_latency = float(config_get('mon_param', 'VOL_PAGE_LATENCY', 10))
+    topology_max_age = float(config_get('mon_param', 'TOPOLOGY_REFRESH', 3600))
+    evict_after = max(int(config_get('mon_param', 'EVICT_AFTER', 3)), 1)
+    breaker_threshold = max(int(config_get('mon_param', 'BREAKER_THRESHOLD', 3)), 1)
+    backoff_max = float(config_get('mon_param', 'BACKOFF_MAX', 900))
+    metrics_file = config_get('mon_param', 'METRICS_FILE', '')
+    snapshot = config_get('mon_param', 'SNAPSHOT', 'no').lower() in ('yes', 'true', '1')
+    history = int(config_get('mon_param', 'HISTORY', 0))
+    shards = int(config_get('mon_param', 'SHARDS', 1))
+    interval_min = float(config_get('mon_param', 'INTERVAL_MIN', interval))
+    interval_max = float(config_get('mon_param', 'INTERVAL_MAX', interval))
+    diskbusy_watermark = float(config_get('mon_param', 'DISKBUSY_WATERMARK', 40))
+    latency_watermark = float(config_get('mon_param', 'LATENCY_WATERMARK', 8))
+    change_watermark = float(config_get('mon_param', 'CHANGE_WATERMARK', 0.25))
+    request_budget = float(config_get('mon_param', 'REQUEST_BUDGET', 0))
+    write_heartbeat = float(config_get('mon_param', 'WRITE_HEARTBEAT', 0))
+    write_epsilon = config_get('mon_param', 'WRITE_EPSILON', '', True)
+    fleet_index = config_get('mon_param', 'FLEET_INDEX', 'no').lower() in ('yes', 'true', '1')
+    notify_socket = config_get('mon_param', 'NOTIFY_SOCKET', '')
+    http_port = int(config_get('mon_param', 'HTTP_PORT', 0))
+    http_address = config_get('mon_param', 'HTTP_ADDRESS', '127.0.0.1')
+    capture_file = config_get('mon_param', 'CAPTURE_FILE', '')
+    call_deadline_spec = config_get('mon_param', 'CALL_DEADLINE', CALL_DEADLINE)
+    collection_deadline = float(config_get('mon_param', 'COLLECTION_DEADLINE', 0))
+    domain_counters = [label.strip() for label in config_get('mon_param', 'DOMAIN_COUNTERS', DOMAIN_COUNTERS).split(",")
+                       if label.strip() != ""]
+
+    # Set up logger file for errors
+    set_log_file(dirloc + "/ontapmon_error.log")
+
+    # The built-in client has no NaServer to fall back on
+    if (client == 'builtin') and (not keepalive) :
+        logger.warning("KEEPALIVE = no needs CLIENT = nmsdk, keeping DFM connections open")
+        keepalive = True
+
+    write_epsilons = parse_epsilons(write_epsilon)
+    if (write_epsilons == -1) :
+        sys.exit(1)
+
+    call_deadlines = parse_deadlines(call_deadline_spec)
+    if (call_deadlines == -1) :
+        sys.exit(1)
+
+    if (len(domain_counters) == 0) :
+        logger.error("main(): DOMAIN_COUNTERS has no domains")
+        sys.exit(1)
+    if (len(domain_counters) > DOMAIN_SIZE) :
+        logger.warning("DOMAIN_COUNTERS has %d domains, the LSF plugin only checks the first %d"
+                       %(len(domain_counters), DOMAIN_SIZE))
+
+    # Requests sent for every filer in every interval
+    domainperf_request = domainperf_template(domain_counters)
+    (aggrperf_request, aggrperf_instance) = aggrperf_templates()
+    volstart_request = proxy_template("volume-list-info-iter-start")
+    volnext_request = proxy_template("volume-list-info-iter-next", "tag", "maximum")
+    volend_request = proxy_template("volume-list-info-iter-end", "tag")
+
+    # Raw ZAPI calls are captured once the process that collects is known
+    capture = None
+
+    # Worker threads, stopped on SIGTERM
+    workers = []
+
+    # Set up signal handler
+    signal.signal(signal.SIGTERM, signal_handler_term)
+
+    #Define the Filer Data Dictionary to hold filer/volume data
+    filerDataDict = {}
+
+    # Aggregate lists, volume to aggregate mapping and IP addresses of filers
+    topology = TopologyCache(topology_max_age)
+
+    # A replay writes its output files to a directory of its own, never
+    # over the live ones that the LSF plugin reads from DIRLOC
+    if (replay_file != None) :
+        dirloc = tempfile.mkdtemp(prefix="ontapmon-replay-")
+
+    # Ring buffers of the recent samples of each filer
+    rings = {}
+    if (history > 0) and (not os.path.isdir(dirloc + "/history")) :
+        os.mkdir(dirloc + "/history")
+
+    # Replay the collections of a capture and stop, with nothing announced
+    # or served, and drop what it wrote
+    if (replay_file != None) :
+        (fleet_writer, notifier, published) = (None, None, None)
+        try :
+            rc = replay(replay_file, paced)
+        finally :
+            for ring in rings.values() :
+                ring.close()
+            shutil.rmtree(dirloc, True)
+        sys.exit(rc)
+
+    # With SHARDS > 1 this process only hands out the filer list from here
+    # on, and the shards it forks carry on below with their own filers.
+    shard = None
+    if (shards > 1) :
+        if (keepalive) :
+            coordinator_ctx = DfmConnection(dfmserver, dfmuser, dfmpw, dfmport)
+        else :
+            coordinator_ctx = construct_server(dfmserver, dfmuser, dfmpw, dfmport)
+        (shard, shard_fd) = ShardCoordinator(shards, coordinator_ctx, interval, refresh, backoff_max).run()
+        set_log_file(dirloc + "/ontapmon_error.shard%d.log" %(shard))
+        if (metrics_file != "") :
+            (root, ext) = os.path.splitext(metrics_file)
+            metrics_file = root + ".shard%d" %(shard) + ext
+
+    # Index of the XML documents of all filers (of this shard)
+    fleet_writer = None
+    if (fleet_index) :
+        if (shard != None) :
+            fleet_writer = ontapfleet.FleetIndexWriter(dirloc + "/fleet.shard%d.idx" %(shard))
+        else :
+            fleet_writer = ontapfleet.FleetIndexWriter(dirloc + "/fleet.idx")
+
+    # Socket the subscribers are told of new data on
+    notifier = None
+    if (notify_socket != "") :
+        if (shard != None) :
+            notify_socket = notify_socket + ".shard%d" %(shard)
+        try :
+            notifier = ontapnotify.Publisher(notify_socket)
+        except socket.error:
+            logger.error("main(): unable to listen on NOTIFY_SOCKET " + notify_socket, exc_info=1)
+            sys.exit(1)
+        notifier.start()
+
+    # Data of the filers as last collected, for the query server
+    published = None
+    if (http_port != 0) :
+        if (shard != None) :
+            http_port = http_port + shard
+        published = {}
+        try :
+            ontaphttp.QueryServer(http_address, http_port, published).start()
+        except socket.error:
+            logger.error("main(): unable to serve queries on %s port %d" %(http_address, http_port), exc_info=1)
+            sys.exit(1)
+
+    # Capture of the raw ZAPI calls, which NaServer does not hand out
+    if (capture_file != "") :
+        if (not keepalive) and (engine != 'async') :
+            logger.warning("CAPTURE_FILE needs KEEPALIVE = yes or ENGINE = async, not capturing")
+        else :
+            if (shard != None) :
+                (root, ext) = os.path.splitext(capture_file)
+                capture_file = root + ".shard%d" %(shard) + ext
+            try :
+                capture = ontapcapture.CaptureWriter(capture_file)
+            except IOError:
+                logger.error("main(): unable to open CAPTURE_FILE " + capture_file, exc_info=1)
+                sys.exit(1)
+
+    # Worker threads (or the asynchronous engine) live for the whole run and
+    # take filers off workq whenever the scheduler finds them due.
     workq = Queue.Queue()
     resultq = Queue.Queue()
-    ntimes = 0
-    nwork = len(flist_arr)
-    nthr = nthreads
-    # Initialize workq with filers to process
-    for f in flist_arr:
-        workq.put(f)
-
-    # Work on current list of filers for specified number of times
-    # After ntimes, refresh list of filers
-    while (ntimes < refresh):
-        # Do not create more threads then there are number of filers on workq
-        if (nwork < nthreads) : 
-            nthr = nwork
-        pool = [WorkerThread(workq=workq, resultq=resultq, dfm_hostname=dfmserver, username=dfmuser, password=dfmpw) for i in range(nthr)]
-        # Start the threads
-        for t in pool :
-            t.start()
-            
-        # Wait for the threads to process all the items in workq
-        for t in pool :
-            t.join()
-
-        ntimes = ntimes + 1
-        succ = 0
-        while nwork > 0 : 
-            result = resultq.get()
-            # If no errors and able to get information 
-            # from filers, add to workq else skip it
-            if (result[0] == 0) :
-                workq.put(result[1])
-                succ = succ + 1
-            nwork = nwork - 1
-        
-        # reset number of work to do
-        nwork = succ
-
-        # sleep for specified number of seconds
-        time.sleep(interval)
+    if (engine == 'async') :
+        collector = AsyncCollector(workq, resultq, dfmserver, dfmuser, dfmpw, dfmport,
+                                   async_connections, async_concurrency, interval, max_idle)
+        collector.start()
+        server_ctx = AsyncServer(collector)
+        pool = None
+    else :
+        # Creating a server object and setting appropriate attributes
+        if (keepalive) :
+            server_ctx = DfmConnection(dfmserver, dfmuser, dfmpw, dfmport)
+        else :
+            server_ctx = construct_server(dfmserver, dfmuser, dfmpw, dfmport)
+
+        # DFM connections shared by the worker threads, one per thread
+        pool = DfmConnectionPool(dfmserver, dfmuser, dfmpw, dfmport, nthreads, max_idle, keepalive)
+        for i in range(nthreads) :
+            workers.append(WorkerThread(workq=workq, resultq=resultq, pool=pool, interval=interval))
+            workers[-1].start()
+
+    scheduler = FilerScheduler(interval, breaker_threshold, backoff_max, interval_min, interval_max,
+                               (diskbusy_watermark, latency_watermark), change_watermark, request_budget)
+
+    # The filer list is fetched in the background so that collection
+    # goes on while DFM answers.
+    if (shard != None) :
+        refresher = ShardFeed(shard_fd, shard, resultq)
+    else :
+        refresher = RefreshThread(server_ctx, resultq)
+    refresher.start()
+    next_refresh = 0.0
+    refreshing = False
+    flist_arr = None
+
+    # Number of the last filer list refresh each filer was listed in.
+    # XML files left from an earlier run count as listed before the
+    # first refresh, so they are removed if their filer does not return.
+    refreshes = 0
+    lastListed = {}
+    for name in os.listdir(dirloc) :
+        if (name.endswith(".xml")) :
+            lastListed[name[:-len(".xml")]] = 0
+
+    next_evict = time.time() + interval
+
+    while True : 
+    
+        now = time.time()
+
+        # Refresh the list of filers every REFRESH intervals
+        if (now >= next_refresh) and (not refreshing) :
+            refresher.request()
+            refreshing = True
+            next_refresh = now + refresh * interval
+
+        # A new filer list came back from the refresh thread
+        if (flist_arr != None) :
+            # If unable to get list of filers or there is no filers being
+            # managed by DFM, keep going with the current list and recheck
+            # after the specified interval
+            if (flist_arr == -1) :
+                logger.error("No filers to process")
+                next_refresh = now + interval
+            else :
+                # Only the changes to the list are applied: added filers
+                # get their data, and their topology and IP addresses are
+                # fetched by the workers on their first collection. The
+                # other filers go on with their schedules.
+                listed = set(flist_arr)
+                added = [f for f in flist_arr if f not in scheduler.filers]
+                removed = [f for f in scheduler.filers if f not in listed]
+                if (len(added) > 0) or (len(removed) > 0) :
+                    logger.info("main(): filer list refreshed, %d added, %d removed" %(len(added), len(removed)))
+
+                for f in added :
+                    if (f not in filerDataDict) :
+                        filerDataDict[f] = FilerData()
+                for f in flist_arr :
+                    # Give batching another try after each refresh
+                    with_filer_lock(f, setattr, filerDataDict[f], "aggrBatchOk", True)
+
+                # New filers are started with their first samples spread
+                # over one interval, removed ones are no longer scheduled.
+                scheduler.set_filers(flist_arr, now)
+
+                # Remove the filers missing from the last EVICT_AFTER
+                # lists once they are no longer being collected
+                refreshes = refreshes + 1
+                for f in flist_arr :
+                    lastListed[f] = refreshes
+                for f in lastListed.keys() :
+                    if (f in scheduler.inflight) :
+                        continue
+                    if (lastListed[f] < refreshes) and (refresher.in_fleet(f)) :
+                        # Moved to another shard, which writes its files now
+                        forget_filer(f)
+                        del lastListed[f]
+                    elif (lastListed[f] <= refreshes - evict_after) :
+                        evict_filer(f)
+                        del lastListed[f]
+            flist_arr = None
+
+        # Hand the filers that are due to the workers
+        for item in scheduler.pop_due(now) :
+            workq.put(item)
+
+        # Drop DFM connections that were not needed for a while and
+        # write out the fleet index and the metrics
+        if (now >= next_evict) :
+            if (pool != None) :
+                pool.evict_idle()
+            if (fleet_writer != None) :
+                update_fleet_index()
+            if (capture != None) :
+                capture.flush()
+            scheduler.rebudget(stats.calls_per_collection())
+            if (metrics_file != "") :
+                stats.export(metrics_file, workq, scheduler, notifier)
+            next_evict = now + interval
+
+        # Wait for results until the next filer is due. Wake up at least once
+        # a second so that signals are handled.
+        wakeup = next_refresh
+        next_due = scheduler.next_due()
+        if (next_due != None) and (next_due < wakeup) :
+            wakeup = next_due
+        try :
+            result = resultq.get(True, min(max(wakeup - time.time(), 0.0), 1.0))
+        except Queue.Empty:
+            continue
 
-     
+        while True :
+            (err, filer) = result
+            if (err == FLIST_DONE) :
+                # filer is the new list, applied at the top of the loop
+                flist_arr = filer
+                refreshing = False
+            else :
+                # If no errors and able to get information from filer, schedule
+                # its next sample, else retry it or back off (see FilerScheduler)
+                if (err == 0) and (scheduler.adaptive()) and (filer in filerDataDict) :
+                    scheduler.adapt(filer, with_filer_lock(filer, filer_load, filerDataDict[filer]))
+                skipped = scheduler.done(filer, err not in (-1, DEADLINE), time.time(), err == DEADLINE)
+                if (skipped > 0) :
+                    logger.warning("main(): collection of " + filer + " overran INTERVAL, skipped %d sample(s)" %(skipped))
+                    stats.skipped.inc(amount=skipped)
+            try :
+                result = resultq.get_nowait()
+            except Queue.Empty:
+                break
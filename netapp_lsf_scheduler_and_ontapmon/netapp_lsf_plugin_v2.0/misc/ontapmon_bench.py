@@ -0,0 +1,115 @@
+#===============================================================#
+#                                                               #
+# $ID$                                                          #
+#                                                               #
+# ontapmon_bench.py - Benchmark of the per filer XML output of  #
+#               ontapmon.py. Fills ontapmon's filer data with   #
+#               synthetic aggregates and volumes and times the  #
+#               streaming writer used by printToXML() against   #
+#               the minidom document and toprettyxml() path,    #
+#               after checking both give the same bytes.        #
+#                                                               #
+#               Usage: ontapmon_bench.py [aggrs] [vols] [runs]  #
+#                                                               #
+#               aggrs = aggregates per filer (default 20)       #
+#               vols  = volumes per aggregate (default 200)     #
+#               runs  = writes timed per path (default 10)      #
+#                                                               #
+# Copyright (c) 2012 NetApp, Inc. All rights reserved.          #
+# Specifications subject to change without notice.              #
+#                                                               #
+#===============================================================#
+
+import sys
+import os
+import re
+import time
+import shutil
+import tempfile
+import ontapmon
+
+#
+# Fills ontapmon.filerDataDict and ontapmon.topology for one filer
+#
+def make_filer(f, naggrs, nvols):
+    fdata = ontapmon.FilerData()
+    for i in range(naggrs) :
+        aggr = ontapmon.AggrData()
+        aggr.maxdiskb = 37.5 + i
+        for j in range(nvols) :
+            vol = ontapmon.VolumeData()
+            vol.avglatency = 0.125 * j
+            vol.availSize = 1000000 * j
+            vol.availInodes = 1000 + j
+            aggr.volumeDataDict["vol%d_%d" %(i, j)] = vol
+        fdata.aggrDataDict["aggr%d" %(i)] = aggr
+    for d in ("raid", "target", "kahuna", "storage", "nwk_legacy", "cifs") :
+        dom = ontapmon.DomainData()
+        dom.dvalue = 42.0
+        fdata.domainDataDict[d] = dom
+    ontapmon.filerDataDict[f] = fdata
+
+    ontapmon.topology.get(f).ipAddr = ["10.0.0.1", "10.0.0.2"]
+
+def minidom_write(f):
+    fp = open(ontapmon.dirloc + "/" + f + ".xml", "w")
+    fp.write(ontapmon.to_pretty_xml(ontapmon.filer_doc(f)))
+    fp.close()
+
+def stream_write(f):
+    ontapmon.printToXML(f)
+
+def read_output(f):
+    fp = open(ontapmon.dirloc + "/" + f + ".xml")
+    data = fp.read()
+    fp.close()
+    # lastUpdated changes between writes
+    return re.sub("<lastUpdated>.*</lastUpdated>", "", data)
+
+def timeit(write, f, runs):
+    best = None
+    for i in range(runs) :
+        start = time.time()
+        write(f)
+        elapsed = time.time() - start
+        if (best == None) or (elapsed < best) :
+            best = elapsed
+    return best
+
+#
+# MAIN
+#
+if __name__ == '__main__':
+    naggrs = 20
+    nvols = 200
+    runs = 10
+    if (len(sys.argv) > 1) :
+        naggrs = int(sys.argv[1])
+    if (len(sys.argv) > 2) :
+        nvols = int(sys.argv[2])
+    if (len(sys.argv) > 3) :
+        runs = int(sys.argv[3])
+
+    ontapmon.dirloc = tempfile.mkdtemp()
+    ontapmon.filerDataDict = {}
+    ontapmon.topology = ontapmon.TopologyCache(3600)
+    make_filer("bench", naggrs, nvols)
+
+    try :
+        minidom_write("bench")
+        expected = read_output("bench")
+        stream_write("bench")
+        if (read_output("bench") != expected) :
+            print("FAILED: streaming writer output differs from minidom output")
+            sys.exit(1)
+
+        size = os.path.getsize(ontapmon.dirloc + "/bench.xml")
+        tmini = timeit(minidom_write, "bench", runs)
+        tstream = timeit(stream_write, "bench", runs)
+    finally :
+        shutil.rmtree(ontapmon.dirloc)
+
+    print("%d aggregates x %d volumes, %d bytes, best of %d runs" %(naggrs, nvols, size, runs))
+    print("minidom + toprettyxml: %8.2f ms" %(tmini * 1000))
+    print("streaming writer:      %8.2f ms" %(tstream * 1000))
+    print("speedup:               %8.1fx" %(tmini / tstream))
@@ -0,0 +1,356 @@
+#===============================================================#
+#                                                               #
+# $ID$                                                          #
+#                                                               #
+# ontapmon_loadbench.py - Load test of ontapmon.py against the  #
+#               simulated DFM server of dfmsim.py. Starts the   #
+#               simulator and ontapmon.py with a config.ini in  #
+#               a temporary directory, lets them run, and       #
+#               reports from METRICS_FILE and /proc:            #
+#                       - time until every filer had its first  #
+#                         XML file written                      #
+#                       - collections per second during that    #
+#                         first pass and after it               #
+#                       - collection and ZAPI call latencies    #
+#                       - resident set size of ontapmon.py, and #
+#                         of its shards with --shards           #
+#                                                               #
+#               Usage: ontapmon_loadbench.py -n <NMDKDIR>       #
+#                       [options], see ontapmon_loadbench.py -h #
+#                                                               #
+#               Only NaElement of the NMSDK is used, as calls   #
+#               go through ontapmon's own DFM connections, and  #
+#               with --client builtin the NMSDK is not needed.  #
+#                                                               #
+# Copyright (c) 2012 NetApp, Inc. All rights reserved.          #
+# Specifications subject to change without notice.              #
+#                                                               #
+#===============================================================#
+
+import sys
+import os
+import re
+import time
+import shutil
+import signal
+import socket
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+MISC = os.path.dirname(os.path.abspath(__file__))
+
+SAMPLE_LINE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+
+#
+# Parses a Prometheus text file written by ontapmon.py.
+# @return dict of (name, labels) to value
+#
+def read_metrics(path):
+    values = {}
+    try :
+        fp = open(path)
+    except IOError:
+        return values
+    try :
+        for line in fp :
+            m = SAMPLE_LINE.match(line.strip())
+            if (m != None) :
+                values[(m.group(1), m.group(2) or "")] = float(m.group(3))
+    finally :
+        fp.close()
+    return values
+
+#
+# Reads the metrics files of ontapmon.py, one per shard with SHARDS.
+# @return dict of file name to the values in the file
+#
+def read_all_metrics(dirloc):
+    files = {}
+    for name in os.listdir(dirloc) :
+        if (name.startswith("metrics") and name.endswith(".prom")) :
+            files[name] = read_metrics(dirloc + "/" + name)
+    return files
+
+# @return the values of all files added up, for counters and histograms
+def merge_metrics(files):
+    merged = {}
+    for values in files.values() :
+        for (k, v) in values.items() :
+            merged[k] = merged.get(k, 0) + v
+    return merged
+
+def metric_sum(values, name):
+    return sum([values[k] for k in values if k[0] == name])
+
+#
+# Estimates a quantile of a histogram from its cumulative buckets, as
+# the upper bound of the bucket the quantile falls in.
+#
+def quantile(values, name, q, label=""):
+    buckets = []
+    for (k, v) in values.items() :
+        if (k[0] != name + "_bucket") :
+            continue
+        labels = k[1]
+        m = re.search(r'le="([^"]+)"', labels)
+        if (re.sub(r',?le="[^"]+"', "", labels) != label) :
+            continue
+        buckets.append((float(m.group(1).replace("+Inf", "inf")), v))
+    buckets.sort()
+    if (len(buckets) == 0) or (buckets[-1][1] == 0) :
+        return None
+    total = buckets[-1][1]
+    for (bound, count) in buckets :
+        if (count >= q * total) :
+            return bound
+    return None
+
+#
+# @return dict of the fields of /proc/<pid>/status in kB, e.g. VmRSS
+#
+def proc_status(pid):
+    fields = {}
+    try :
+        fp = open("/proc/%d/status" %(pid))
+    except IOError:
+        return fields
+    try :
+        for line in fp :
+            parts = line.split()
+            if (len(parts) == 3) and (parts[2] == "kB") :
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    finally :
+        fp.close()
+    return fields
+
+#
+# @return CPU seconds used by a process so far
+#
+def cpu_seconds(pid):
+    try :
+        fp = open("/proc/%d/stat" %(pid))
+    except IOError:
+        return 0.0
+    try :
+        fields = fp.read().rsplit(")", 1)[1].split()
+    finally :
+        fp.close()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+#
+# @return pid and the pids of the processes started by pid, e.g. the
+# shards of ontapmon.py
+#
+def process_tree(pid):
+    pids = [pid]
+    for name in os.listdir("/proc") :
+        if (not name.isdigit()) :
+            continue
+        try :
+            fp = open("/proc/" + name + "/stat")
+            try :
+                ppid = int(fp.read().rsplit(")", 1)[1].split()[1])
+            finally :
+                fp.close()
+        except (IOError, IndexError, ValueError):
+            continue
+        if (ppid == pid) :
+            pids.append(int(name))
+    return pids
+
+def tree_status(pids, field):
+    return sum([proc_status(pid).get(field, 0) for pid in pids])
+
+def wait_for_port(port, timeout):
+    deadline = time.time() + timeout
+    while (time.time() < deadline) :
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try :
+            try :
+                s.connect(("127.0.0.1", port))
+                return True
+            except socket.error:
+                time.sleep(0.1)
+        finally :
+            s.close()
+    return False
+
+def write_config(path, options, dirloc):
+    fp = open(path, "w")
+    fp.write("[env_params]\n")
+    if (options.nmsdk != None) :
+        fp.write("NMDKDIR = %s\n" %(options.nmsdk))
+    fp.write("[dfm_param]\n")
+    fp.write("HOST = 127.0.0.1\n")
+    fp.write("USER = admin\n")
+    fp.write("PASSWD = admin\n")
+    fp.write("PORT = %d\n" %(options.port))
+    fp.write("CLIENT = %s\n" %(options.client))
+    fp.write("[mon_param]\n")
+    fp.write("INTERVAL = %g\n" %(options.interval))
+    fp.write("DIRLOC = %s\n" %(dirloc))
+    fp.write("NTHREADS = %d\n" %(options.threads))
+    fp.write("REFRESH = 1000000\n")
+    fp.write("ENGINE = %s\n" %(options.engine))
+    fp.write("ASYNC_CONCURRENCY = %d\n" %(options.concurrency))
+    fp.write("SHARDS = %d\n" %(options.shards))
+    fp.write("METRICS_FILE = %s\n" %(dirloc + "/metrics.prom"))
+    fp.close()
+
+def count_xml(dirloc):
+    return len([name for name in os.listdir(dirloc) if name.endswith(".xml")])
+
+def stop(proc):
+    if (proc.poll() == None) :
+        os.kill(proc.pid, signal.SIGTERM)
+        deadline = time.time() + 5
+        while (proc.poll() == None) and (time.time() < deadline) :
+            time.sleep(0.1)
+        if (proc.poll() == None) :
+            os.kill(proc.pid, signal.SIGKILL)
+            proc.wait()
+
+def option_parser():
+    parser = OptionParser(usage="%prog -n NMDKDIR [options] or %prog --client builtin [options]")
+    parser.add_option("-n", "--nmsdk", help="directory of netapp-manageability-sdk-5.0 (NMDKDIR)")
+    parser.add_option("--client", default="nmsdk", help="CLIENT of ontapmon (nmsdk or builtin)")
+    parser.add_option("-f", "--filers", type="int", default=100, help="number of filers (default 100)")
+    parser.add_option("-a", "--aggrs", type="int", default=3, help="aggregates per filer (default 3)")
+    parser.add_option("-v", "--vols", type="int", default=20, help="volumes per aggregate (default 20)")
+    parser.add_option("-l", "--latency", type="float", default=5.0,
+                      help="milliseconds the simulator adds to every call (default 5)")
+    parser.add_option("-e", "--error-rate", type="float", default=0.0,
+                      help="fraction of calls that fail in the simulator")
+    parser.add_option("-s", "--seconds", type="float", default=60.0, help="seconds to run (default 60)")
+    parser.add_option("-i", "--interval", type="float", default=30.0,
+                      help="INTERVAL of ontapmon (default 30)")
+    parser.add_option("--engine", default="threads", help="ENGINE of ontapmon (threads or async)")
+    parser.add_option("-t", "--threads", type="int", default=10, help="NTHREADS of ontapmon (default 10)")
+    parser.add_option("-c", "--concurrency", type="int", default=100,
+                      help="ASYNC_CONCURRENCY of ontapmon (default 100)")
+    parser.add_option("--shards", type="int", default=1, help="SHARDS of ontapmon (default 1)")
+    parser.add_option("-p", "--port", type="int", default=18088, help="port of the simulator (default 18088)")
+    parser.add_option("-k", "--keep", action="store_true", default=False,
+                      help="keep the temporary directory with the logs and XML files")
+    return parser
+
+#
+# MAIN
+#
+if __name__ == '__main__':
+    parser = option_parser()
+    (options, args) = parser.parse_args()
+    if (options.nmsdk == None) and (options.client != "builtin") :
+        parser.error("NMDKDIR is required (-n) unless --client builtin is used")
+
+    tmpdir = tempfile.mkdtemp(prefix="ontapmon_loadbench.")
+    dirloc = tmpdir + "/out"
+    os.mkdir(dirloc)
+    config = tmpdir + "/config.ini"
+    write_config(config, options, dirloc)
+
+    simlog = open(tmpdir + "/dfmsim.log", "w")
+    sim = subprocess.Popen([sys.executable, MISC + "/dfmsim.py", "--port", str(options.port),
+                            "--filers", str(options.filers), "--aggrs", str(options.aggrs),
+                            "--vols", str(options.vols), "--latency", str(options.latency),
+                            "--error-rate", str(options.error_rate)],
+                           stdout=simlog, stderr=subprocess.STDOUT)
+    mon = None
+    try :
+        if (not wait_for_port(options.port, 10)) :
+            print("FAILED: dfmsim.py did not start, see " + tmpdir + "/dfmsim.log")
+            options.keep = True
+            sys.exit(1)
+
+        monlog = open(tmpdir + "/ontapmon.out", "w")
+        start = time.time()
+        mon = subprocess.Popen([sys.executable, MISC + "/ontapmon.py", config],
+                               cwd=tmpdir, stdout=monlog, stderr=subprocess.STDOUT)
+
+        firstPass = None
+        steady = None
+        peak = 0
+        while (time.time() - start < options.seconds) and (mon.poll() == None) :
+            time.sleep(0.5)
+            pids = process_tree(mon.pid)
+            peak = max(peak, tree_status(pids, "VmRSS"))
+            if (firstPass == None) and (count_xml(dirloc) >= options.filers) :
+                firstPass = time.time() - start
+                # The metrics written after the first pass are the start of
+                # the steady state window
+                steady = read_all_metrics(dirloc)
+        pids = process_tree(mon.pid)
+        rss = tree_status(pids, "VmRSS")
+        hwm = tree_status(pids, "VmHWM")
+        elapsed = time.time() - start
+        monCpu = sum([cpu_seconds(pid) for pid in pids])
+        simCpu = cpu_seconds(sim.pid)
+        endFiles = read_all_metrics(dirloc)
+        stop(mon)
+    finally :
+        if (mon != None) :
+            stop(mon)
+        stop(sim)
+        simlog.close()
+
+    if (mon.returncode not in (0, -signal.SIGTERM)) and (time.time() - start < options.seconds) :
+        print("FAILED: ontapmon.py exited with %s, see %s/ontapmon.out" %(mon.returncode, tmpdir))
+        sys.exit(1)
+
+    print("%d filers x %d aggregates x %d volumes, %g ms simulated latency, %s engine, %s client, %d shard(s), %g s run" %(
+        options.filers, options.aggrs, options.vols, options.latency, options.engine, options.client,
+        options.shards, options.seconds))
+    if (firstPass == None) :
+        print("fleet cycle time:      not finished (%d of %d XML files), run longer (-s)" %(
+            count_xml(dirloc), options.filers))
+    else :
+        print("fleet cycle time:      %8.2f s, first pass including filer list and topology" %(firstPass))
+        print("first pass throughput: %8.1f filers/s" %(options.filers / firstPass))
+
+    okName = ("ontapmon_collections_total", 'result="ok"')
+    failedName = ("ontapmon_collections_total", 'result="failed"')
+    timeName = ("ontapmon_last_export_time_seconds", "")
+    # Each metrics file has its own window between its two exports
+    rate = 0.0
+    ok = 0
+    failed = 0
+    windows = []
+    for name in endFiles :
+        first = (steady or {}).get(name, {})
+        last = endFiles[name]
+        if (timeName not in first) or (timeName not in last) or (last[timeName] <= first[timeName]) :
+            continue
+        window = last[timeName] - first[timeName]
+        nok = last.get(okName, 0) - first.get(okName, 0)
+        nfailed = last.get(failedName, 0) - first.get(failedName, 0)
+        rate = rate + (nok + nfailed) / window
+        ok = ok + nok
+        failed = failed + nfailed
+        windows.append(window)
+    if (len(windows) > 0) :
+        print("steady state:          %8.1f collections/s over %.1f s (%d ok, %d failed)" %(
+            rate, min(windows), ok, failed))
+
+    end = merge_metrics(endFiles)
+
+    count = end.get(("ontapmon_collection_seconds_count", ""), 0)
+    if (count > 0) :
+        print("collection latency:    %8.3f s mean, p95 <= %s s" %(
+            end[("ontapmon_collection_seconds_sum", "")] / count,
+            quantile(end, "ontapmon_collection_seconds", 0.95)))
+    calls = metric_sum(end, "ontapmon_zapi_calls_total")
+    print("ZAPI calls:            %8d (%d failed), p95 <= %s s" %(
+        calls, metric_sum(end, "ontapmon_zapi_call_failures_total"),
+        quantile(end, "ontapmon_zapi_call_seconds", 0.95, 'api="perf-get-counter-data"')))
+    print("overrun samples:       %8d" %(end.get(("ontapmon_overrun_samples_total", ""), 0)))
+    print("memory:                %8.1f MB RSS at end, %.1f MB peak RSS, %.1f MB high water mark" %(
+        rss / 1024.0, peak / 1024.0, hwm / 1024.0))
+    # A simulator near one CPU is the limit, not ontapmon
+    print("CPU:                   %8.0f%% ontapmon.py, %.0f%% dfmsim.py" %(
+        100.0 * monCpu / elapsed, 100.0 * simCpu / elapsed))
+
+    if (options.keep) :
+        print("logs and output kept in " + tmpdir)
+    else :
+        shutil.rmtree(tmpdir)
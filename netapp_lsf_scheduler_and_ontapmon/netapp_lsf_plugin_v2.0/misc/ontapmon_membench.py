@@ -0,0 +1,135 @@
+#===============================================================#
+#                                                               #
+# $ID$                                                          #
+#                                                               #
+# ontapmon_membench.py - Memory benchmark of the filer data     #
+#               ontapmon.py keeps for the whole fleet. Builds   #
+#               filerDataDict for a synthetic fleet with the    #
+#               __slots__ classes of ontapmon.py and with plain #
+#               dict based classes like the ones they replaced, #
+#               each in its own process, and prints the growth  #
+#               of the resident set size.                       #
+#                                                               #
+#               Usage: ontapmon_membench.py [filers] [vols]     #
+#                                                               #
+#               filers = number of filers (default 1000)        #
+#               vols   = volumes per filer (default 1000)       #
+#                                                               #
+# Copyright (c) 2012 NetApp, Inc. All rights reserved.          #
+# Specifications subject to change without notice.              #
+#                                                               #
+#===============================================================#
+
+import sys
+import os
+import gc
+import ontapmon
+
+AGGRS_PER_FILER = 10
+DOMAINS = ("raid", "target", "kahuna", "storage", "nwk_legacy", "cifs")
+
+#
+# Dict based classes as ontapmon.py had them before __slots__
+#
+class DictFilerData(object):
+    def __init__(self) :
+        self.aggrDataDict = {}
+        self.domainDataDict = {}
+        self.aggrBatchOk = True
+
+class DictAggrData(object) :
+    def __init__(self) :
+        self.volumeDataDict = {}
+        self.maxdiskb = 0.0
+
+class DictVolumeData(object):
+    def __init__(self):
+        self.avglatency = 0.0
+        self.availSize = 0
+        self.availInodes = 0
+
+class DictDomainData(object):
+    def __init__(self):
+        self.dvalue = 0
+
+def plain_key(name):
+    return name
+
+#
+# @return resident set size of this process in bytes
+#
+def rss():
+    fp = open("/proc/self/statm")
+    pages = int(fp.read().split()[1])
+    fp.close()
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+#
+# Builds the fleet with the given classes. Names are built from parts
+# for every filer, as they are when parsed from DFM responses, so that
+# interning has copies to share.
+#
+def build(nfilers, nvols, FilerData, AggrData, VolumeData, DomainData, key):
+    fleet = {}
+    vols_per_aggr = max(nvols / AGGRS_PER_FILER, 1)
+    for i in range(nfilers) :
+        fdata = FilerData()
+        for a in range(AGGRS_PER_FILER) :
+            aggr = AggrData()
+            aggr.maxdiskb = 12.5 * a
+            for v in range(vols_per_aggr) :
+                vol = VolumeData()
+                vol.avglatency = 0.5 * v
+                vol.availSize = 1000000 * v
+                vol.availInodes = 1000 + v
+                aggr.volumeDataDict[key("vol%d_%d" %(a, v))] = vol
+            fdata.aggrDataDict[key("aggr%d" %(a))] = aggr
+        for d in DOMAINS :
+            dom = DomainData()
+            dom.dvalue = 42.0
+            fdata.domainDataDict[key("".join(list(d)))] = dom
+        fleet["filer%04d" %(i)] = fdata
+    return fleet
+
+#
+# Builds the fleet in a child process.
+# @return growth of the resident set size in bytes
+#
+def measure(nfilers, nvols, classes):
+    (rfd, wfd) = os.pipe()
+    pid = os.fork()
+    if (pid == 0) :
+        os.close(rfd)
+        gc.collect()
+        before = rss()
+        fleet = build(nfilers, nvols, *classes)
+        gc.collect()
+        os.write(wfd, str(rss() - before))
+        os._exit(0)
+    os.close(wfd)
+    result = os.read(rfd, 64)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return int(result)
+
+#
+# MAIN
+#
+if __name__ == '__main__':
+    nfilers = 1000
+    nvols = 1000
+    if (len(sys.argv) > 1) :
+        nfilers = int(sys.argv[1])
+    if (len(sys.argv) > 2) :
+        nvols = int(sys.argv[2])
+
+    slots = measure(nfilers, nvols, (ontapmon.FilerData, ontapmon.AggrData, ontapmon.VolumeData,
+                                     ontapmon.DomainData, ontapmon.name_key))
+    dicts = measure(nfilers, nvols, (DictFilerData, DictAggrData, DictVolumeData,
+                                     DictDomainData, plain_key))
+
+    nentries = nfilers * (max(nvols / AGGRS_PER_FILER, 1) * AGGRS_PER_FILER)
+    print("%d filers x %d volumes" %(nfilers, nvols))
+    print("dict based classes:   %8.1f MB, %5.0f bytes/volume" %(dicts / 1048576.0, float(dicts) / nentries))
+    print("__slots__ + interned: %8.1f MB, %5.0f bytes/volume" %(slots / 1048576.0, float(slots) / nentries))
+    print("saved:                %8.1f%%" %(100.0 * (dicts - slots) / dicts))
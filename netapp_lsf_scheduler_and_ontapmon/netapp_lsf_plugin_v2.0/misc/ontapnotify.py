@@ -0,0 +1,166 @@
+#===============================================================#
+#                                                               #
+# $ID$                                                          #
+#                                                               #
+# ontapnotify.py - Update notifications that ontapmon.py sends  #
+#               on a Unix domain socket (NOTIFY_SOCKET) when it #
+#               has written new data, so that consumers react   #
+#               at once instead of polling modification times.  #
+#                                                               #
+#               Subscribers connect to the socket and read one  #
+#               line per event:                                 #
+#                                                               #
+#               update <filer> <generation>                     #
+#                       <filer>.xml was rewritten with the      #
+#                       data of collection pass <generation>    #
+#               index <generation>                              #
+#                       a new fleet index was written           #
+#                                                               #
+#               Sending never blocks ontapmon.py. What a slow   #
+#               subscriber has not read yet is kept for it, up  #
+#               to MAX_BACKLOG bytes. Past that it is dropped,  #
+#               and has to reconnect and rescan, as the hot job #
+#               detector does.                                  #
+#                                                               #
+# Copyright (c) 2012 NetApp, Inc. All rights reserved.          #
+# Specifications subject to change without notice.              #
+#                                                               #
+#===============================================================#
+
+import os
+import stat
+import errno
+import select
+import socket
+import threading
+
+# Event kinds
+UPDATE = "update"
+INDEX = "index"
+
+# Bytes of events kept for a subscriber that does not read them fast
+# enough. The socket buffer alone only holds a few hundred events.
+MAX_BACKLOG = 1048576
+# Seconds between attempts to send the events left to slow subscribers
+FLUSH_INTERVAL = 0.1
+
+#
+# Accepts subscribers on the socket at path and sends them the events
+# published. The socket file of an earlier run is replaced.
+#
+class Publisher(threading.Thread):
+    def __init__(self, path, backlog=16, max_backlog=MAX_BACKLOG):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.path = path
+        self.maxBacklog = max_backlog
+        # [connection, events not sent yet, their size] of each subscriber
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.closed = False
+        try :
+            if (stat.S_ISSOCK(os.stat(path).st_mode)) :
+                os.remove(path)
+        except OSError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(backlog)
+
+    #
+    # Accepts subscribers, and sends the events left over by publish() to
+    # the subscribers that can take them again
+    #
+    def run(self):
+        while (not self.closed) :
+            self.lock.acquire()
+            try :
+                waiting = [sub[0] for sub in self.subscribers if sub[2] > 0]
+            finally :
+                self.lock.release()
+            try :
+                (readable, writable, errors) = select.select([self.sock], waiting, [], FLUSH_INTERVAL)
+            except (select.error, socket.error):
+                # A subscriber was dropped meanwhile
+                continue
+
+            if (len(readable) > 0) :
+                try :
+                    (conn, addr) = self.sock.accept()
+                except socket.error:
+                    continue
+                conn.setblocking(0)
+                self.lock.acquire()
+                try :
+                    self.subscribers.append([conn, [], 0])
+                finally :
+                    self.lock.release()
+
+            if (len(writable) > 0) :
+                self.lock.acquire()
+                try :
+                    for sub in self.subscribers[:] :
+                        if (sub[0] in writable) and (sub[2] > 0) :
+                            self.send(sub, "".join(sub[1]))
+                finally :
+                    self.lock.release()
+
+    #
+    # Sends data, all the events a subscriber has not got yet, and keeps
+    # what does not go through. A subscriber that is gone or would have
+    # more than max_backlog bytes left is disconnected. Called with the
+    # lock held.
+    # @return False if the subscriber was disconnected
+    #
+    def send(self, sub, data):
+        try :
+            data = data[sub[0].send(data):]
+        except socket.error, e:
+            if (e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK)) :
+                data = None
+        if (data != None) and (len(data) <= self.maxBacklog) :
+            sub[1] = (len(data) > 0) and [data] or []
+            sub[2] = len(data)
+            return True
+        sub[0].close()
+        self.subscribers.remove(sub)
+        return False
+
+    #
+    # Sends an event line to every subscriber without waiting. Subscribers
+    # that already have events left only get it queued behind them.
+    # @return number of subscribers disconnected
+    #
+    def publish(self, kind, *args):
+        line = " ".join([kind] + [str(a) for a in args]) + "\n"
+        dropped = 0
+        self.lock.acquire()
+        try :
+            for sub in self.subscribers[:] :
+                if (sub[2] == 0) :
+                    if (not self.send(sub, line)) :
+                        dropped = dropped + 1
+                elif (sub[2] + len(line) > self.maxBacklog) :
+                    sub[0].close()
+                    self.subscribers.remove(sub)
+                    dropped = dropped + 1
+                else :
+                    sub[1].append(line)
+                    sub[2] = sub[2] + len(line)
+        finally :
+            self.lock.release()
+        return dropped
+
+    def count(self):
+        return len(self.subscribers)
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+        self.lock.acquire()
+        try :
+            for sub in self.subscribers :
+                sub[0].close()
+            self.subscribers = []
+        finally :
+            self.lock.release()
@@ -0,0 +1,260 @@
+#===============================================================#
+#                                                               #
+# $ID$                                                          #
+#                                                               #
+# ontapring.py - Fixed size, memory mapped ring buffer of the   #
+#               last samples collected by ontapmon.py for a     #
+#               filer (HISTORY in config.ini). Each sample has  #
+#               a timestamp and one value per series, where a   #
+#               series is a volume latency (vol:<name>), an     #
+#               aggregate disk busy (aggr:<name>) or a domain   #
+#               busy (domain:<name>).                           #
+#                                                               #
+#               Layout (little endian, offsets from the start)  #
+#                                                               #
+#               header  HEADER, padded to HEADER_SIZE bytes     #
+#               names   maxseries x NAME_SIZE, NUL padded       #
+#               slots   nslots x (timestamp, maxseries values)  #
+#                       as doubles, NaN for a missing value     #
+#                                                               #
+#               The writer bumps seq to an odd value before it  #
+#               changes a slot and back to even afterwards, so  #
+#               readers retry when seq is odd or has changed.   #
+#               When more series are needed than fit, the file  #
+#               is rebuilt without the series that have no      #
+#               value left in it, with twice the room if still  #
+#               needed, and renamed over the old one; readers   #
+#               pick it up by themselves.                       #
+#                                                               #
+# Copyright (c) 2012 NetApp, Inc. All rights reserved.          #
+# Specifications subject to change without notice.              #
+#                                                               #
+#===============================================================#
+
+import os
+import mmap
+import time
+import struct
+
+MAGIC = "ONTR"
+VERSION = 1
+
+# magic, version, name size, nslots, maxseries, nseries, head, count, seq
+HEADER = struct.Struct("<4sHHIIIIIQ")
+HEADER_SIZE = 64
+NAME_SIZE = 128
+MIN_SERIES = 64
+# Times a reader retries while the writer changes a slot, and seconds
+# it waits between tries. A writer that died in the middle of append()
+# leaves seq odd until the next writer opens the ring.
+READ_RETRIES = 100
+READ_RETRY_WAIT = 0.001
+
+NAN = float("nan")
+
+class RingError(Exception):
+    pass
+
+class RingBuffer(object):
+    #
+    # Opens the ring at path. A writer creates it, or recreates it when
+    # it does not hold nslots samples, with room for maxseries series.
+    # A reader (nslots = None) only maps an existing ring.
+    #
+    def __init__(self, path, nslots=None, maxseries=MIN_SERIES):
+        self.path = path
+        self.writer = (nslots != None)
+        self.mm = None
+        if (self.writer) :
+            try :
+                self.map()
+                if (self.nslots != nslots) :
+                    raise RingError("ring has %d slots" %(self.nslots))
+            except (IOError, OSError, RingError):
+                self.close()
+                self.create(path, nslots, max(maxseries, MIN_SERIES))
+                self.map()
+            # A writer killed in append() left seq odd. The slot it was
+            # writing is the one after the newest, which no reader uses.
+            (magic, version, namesize, nslots, maxseries, nseries, head, count, seq) = self.header()
+            if (seq % 2) :
+                self.set_header(nseries, head, count, seq + 1)
+        else :
+            self.map()
+
+    def map(self):
+        fp = open(self.path, self.writer and "r+b" or "rb")
+        try :
+            st = os.fstat(fp.fileno())
+            if (st.st_size < HEADER_SIZE) :
+                raise RingError("ring too short")
+            if (self.writer) :
+                self.mm = mmap.mmap(fp.fileno(), st.st_size)
+            else :
+                self.mm = mmap.mmap(fp.fileno(), st.st_size, access=mmap.ACCESS_READ)
+        finally :
+            fp.close()
+        self.ino = st.st_ino
+
+        (magic, version, namesize, self.nslots, self.maxseries, nseries, head, count, seq) = \
+            HEADER.unpack_from(self.mm, 0)
+        if (magic != MAGIC) or (version != VERSION) or (namesize != NAME_SIZE) :
+            self.close()
+            raise RingError("not a version %d ring: %s" %(VERSION, self.path))
+        self.slotSize = 8 * (1 + self.maxseries)
+        self.slotOffset = HEADER_SIZE + self.maxseries * NAME_SIZE
+        if (st.st_size < self.slotOffset + self.nslots * self.slotSize) :
+            self.close()
+            raise RingError("ring truncated: " + self.path)
+        self.slotFmt = "<%dd" %(1 + self.maxseries)
+        self.names = []
+        self.index = {}
+        self.load_names(nseries)
+
+    def load_names(self, nseries):
+        for i in range(len(self.names), nseries) :
+            off = HEADER_SIZE + i * NAME_SIZE
+            name = self.mm[off:off + NAME_SIZE].rstrip("\0")
+            self.index[name] = len(self.names)
+            self.names.append(name)
+
+    # Creates an empty ring at path, through a temporary file
+    def create(self, path, nslots, maxseries, names=[], samples=[]):
+        tmpname = path + ".tmp"
+        fp = open(tmpname, "wb")
+        try :
+            slotSize = 8 * (1 + maxseries)
+            fp.truncate(HEADER_SIZE + maxseries * NAME_SIZE + nslots * slotSize)
+            fp.write(HEADER.pack(MAGIC, VERSION, NAME_SIZE, nslots, maxseries, len(names), 0, 0, 0))
+            for (i, name) in enumerate(names) :
+                fp.seek(HEADER_SIZE + i * NAME_SIZE)
+                fp.write(name)
+            pad = [NAN] * (maxseries - len(names))
+            fp.seek(HEADER_SIZE + maxseries * NAME_SIZE)
+            for (i, row) in enumerate(samples) :
+                fp.write(struct.pack("<%dd" %(1 + maxseries), *(list(row) + pad)))
+            fp.seek(0)
+            fp.write(HEADER.pack(MAGIC, VERSION, NAME_SIZE, nslots, maxseries, len(names),
+                                 len(samples) % nslots, len(samples), 0))
+        finally :
+            fp.close()
+        os.rename(tmpname, path)
+
+    def close(self):
+        if (self.mm != None) :
+            self.mm.close()
+            self.mm = None
+
+    def header(self):
+        return HEADER.unpack_from(self.mm, 0)
+
+    def set_header(self, nseries, head, count, seq):
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, NAME_SIZE, self.nslots, self.maxseries,
+                         nseries, head, count, seq)
+
+    #
+    # Adds a sample. values maps series names to numbers; series that
+    # are not in values get NaN for this sample.
+    #
+    def append(self, timestamp, values):
+        values = dict([(name[:NAME_SIZE], values[name]) for name in values])
+        new = [name for name in values if name not in self.index]
+        if (len(self.names) + len(new) > self.maxseries) :
+            self.grow(values, len(new))
+        (magic, version, namesize, nslots, maxseries, nseries, head, count, seq) = self.header()
+
+        for name in new :
+            off = HEADER_SIZE + len(self.names) * NAME_SIZE
+            self.mm[off:off + NAME_SIZE] = name.ljust(NAME_SIZE, "\0")
+            self.index[name] = len(self.names)
+            self.names.append(name)
+
+        row = [NAN] * (1 + self.maxseries)
+        row[0] = timestamp
+        for name in values :
+            row[1 + self.index[name]] = values[name]
+
+        self.set_header(nseries, head, count, seq + 1)
+        struct.pack_into(self.slotFmt, self.mm, self.slotOffset + head * self.slotSize, *row)
+        self.set_header(len(self.names), (head + 1) % self.nslots, min(count + 1, self.nslots), seq + 2)
+
+    #
+    # Rebuilds the ring with room for extra more series. Series without a
+    # value in any sample kept (volumes, aggregates and domains that went
+    # away) are left out, so that the ring only grows with the number of
+    # series a filer has at once. Those in keep, the sample about to be
+    # appended, stay.
+    #
+    def grow(self, keep, extra):
+        rows = self.rows()
+        cols = [i for i in range(len(self.names))
+                if (self.names[i] in keep) or any([row[1 + i] == row[1 + i] for row in rows])]
+        maxseries = self.maxseries
+        while (maxseries < len(cols) + extra) :
+            maxseries = maxseries * 2
+        self.close()
+        self.create(self.path, self.nslots, maxseries, [self.names[i] for i in cols],
+                    [[row[0]] + [row[1 + i] for i in cols] for row in rows])
+        self.map()
+
+    # Remaps the ring if the writer replaced the file
+    def check(self):
+        if (not self.writer) :
+            try :
+                if (os.stat(self.path).st_ino != self.ino) :
+                    self.close()
+                    self.map()
+            except OSError:
+                pass
+
+    #
+    # @return all samples, oldest first, as lists of the timestamp
+    # followed by one value per series
+    # @raise RingError if the writer did not let go of the ring within
+    # READ_RETRIES tries
+    #
+    def rows(self):
+        for attempt in range(READ_RETRIES) :
+            if (attempt > 0) :
+                time.sleep(READ_RETRY_WAIT)
+            (magic, version, namesize, nslots, maxseries, nseries, head, count, seq) = self.header()
+            if (seq % 2) :
+                continue
+            rows = []
+            for i in range(count) :
+                slot = (head - count + i) % self.nslots
+                rows.append(struct.unpack_from(self.slotFmt, self.mm, self.slotOffset + slot * self.slotSize))
+            if (self.header()[8] == seq) :
+                self.load_names(nseries)
+                return rows
+        raise RingError("ring kept changing while read: " + self.path)
+
+    def series(self):
+        self.check()
+        self.load_names(self.header()[5])
+        return list(self.names)
+
+    #
+    # @return list of (timestamp, value) of a series, oldest first, for
+    # the samples with start <= timestamp <= end
+    #
+    def samples(self, name, start=0.0, end=None):
+        self.check()
+        rows = self.rows()
+        if (name not in self.index) :
+            return []
+        col = 1 + self.index[name]
+        out = []
+        for row in rows :
+            if (row[0] < start) or ((end != None) and (row[0] > end)) :
+                continue
+            if (row[col] == row[col]) :
+                out.append((row[0], row[col]))
+        return out
+
+    # @return (timestamp, value) of the newest sample of a series, or None
+    def latest(self, name):
+        out = self.samples(name)
+        if (len(out) == 0) :
+            return None
+        return out[-1]
@@ -0,0 +1,174 @@
+#===============================================================#
+#                                                               #
+# $ID$                                                          #
+#                                                               #
+# ontapsnap.py - Writer and reader of the binary snapshot that  #
+#               ontapmon.py writes next to the XML file of each #
+#               filer (<filer>.snap) when SNAPSHOT = yes. The   #
+#               snapshot holds the same data as the XML file in #
+#               a fixed layout, so that readers can mmap it and #
+#               use struct instead of parsing XML.              #
+#                                                               #
+#               Layout (little endian, offsets from the start)  #
+#                                                               #
+#               header     HEADER (magic, version, counts)      #
+#               ipaddrs    nips x uint32 string index           #
+#               aggregates naggrs x AGGR_REC                    #
+#               volumes    nvols x VOL_REC, grouped by aggr     #
+#               domains    ndomains x DOMAIN_REC                #
+#               strings    (nstrings + 1) x uint32 offsets      #
+#                          followed by the UTF-8 string data    #
+#                                                               #
+#               String 0 is the filer name. Readers must check  #
+#               MAGIC and VERSION before using the counts.      #
+#                                                               #
+# Copyright (c) 2012 NetApp, Inc. All rights reserved.          #
+# Specifications subject to change without notice.              #
+#                                                               #
+#===============================================================#
+
+import os
+import mmap
+import struct
+
+MAGIC = "ONTS"
+VERSION = 1
+
+# magic, version, header size, collection time, nstrings, nips,
+# naggrs, nvols, ndomains
+HEADER = struct.Struct("<4sHHdIIIII")
+# name, first volume, number of volumes, maxdiskb
+AGGR_REC = struct.Struct("<IIId")
+# name, aggregate, avglatency, availsize, availinodes
+VOL_REC = struct.Struct("<IIdqq")
+# name, value
+DOMAIN_REC = struct.Struct("<Id")
+STR_OFF = struct.Struct("<I")
+
+class SnapshotError(Exception):
+    pass
+
+#
+# Writes a snapshot to fp.
+#   aggrs   - list of (name, maxdiskb, volumes) where volumes is a list
+#             of (name, avglatency, availsize, availinodes)
+#   domains - list of (name, value)
+#
+def write_snapshot(fp, filer, updated, ipaddrs, aggrs, domains):
+    strings = []
+
+    def intern_str(s):
+        if (isinstance(s, unicode)) :
+            s = s.encode("utf-8")
+        strings.append(s)
+        return len(strings) - 1
+
+    intern_str(filer)
+    ips = [intern_str(ip) for ip in ipaddrs]
+
+    arecs = []
+    vrecs = []
+    for (aname, maxdiskb, vols) in aggrs :
+        aidx = len(arecs)
+        arecs.append(AGGR_REC.pack(intern_str(aname), len(vrecs), len(vols), maxdiskb))
+        for (vname, avglatency, availsize, availinodes) in vols :
+            vrecs.append(VOL_REC.pack(intern_str(vname), aidx, avglatency, availsize, availinodes))
+
+    drecs = [DOMAIN_REC.pack(intern_str(dname), value) for (dname, value) in domains]
+
+    offsets = []
+    pos = 0
+    for s in strings :
+        offsets.append(STR_OFF.pack(pos))
+        pos = pos + len(s)
+    offsets.append(STR_OFF.pack(pos))
+
+    fp.write(HEADER.pack(MAGIC, VERSION, HEADER.size, updated, len(strings),
+                         len(ips), len(arecs), len(vrecs), len(drecs)))
+    fp.write("".join([STR_OFF.pack(i) for i in ips]))
+    fp.write("".join(arecs))
+    fp.write("".join(vrecs))
+    fp.write("".join(drecs))
+    fp.write("".join(offsets))
+    fp.write("".join(strings))
+
+#
+# Read only view of a snapshot held in a string, buffer or mmap.
+#
+class Snapshot(object):
+    def __init__(self, data):
+        if (len(data) < HEADER.size) :
+            raise SnapshotError("snapshot too short")
+        (magic, version, hsize, self.updated, self.nstrings, self.nips,
+         self.naggrs, self.nvols, self.ndomains) = HEADER.unpack_from(data, 0)
+        if (magic != MAGIC) :
+            raise SnapshotError("not a snapshot")
+        if (version != VERSION) :
+            raise SnapshotError("unsupported snapshot version %d" %(version))
+
+        self.data = data
+        self.ipOffset = hsize
+        self.aggrOffset = self.ipOffset + self.nips * STR_OFF.size
+        self.volOffset = self.aggrOffset + self.naggrs * AGGR_REC.size
+        self.domainOffset = self.volOffset + self.nvols * VOL_REC.size
+        self.strOffset = self.domainOffset + self.ndomains * DOMAIN_REC.size
+        self.strData = self.strOffset + (self.nstrings + 1) * STR_OFF.size
+        if (len(data) < self.strData) :
+            raise SnapshotError("snapshot truncated")
+        self.filer = self.string(0)
+
+    def string(self, i):
+        (start, end) = struct.unpack_from("<II", self.data, self.strOffset + i * STR_OFF.size)
+        return self.data[self.strData + start:self.strData + end]
+
+    def ipaddrs(self):
+        return [self.string(STR_OFF.unpack_from(self.data, self.ipOffset + i * STR_OFF.size)[0])
+                for i in range(self.nips)]
+
+    #
+    # @return (name, maxdiskb, first volume, number of volumes) of
+    # aggregate i
+    #
+    def aggr(self, i):
+        (name, first, nvols, maxdiskb) = AGGR_REC.unpack_from(self.data, self.aggrOffset + i * AGGR_REC.size)
+        return (self.string(name), maxdiskb, first, nvols)
+
+    #
+    # @return (name, aggregate index, avglatency, availsize,
+    # availinodes) of volume i
+    #
+    def volume(self, i):
+        (name, aggr, avglatency, availsize, availinodes) = \
+            VOL_REC.unpack_from(self.data, self.volOffset + i * VOL_REC.size)
+        return (self.string(name), aggr, avglatency, availsize, availinodes)
+
+    def aggregates(self):
+        return [self.aggr(i) for i in range(self.naggrs)]
+
+    def volumes(self):
+        return [self.volume(i) for i in range(self.nvols)]
+
+    # @return list of (name, value) of the domains
+    def domains(self):
+        doms = []
+        for i in range(self.ndomains) :
+            (name, value) = DOMAIN_REC.unpack_from(self.data, self.domainOffset + i * DOMAIN_REC.size)
+            doms.append((self.string(name), value))
+        return doms
+
+#
+# Maps the snapshot file at path. The file is replaced, never rewritten
+# in place, by ontapmon so the mapping stays valid after the file is
+# renamed over.
+# @return Snapshot
+#
+def open_snapshot(path):
+    fp = open(path, "rb")
+    try :
+        size = os.fstat(fp.fileno()).st_size
+        if (size == 0) :
+            raise SnapshotError("empty snapshot " + path)
+        data = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+    finally :
+        fp.close()
+    return Snapshot(data)
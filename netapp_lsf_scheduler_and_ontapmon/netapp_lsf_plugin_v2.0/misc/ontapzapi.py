@@ -0,0 +1,185 @@
+#===============================================================#
+#                                                               #
+# $ID$                                                          #
+#                                                               #
+# ontapzapi.py - Built-in ZAPI client used by ontapmon.py when  #
+#               CLIENT = builtin, so that the NMSDK is not      #
+#               needed. Provides ZapiElement, which has the     #
+#               part of the NMSDK NaElement interface that      #
+#               ontapmon.py uses, and a streaming response      #
+#               parser that keeps only the elements it is told  #
+#               to, dropping the rest of large responses while  #
+#               they are parsed.                                #
+#                                                               #
+#               The parser keeps its state per call and can be  #
+#               used from several threads at once, unlike       #
+#               NaServer.parse_xml().                           #
+#                                                               #
+# Copyright (c) 2012 NetApp, Inc. All rights reserved.          #
+# Specifications subject to change without notice.              #
+#                                                               #
+#===============================================================#
+
+import xml.parsers.expat
+
+#
+# ZAPI element with the same element dictionary (name, content,
+# children, attrs) and accessors as NaElement. Request trees are small
+# and response trees are trimmed by parse_response(), so the class only
+# uses __slots__ and lists, and serializes in a single pass.
+#
+class ZapiElement(object):
+    __slots__ = ('element',)
+
+    def __init__(self, name, value=None):
+        self.element = {'name': name, 'content': "", 'children': [], 'attrs': {}}
+        if (value != None) :
+            self.element['content'] = str(value)
+
+    def results_status(self):
+        status = self.element['attrs'].get('status')
+        if (status == None) or (status == "passed") :
+            return "passed"
+        return "failed"
+
+    def results_reason(self):
+        if (self.results_status() == "passed") :
+            return None
+        return str(self.element['attrs'].get('reason', "No reason given"))
+
+    def results_errno(self):
+        if (self.results_status() == "passed") :
+            return None
+        return self.element['attrs'].get('errno')
+
+    def attr_set(self, key, value):
+        self.element['attrs'][key] = str(value)
+
+    def attr_get(self, key):
+        return self.element['attrs'].get(key)
+
+    def add_content(self, content):
+        self.element['content'] = self.element['content'] + content
+
+    def set_content(self, content):
+        self.element['content'] = content
+
+    def has_children(self):
+        return (len(self.element['children']) != 0)
+
+    def child_add(self, child):
+        self.element['children'].append(child)
+
+    def child_add_string(self, name, value):
+        self.element['children'].append(ZapiElement(name, value))
+
+    def child_get(self, name):
+        for child in self.element['children'] :
+            if (child.element['name'] == name) :
+                return child
+        return None
+
+    def child_get_string(self, name):
+        child = self.child_get(name)
+        if (child == None) :
+            return None
+        return child.element['content']
+
+    def child_get_int(self, name):
+        value = self.child_get_string(name)
+        if (value == None) :
+            return None
+        return int(value)
+
+    def children_get(self):
+        return self.element['children']
+
+    def toEncodedString(self):
+        out = []
+        self.encode(out)
+        return "".join(out)
+
+    def encode(self, out):
+        name = self.element['name']
+        out.append("<" + name)
+        for (key, value) in self.element['attrs'].items() :
+            out.append(" " + key + "=\"" + escape(value, True) + "\"")
+        out.append(">")
+        for child in self.element['children'] :
+            child.encode(out)
+        out.append(escape(self.element['content']))
+        out.append("</" + name + ">")
+
+def escape(data, attr=False):
+    data = data.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    if (attr) :
+        data = data.replace("\"", "&quot;")
+    return data
+
+#
+# Builds a failed results element the way NaServer does, so callers can
+# check results_status()/results_reason() whatever went wrong.
+#
+def fail_response(errno, reason, element=ZapiElement):
+    n = element("results")
+    n.attr_set("status", "failed")
+    n.attr_set("reason", reason)
+    n.attr_set("errno", errno)
+    return n
+
+#
+# Parses a ZAPI response with expat into element objects (ZapiElement or
+# NaElement, given as element) and returns the results element.
+#
+# fields, if given, is the set of the element names to keep below
+# results. Any other element is dropped with everything inside it as the
+# parser goes, so the tree only holds what the caller will read. The
+# names of the container elements on the way to a kept field must be in
+# fields as well.
+#
+def parse_response(data, element=ZapiElement, fields=None):
+    stack = []
+    # Depth of the element being dropped, 0 when not dropping
+    state = {'skip': 0}
+
+    def start_element(name, attrs):
+        if (state['skip'] > 0) :
+            state['skip'] = state['skip'] + 1
+            return
+        if (fields != None) and (len(stack) > 1) and (name not in fields) :
+            state['skip'] = 1
+            return
+        n = element(name)
+        for key in attrs :
+            n.attr_set(key, attrs[key])
+        if (len(stack) > 0) :
+            stack[-1].child_add(n)
+        stack.append(n)
+
+    def end_element(name):
+        if (state['skip'] > 0) :
+            state['skip'] = state['skip'] - 1
+        elif (len(stack) > 1) :
+            stack.pop()
+
+    def char_data(data):
+        if (state['skip'] == 0) and (len(stack) > 0) :
+            stack[-1].add_content(data)
+
+    p = xml.parsers.expat.ParserCreate()
+    p.returns_unicode = 0
+    p.buffer_text = 1
+    p.StartElementHandler = start_element
+    p.EndElementHandler = end_element
+    p.CharacterDataHandler = char_data
+    try :
+        p.Parse(data, 1)
+    except xml.parsers.expat.ExpatError, e:
+        return fail_response(13001, "Unable to parse response: " + str(e), element)
+
+    if (len(stack) == 0) :
+        return fail_response(13001, "No netapp element in output!", element)
+    results = stack[0].child_get("results")
+    if (results == None) :
+        return fail_response(13001, "No results element in output!", element)
+    return results
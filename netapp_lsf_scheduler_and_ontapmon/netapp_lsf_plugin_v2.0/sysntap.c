@@ -2,6 +2,9 @@
  * Copyright (c) 2005-2012 NetApp, Inc.
  * All rights reserved.
  */
+#include <fcntl.h>
+#include <glob.h>
+#include <sys/mman.h>
 #include "sysntap.h"
 #include "tools/expat-2.0.1/lib/expat_external.h"
 #include "tools/expat-2.0.1/lib/expat.h"
@@ -21,6 +24,10 @@ static int    numfilesys;
 static int    numfilers;
 static int    numvols;
 
+static struct fleetidx fleetidx[MAX_FLEET_INDEX];
+static int    nfleetidx;
+static time_t fleetGlobTime;
+
 static char   logfile[PATH_MAX];
 static char   eventfile[PATH_MAX];
 
@@ -38,6 +45,10 @@ static int    parse_filerpolicies(const char *);
 static int    parse_params(const char *);
 static void   desperado(const char *);
 static int    parse_ctrxml(char *);
+static int    parse_ctrbuf(const char *, const char *, size_t);
+static void   fleet_refresh(void);
+static void   fleet_unmap(struct fleetidx *);
+static int    fleet_lookup(const char *, const char **, size_t *, unsigned long long *);
 static int    process_element();
 static void   char_handler(void *, const char *, int);
 static void   end_handler(void *, const char *);
@@ -238,6 +249,10 @@ filer_load_ok(const char *fstag)
     time_t		seconds;
     char		vname[PATH_MAX];
     int			res;
+    int			reread;
+    const char		*doc;
+    size_t		doclen;
+    unsigned long long	gen;
 
     /* Find the list of volumes for this
      * storage map.
@@ -258,13 +273,19 @@ filer_load_ok(const char *fstag)
      * zero out the contents of the filer in filertab and fstab
      * and so that filer information can be re-read 
      *
-     * Re-read if seconds - readTime(of each filer) > reread_value
+     * Re-read if seconds - readTime(of each filer) > reread_value, or
+     * if the filer is in a fleet index, when its generation changed.
      */
     seconds = time(NULL);
+    fleet_refresh();
     while (currp != NULL)  {
         filer = hash_lookup(filertab, currp->filer);
 	if (filer != NULL)  {
-        if ((seconds - filer->readTime) > prms.xmlreread) {
+	    if (fleet_lookup(currp->filer, &doc, &doclen, &gen) == 0)
+	        reread = (gen != filer->generation);
+	    else
+	        reread = ((seconds - filer->readTime) > prms.xmlreread);
+        if (reread) {
 	      log_msg(MSG_DEBUG, "%s: freeing up filer %s from table ", fname, currp->filer);
 	        free_filer(currp->filer);
 	        free_fs(currp->filer);
@@ -282,6 +303,18 @@ filer_load_ok(const char *fstag)
     while (currp != NULL) {
 	log_msg(MSG_DEBUG, "FILER %s:", currp->filer);
         filer = hash_lookup(filertab, currp->filer);
+	if ((filer == NULL) &&
+	    (fleet_lookup(currp->filer, &doc, &doclen, &gen) == 0)) {
+	    /* Parse XML Counter Document from the fleet index */
+	    log_msg(MSG_DEBUG, "%s: Parsing %s from fleet index", fname, currp->filer);
+	    if (parse_ctrbuf(currp->filer, doc, doclen)) {
+	      log_msg(MSG_ERR, "%s: Error in parsing %s", fname, currp->filer);
+	      return(-1);
+	    }
+	    filer = hash_lookup(filertab, currp->filer);
+	    if (filer != NULL)
+	        filer->generation = gen;
+	}
 	if (filer == NULL){
 	    sprintf(vname, "%s/%s.xml", prms.counterdir, currp->filer);
   	    /* Parse XML Counter Document */
@@ -972,6 +1005,230 @@ parse_ctrxml(char *xfile)
     return(0);
 } 
 
+/*
+ * parse_ctrbuf - parses the counter XML document of a filer taken from
+ * a fleet index, line by line like parse_ctrxml()
+ * @return -1: If unable to parse the counter XML document
+ */
+static int
+parse_ctrbuf(const char *filer, const char *buf, size_t size)
+{
+    char		fname[] = "parse_ctrbuf()";
+    char		lbuf[BUFSIZ];
+    const char		*p, *end, *eol;
+    size_t		len;
+
+    XML_Parser xp = XML_ParserCreate(NULL);
+    if (! xp) {
+	log_msg(MSG_ERR, "%s:Couldn't allocate memory for parser for filer %s\n", fname, filer);
+	return(-1);
+    }
+
+    XML_UseParserAsHandlerArg(xp);
+    XML_SetElementHandler(xp, start_handler, end_handler);
+    XML_SetCharacterDataHandler(xp, char_handler);
+    log_msg(MSG_DEBUG, "%s: Registered XML handlers for %s", fname, filer);
+    dcnt = 0;
+    p = buf;
+    end = buf + size;
+    while (p < end) {
+	/* Get a line from the document */
+	eol = memchr(p, '\n', end - p);
+	len = (eol == NULL) ? (size_t)(end - p) : (size_t)(eol - p + 1);
+	if (len > sizeof(lbuf) - 1)
+	    len = sizeof(lbuf) - 1;
+	memcpy(lbuf, p, len);
+	lbuf[len] = '\0';
+	p += len;
+	log_msg(MSG_DEBUG, "%s: Got line from filer %s", fname, lbuf);
+
+	/* Begin parsing line */
+	if (! XML_Parse(xp, lbuf, len, 0)) {
+	    log_msg(MSG_ERR, "%s: Parse error at line %d:\n%s\n", fname,
+		    XML_GetCurrentLineNumber(xp),
+		    XML_ErrorString(XML_GetErrorCode(xp)));
+	    XML_ParserFree(xp);
+	    return(-1);
+	}
+	/* Process the elements within XML doc */
+	if (process_element()) {
+	    XML_ParserFree(xp);
+	    return(-1);
+	}
+    }
+    /* Free parser structure allocated */
+    XML_ParserFree(xp);
+    return(0);
+}
+
+/*
+ * get_le() - reads an n byte little endian number of the fleet index
+ */
+static unsigned long long
+get_le(const char *p, int n)
+{
+    unsigned long long v = 0;
+
+    while (n-- > 0)
+	v = (v << 8) | (unsigned char)p[n];
+    return(v);
+}
+
+/*
+ * fleet_unmap() - unmaps a fleet index
+ */
+static void
+fleet_unmap(struct fleetidx *fx)
+{
+    if (fx->data != NULL)
+	munmap(fx->data, fx->size);
+    fx->data = NULL;
+    fx->ino = 0;
+    fx->nfilers = 0;
+}
+
+/*
+ * fleet_refresh() - maps the fleet indexes in Counter_Dir that were
+ * replaced since the last call.  ontapmon.py renames a new index over
+ * the old one, so one stat per index tells whether it changed.  The
+ * directory is only searched for indexes every XMLReread seconds.
+ */
+static void
+fleet_refresh(void)
+{
+    static char		fname[] = "fleet_refresh()";
+    char		pattern[PATH_MAX];
+    struct fleetidx	found[MAX_FLEET_INDEX];
+    struct fleetidx	*fx;
+    struct stat		st;
+    glob_t		gl;
+    time_t		now;
+    size_t		i;
+    int			j, n, fd;
+    char		*data;
+
+    now = time(NULL);
+    if ((now - fleetGlobTime) >= prms.xmlreread) {
+	fleetGlobTime = now;
+	sprintf(pattern, "%s/%s", prms.counterdir, FLEET_INDEX);
+	n = 0;
+	if (glob(pattern, 0, NULL, &gl) == 0) {
+	    for (i = 0; i < gl.gl_pathc && n < MAX_FLEET_INDEX; i++) {
+		memset(&found[n], 0, sizeof(struct fleetidx));
+		strncpy(found[n].path, gl.gl_pathv[i], PATH_MAX - 1);
+		/* Keep the mapping of an index already known */
+		for (j = 0; j < nfleetidx; j++) {
+		    if (strcmp(fleetidx[j].path, found[n].path) == 0) {
+			found[n] = fleetidx[j];
+			fleetidx[j].data = NULL;
+			break;
+		    }
+		}
+		n++;
+	    }
+	    globfree(&gl);
+	}
+	for (j = 0; j < nfleetidx; j++)
+	    fleet_unmap(&fleetidx[j]);
+	memcpy(fleetidx, found, n * sizeof(struct fleetidx));
+	nfleetidx = n;
+    }
+
+    for (j = 0; j < nfleetidx; j++) {
+	fx = &fleetidx[j];
+	if (stat(fx->path, &st) < 0) {
+	    fleet_unmap(fx);
+	    continue;
+	}
+	if ((fx->data != NULL) && (st.st_ino == fx->ino))
+	    continue;
+
+	fleet_unmap(fx);
+	fd = open(fx->path, O_RDONLY);
+	if (fd < 0)
+	    continue;
+	if ((fstat(fd, &st) < 0) || (st.st_size < FLEET_HEADER_SIZE)) {
+	    close(fd);
+	    continue;
+	}
+	data = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+	close(fd);
+	if (data == MAP_FAILED) {
+	    log_msg(MSG_ERR, "%s: Couldn't map %s %s", fname, fx->path, errstr);
+	    continue;
+	}
+	fx->data = data;
+	fx->size = st.st_size;
+	fx->ino = st.st_ino;
+	if ((memcmp(data, FLEET_MAGIC, 4) != 0) ||
+	    (get_le(data + 4, 2) != FLEET_VERSION)) {
+	    log_msg(MSG_ERR, "%s: %s is not a fleet index", fname, fx->path);
+	    fleet_unmap(fx);
+	    continue;
+	}
+	fx->table = get_le(data + 6, 2);
+	fx->nfilers = get_le(data + 24, 4);
+	if (fx->table + (size_t)fx->nfilers * FLEET_ENTRY_SIZE > fx->size) {
+	    log_msg(MSG_ERR, "%s: %s is truncated", fname, fx->path);
+	    fleet_unmap(fx);
+	    continue;
+	}
+	log_msg(MSG_DEBUG, "%s: mapped %s generation %llu, %u filers", fname,
+		fx->path, get_le(data + 8, 8), fx->nfilers);
+    }
+}
+
+/*
+ * fleet_lookup() - finds the counter XML document of a filer in the
+ * fleet indexes.  The entries of an index are sorted by filer name.
+ * @return -1: If the filer is in no fleet index
+ */
+static int
+fleet_lookup(const char *filer, const char **doc, size_t *doclen, unsigned long long *gen)
+{
+    struct fleetidx	*fx;
+    const char		*entry;
+    unsigned long long	noff, doff;
+    size_t		nlen, dlen, flen;
+    unsigned int	lo, hi, mid;
+    int			j, cmp;
+
+    flen = strlen(filer);
+    for (j = 0; j < nfleetidx; j++) {
+	fx = &fleetidx[j];
+	if (fx->data == NULL)
+	    continue;
+	lo = 0;
+	hi = fx->nfilers;
+	while (lo < hi) {
+	    mid = lo + (hi - lo) / 2;
+	    entry = fx->data + fx->table + (size_t)mid * FLEET_ENTRY_SIZE;
+	    noff = get_le(entry, 8);
+	    nlen = get_le(entry + 8, 4);
+	    if (noff + nlen > fx->size)
+		return(-1);
+	    cmp = memcmp(fx->data + noff, filer, nlen < flen ? nlen : flen);
+	    if (cmp == 0)
+		cmp = (nlen > flen) - (nlen < flen);
+	    if (cmp == 0) {
+		doff = get_le(entry + 12, 8);
+		dlen = get_le(entry + 20, 4);
+		if (doff + dlen > fx->size)
+		    return(-1);
+		*doc = fx->data + doff;
+		*doclen = dlen;
+		*gen = get_le(entry + 32, 8);
+		return(0);
+	    }
+	    if (cmp < 0)
+		lo = mid + 1;
+	    else
+		hi = mid;
+	}
+    }
+    return(-1);
+}
+
 /*
  * start_handler() - handler for the start tag which just keep track of depth.
  */
@@ -1044,6 +1301,9 @@ process_element()
     }
 
     if (strcmp(endelement, "value") == 0) {
+	/* Domains past DOMAIN_SIZE (see DOMAIN_COUNTERS) are not checked */
+	if (dcnt >= DOMAIN_SIZE)
+	    return(0);
 	ftmp->domains[dcnt] = atof(last_content); 
 	log_msg(MSG_DEBUG, "%s: domain value %0.5f", fname, ftmp->domains[dcnt]);
 	dcnt++;
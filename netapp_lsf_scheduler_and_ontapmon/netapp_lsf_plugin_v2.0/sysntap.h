@@ -28,6 +28,16 @@
 #define XMLReread     "XMLReread"
 #define DryRunMode    "DryRunMode"
 
+/* Fleet indexes written by ontapmon.py with FLEET_INDEX = yes, see
+ * misc/ontapfleet.py for the layout
+ */
+#define FLEET_INDEX        "fleet*.idx"
+#define FLEET_MAGIC        "ONTF"
+#define FLEET_VERSION      1
+#define FLEET_HEADER_SIZE  28
+#define FLEET_ENTRY_SIZE   40
+#define MAX_FLEET_INDEX    64
+
 /* Configuration 
  */
 struct filesystags {
@@ -83,6 +93,18 @@ struct filer {
     time_t		readTime;
     char                *name;
     double		domains[DOMAIN_SIZE];
+    unsigned long long	generation;
+};
+
+/* A mapped fleet index
+ */
+struct fleetidx {
+    char		path[PATH_MAX];
+    ino_t		ino;
+    char		*data;
+    size_t		size;
+    unsigned int	nfilers;
+    unsigned int	table;
 };
 
 /* The file system